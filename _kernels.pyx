@@ -0,0 +1,405 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+
+Compiled kernels for kernels.py. Build with `python setup.py build_ext --inplace`
+
+"""
+from cython cimport floating
+from libc.stdlib cimport malloc, free
+from libc.math cimport log, logf
+
+
+def inner(floating[:, ::1] beta, floating[:, ::1] theta,
+          int[::1] rows, int[::1] cols, floating[::1] data):
+    '''
+    data[i] = sum_k beta[rows[i], k] * theta[k, cols[i]]
+    '''
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc
+    with nogil:
+        for i in range(n_ratings):
+            acc = 0
+            for j in range(n_components):
+                acc = acc + beta[rows[i], j] * theta[j, cols[i]]
+            data[i] = acc
+
+
+def ratio_dot_items(floating[::1] X_data, floating[:, ::1] beta,
+                    floating[:, ::1] theta, int[::1] rows, int[::1] cols,
+                    floating[:, ::1] theta_acc, floating[:, ::1] out):
+    '''
+    out[rows[i]] += X_data[i] / <beta[rows[i]], theta[:, cols[i]]> *
+        theta_acc[:, cols[i]]
+    '''
+    cdef Py_ssize_t i, j, d, u
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc, ratio
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            acc = 0
+            for j in range(n_components):
+                acc = acc + beta[d, j] * theta[j, u]
+            ratio = X_data[i] / acc
+            for j in range(n_components):
+                out[d, j] += ratio * theta_acc[j, u]
+
+
+def ratio_dot_users(floating[::1] X_data, floating[:, ::1] beta,
+                    floating[:, ::1] theta, int[::1] rows, int[::1] cols,
+                    floating[:, ::1] beta_acc, floating[:, ::1] out):
+    '''
+    out[:, cols[i]] += X_data[i] / <beta[rows[i]], theta[:, cols[i]]> *
+        beta_acc[rows[i]]
+    '''
+    cdef Py_ssize_t i, j, d, u
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc, ratio
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            acc = 0
+            for j in range(n_components):
+                acc = acc + beta[d, j] * theta[j, u]
+            ratio = X_data[i] / acc
+            for j in range(n_components):
+                out[j, u] += ratio * beta_acc[d, j]
+
+
+def ratio_dot_items_csr(floating[::1] X_data, floating[:, ::1] beta,
+                        floating[:, ::1] theta, int[::1] cols,
+                        int[::1] order, int[::1] indptr,
+                        floating[:, ::1] theta_acc, floating[:, ::1] out,
+                        Py_ssize_t start, Py_ssize_t end):
+    '''
+    ratio_dot_items over items start..end, visiting the ratings of each item
+    through the CSR order so that threads own disjoint rows of out
+    '''
+    cdef Py_ssize_t i, j, d, u, p
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc, ratio
+    with nogil:
+        for d in range(start, end):
+            for p in range(indptr[d], indptr[d + 1]):
+                i = order[p]
+                u = cols[i]
+                acc = 0
+                for j in range(n_components):
+                    acc = acc + beta[d, j] * theta[j, u]
+                ratio = X_data[i] / acc
+                for j in range(n_components):
+                    out[d, j] += ratio * theta_acc[j, u]
+
+
+def ratio_dot_users_csc(floating[::1] X_data, floating[:, ::1] beta,
+                        floating[:, ::1] theta, int[::1] rows,
+                        int[::1] order, int[::1] indptr,
+                        floating[:, ::1] beta_acc, floating[:, ::1] out,
+                        Py_ssize_t start, Py_ssize_t end):
+    '''
+    ratio_dot_users over users start..end, visiting the ratings of each user
+    through the CSC order so that threads own disjoint columns of out
+    '''
+    cdef Py_ssize_t i, j, d, u, p
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc, ratio
+    cdef floating *col = <floating *> malloc(n_components * sizeof(floating))
+    with nogil:
+        for u in range(start, end):
+            for j in range(n_components):
+                col[j] = 0
+            for p in range(indptr[u], indptr[u + 1]):
+                i = order[p]
+                d = rows[i]
+                acc = 0
+                for j in range(n_components):
+                    acc = acc + beta[d, j] * theta[j, u]
+                ratio = X_data[i] / acc
+                for j in range(n_components):
+                    col[j] += ratio * beta_acc[d, j]
+            for j in range(n_components):
+                out[j, u] = col[j]
+    free(col)
+
+
+def inner2(floating[:, ::1] beta1, floating[:, ::1] beta2,
+           floating[:, ::1] theta, int[::1] rows, int[::1] cols,
+           floating[::1] data1, floating[::1] data2):
+    '''
+    inner(beta1, ...) and inner(beta2, ...) in one sweep over theta
+    '''
+    cdef Py_ssize_t i, j, d, u
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc1, acc2, t
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            acc1 = 0
+            acc2 = 0
+            for j in range(n_components):
+                t = theta[j, u]
+                acc1 = acc1 + beta1[d, j] * t
+                acc2 = acc2 + beta2[d, j] * t
+            data1[i] = acc1
+            data2[i] = acc2
+
+
+def ratio_dot_users2(floating[::1] X_data, floating[:, ::1] beta1,
+                     floating[:, ::1] beta2, floating[:, ::1] theta,
+                     int[::1] rows, int[::1] cols,
+                     floating[:, ::1] beta_acc1, floating[:, ::1] beta_acc2,
+                     floating[:, ::1] out1, floating[:, ::1] out2):
+    '''
+    ratio_dot_users for (beta1, beta_acc1) into out1 and (beta2, beta_acc2)
+    into out2, sharing the reads of theta
+    '''
+    cdef Py_ssize_t i, j, d, u
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc1, acc2, ratio1, ratio2, t
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            acc1 = 0
+            acc2 = 0
+            for j in range(n_components):
+                t = theta[j, u]
+                acc1 = acc1 + beta1[d, j] * t
+                acc2 = acc2 + beta2[d, j] * t
+            ratio1 = X_data[i] / acc1
+            ratio2 = X_data[i] / acc2
+            for j in range(n_components):
+                out1[j, u] += ratio1 * beta_acc1[d, j]
+                out2[j, u] += ratio2 * beta_acc2[d, j]
+
+
+def ratio_dot_users2_csc(floating[::1] X_data, floating[:, ::1] beta1,
+                         floating[:, ::1] beta2, floating[:, ::1] theta,
+                         int[::1] rows, int[::1] order, int[::1] indptr,
+                         floating[:, ::1] beta_acc1,
+                         floating[:, ::1] beta_acc2,
+                         floating[:, ::1] out1, floating[:, ::1] out2,
+                         Py_ssize_t start, Py_ssize_t end):
+    '''
+    ratio_dot_users2 over users start..end through the CSC order, reading
+    each user's theta column into a buffer once
+    '''
+    cdef Py_ssize_t i, j, d, u, p
+    cdef Py_ssize_t n_components = theta.shape[0]
+    cdef floating acc1, acc2, ratio1, ratio2
+    cdef floating *buf = <floating *> malloc(
+        3 * n_components * sizeof(floating))
+    cdef floating *t = buf
+    cdef floating *col1 = buf + n_components
+    cdef floating *col2 = buf + 2 * n_components
+    with nogil:
+        for u in range(start, end):
+            for j in range(n_components):
+                t[j] = theta[j, u]
+                col1[j] = 0
+                col2[j] = 0
+            for p in range(indptr[u], indptr[u + 1]):
+                i = order[p]
+                d = rows[i]
+                acc1 = 0
+                acc2 = 0
+                for j in range(n_components):
+                    acc1 = acc1 + beta1[d, j] * t[j]
+                    acc2 = acc2 + beta2[d, j] * t[j]
+                ratio1 = X_data[i] / acc1
+                ratio2 = X_data[i] / acc2
+                for j in range(n_components):
+                    col1[j] += ratio1 * beta_acc1[d, j]
+                    col2[j] += ratio2 * beta_acc2[d, j]
+            for j in range(n_components):
+                out1[j, u] = col1[j]
+                out2[j, u] = col2[j]
+    free(buf)
+
+
+# The *_sparse kernels take an item factor as its CSR arrays (data, indices,
+# indptr), e.g. observed category indicators, and visit only the stored
+# entries of each item's row instead of all n_components
+
+
+def inner_sparse(floating[::1] b_data, int[::1] b_indices, int[::1] b_indptr,
+                 floating[:, ::1] theta, int[::1] rows, int[::1] cols,
+                 floating[::1] data):
+    '''
+    data[i] = sum over the stored k of beta[rows[i], k] * theta[k, cols[i]]
+    '''
+    cdef Py_ssize_t i, p, d, u
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef floating acc
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            acc = 0
+            for p in range(b_indptr[d], b_indptr[d + 1]):
+                acc = acc + b_data[p] * theta[b_indices[p], u]
+            data[i] = acc
+
+
+def ratio_dot_items_sparse_csr(floating[::1] X_data, floating[::1] b_data,
+                               int[::1] b_indices, int[::1] b_indptr,
+                               floating[:, ::1] theta, int[::1] cols,
+                               int[::1] order, int[::1] indptr,
+                               floating[:, ::1] theta_acc,
+                               floating[:, ::1] out,
+                               Py_ssize_t start, Py_ssize_t end):
+    '''
+    ratio_dot_items_csr with a CSR beta
+    '''
+    cdef Py_ssize_t i, j, d, u, p, q
+    cdef Py_ssize_t n_components = theta_acc.shape[0]
+    cdef floating acc, ratio
+    with nogil:
+        for d in range(start, end):
+            for p in range(indptr[d], indptr[d + 1]):
+                i = order[p]
+                u = cols[i]
+                acc = 0
+                for q in range(b_indptr[d], b_indptr[d + 1]):
+                    acc = acc + b_data[q] * theta[b_indices[q], u]
+                ratio = X_data[i] / acc
+                for j in range(n_components):
+                    out[d, j] += ratio * theta_acc[j, u]
+
+
+def ratio_dot_users_sparse(floating[::1] X_data, floating[::1] b_data,
+                           int[::1] b_indices, int[::1] b_indptr,
+                           floating[:, ::1] theta, int[::1] rows,
+                           int[::1] cols, floating[::1] a_data,
+                           int[::1] a_indices, int[::1] a_indptr,
+                           floating[:, ::1] out):
+    '''
+    ratio_dot_users with a CSR beta and a CSR beta_acc: the accumulation is
+    a sum over the stored entries of beta_acc's row
+    '''
+    cdef Py_ssize_t i, d, u, q
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    cdef floating acc, ratio
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            acc = 0
+            for q in range(b_indptr[d], b_indptr[d + 1]):
+                acc = acc + b_data[q] * theta[b_indices[q], u]
+            ratio = X_data[i] / acc
+            for q in range(a_indptr[d], a_indptr[d + 1]):
+                out[a_indices[q], u] += ratio * a_data[q]
+
+
+def ratio_dot_users_sparse_csc(floating[::1] X_data, floating[::1] b_data,
+                               int[::1] b_indices, int[::1] b_indptr,
+                               floating[:, ::1] theta, int[::1] rows,
+                               int[::1] order, int[::1] indptr,
+                               floating[::1] a_data, int[::1] a_indices,
+                               int[::1] a_indptr, floating[:, ::1] out,
+                               Py_ssize_t start, Py_ssize_t end):
+    '''
+    ratio_dot_users_sparse over users start..end through the CSC order
+    '''
+    cdef Py_ssize_t i, j, d, u, p, q
+    cdef Py_ssize_t n_components = out.shape[0]
+    cdef floating acc, ratio
+    cdef floating *col = <floating *> malloc(n_components * sizeof(floating))
+    with nogil:
+        for u in range(start, end):
+            for j in range(n_components):
+                col[j] = 0
+            for p in range(indptr[u], indptr[u + 1]):
+                i = order[p]
+                d = rows[i]
+                acc = 0
+                for q in range(b_indptr[d], b_indptr[d + 1]):
+                    acc = acc + b_data[q] * theta[b_indices[q], u]
+                ratio = X_data[i] / acc
+                for q in range(a_indptr[d], a_indptr[d + 1]):
+                    col[a_indices[q]] += ratio * a_data[q]
+            for j in range(n_components):
+                out[j, u] = col[j]
+    free(col)
+
+
+# The masked_dot_items kernels take the ratios X / (beta theta) and a mask
+# in CSR form (indptr, indices) of the (item, component) pairs to update,
+# and accumulate only those entries of ratio_dot_items, in the order of the
+# mask's entries
+
+
+def masked_dot_items(floating[::1] ratio, floating[:, ::1] theta_acc,
+                     int[::1] rows, int[::1] cols, int[::1] m_indptr,
+                     int[::1] m_indices, floating[::1] out):
+    '''
+    out[p] += ratio[i] * theta_acc[m_indices[p], cols[i]] for the entries p
+    of row rows[i] of the mask
+    '''
+    cdef Py_ssize_t i, d, u, p
+    cdef Py_ssize_t n_ratings = rows.shape[0]
+    with nogil:
+        for i in range(n_ratings):
+            d = rows[i]
+            u = cols[i]
+            for p in range(m_indptr[d], m_indptr[d + 1]):
+                out[p] += ratio[i] * theta_acc[m_indices[p], u]
+
+
+def masked_dot_items_csr(floating[::1] ratio, floating[:, ::1] theta_acc,
+                         int[::1] cols, int[::1] order, int[::1] indptr,
+                         int[::1] m_indptr, int[::1] m_indices,
+                         floating[::1] out, Py_ssize_t start, Py_ssize_t end):
+    '''
+    masked_dot_items over items start..end through the CSR order, so that
+    threads own disjoint entries of out
+    '''
+    cdef Py_ssize_t i, d, u, p, q
+    with nogil:
+        for d in range(start, end):
+            for p in range(indptr[d], indptr[d + 1]):
+                i = order[p]
+                u = cols[i]
+                for q in range(m_indptr[d], m_indptr[d + 1]):
+                    out[q] += ratio[i] * theta_acc[m_indices[q], u]
+
+
+cdef inline floating _digamma(floating x) noexcept nogil:
+    # recurrence psi(x) = psi(x + 1) - 1 / x up to x >= 6, with the sum of
+    # the 1 / x terms kept as one fraction to save divisions, then the
+    # asymptotic series, which is within float32 precision from there
+    cdef floating num = 0
+    cdef floating den = 1
+    cdef floating inv, inv2, result
+    while x < 6:
+        num = num * x + den
+        den = den * x
+        x += 1
+    inv = 1 / x
+    inv2 = inv * inv
+    if floating is float:
+        result = logf(x)
+    else:
+        result = log(x)
+    return result - num / den - 0.5 * inv - inv2 * (1. / 12 - inv2 * (
+        1. / 120 - inv2 * (1. / 252 - inv2 * (1. / 240 - inv2 * (1. / 132)))))
+
+
+def digamma(floating[::1] x, floating[::1] out):
+    '''
+    out[i] = psi(x[i]) for x[i] > 0
+    '''
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(x.shape[0]):
+            out[i] = _digamma(x[i])
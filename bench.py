@@ -0,0 +1,385 @@
+"""
+
+Micro-benchmarks for the kernels in kernels.py, and the iterations the
+estimators take to converge, e.g.
+
+    python bench.py digamma --n_threads 4
+    python bench.py init --data_dir ~/arxiv/dat/dataset_2003-2012_clean/
+    python bench.py squarem
+
+"""
+import argparse
+import os
+import time
+import numpy as np
+from scipy import sparse, special
+
+import ctpf
+import datacache
+import hpmf
+import kernels
+import pmf
+import variational
+
+
+def best_time(func, repeat):
+    ''' Best wall clock time of repeat calls to func, in seconds '''
+    best = np.inf
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        best = min(best, time.time() - start)
+    return best
+
+
+def bench_digamma(args):
+    '''
+    Max error of kernels.digamma against scipy.special.psi in double
+    precision, per argument range, and its speed against scipy.special.psi
+    on float32 arrays, for every backend
+    '''
+    rng = np.random.RandomState(args.seed)
+    print 'digamma max error vs scipy.special.psi (float64)'
+    print '{:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'low', 'high', 'backend', 'abs error', 'rel error')
+    for low, high in [(1e-5, 1e-1), (1e-1, 6.), (6., 1e6)]:
+        x = np.exp(rng.uniform(np.log(low), np.log(high), size=args.size)
+                   ).astype(np.float32)
+        reference = special.psi(x.astype(np.float64))
+        for backend in kernels.available_backends():
+            kernels.set_backend(backend)
+            error = np.abs(kernels.digamma(x) - reference)
+            print '{:>10g} {:>10g} {:>10} {:>12.3g} {:>12.3g}'.format(
+                low, high, backend, error.max(),
+                (error / np.maximum(np.abs(reference), 1.)).max())
+
+    # shape parameters of a fitted model sit mostly just above the prior
+    x = (0.3 + rng.gamma(1., 10., size=args.size)).astype(np.float32)
+    out = np.empty_like(x)
+    print
+    print 'digamma on {} float32 values, {} threads'.format(
+        args.size, kernels.get_num_threads())
+    scipy_time = best_time(lambda: special.psi(x, out=out), args.repeat)
+    print '{:>10} {:>10.4f} sec'.format('scipy', scipy_time)
+    for backend in kernels.available_backends():
+        kernels.set_backend(backend)
+        seconds = best_time(lambda: kernels.digamma(x, out=out), args.repeat)
+        print '{:>10} {:>10.4f} sec  {:.2f}x'.format(
+            backend, seconds, scipy_time / seconds)
+
+
+def bench_dual(args):
+    '''
+    Two single-factor sweeps against the fused two-factor kernels used by
+    the ctpf and uaspmf user updates and predictive likelihoods
+    '''
+    rng = np.random.RandomState(args.seed)
+    n_items, n_users, n_components = 20000, 50000, 100
+    rows = rng.randint(n_items, size=args.size).astype(np.int32)
+    cols = rng.randint(n_users, size=args.size).astype(np.int32)
+    X_data = np.ones(args.size, dtype=np.float32)
+    pattern = kernels.SparsityPattern(rows, cols, (n_items, n_users))
+    beta1, beta2 = [rng.gamma(1., 1., size=(n_items, n_components)
+                              ).astype(np.float32) for _ in xrange(2)]
+    theta = rng.gamma(1., 1., size=(n_components, n_users)).astype(np.float32)
+
+    def two_inner():
+        kernels.inner(beta1, theta, rows, cols)
+        kernels.inner(beta2, theta, rows, cols)
+
+    def two_ratio_dot_users():
+        kernels.ratio_dot_users(X_data, beta1, theta, rows, cols,
+                                pattern=pattern)
+        kernels.ratio_dot_users(X_data, beta2, theta, rows, cols,
+                                pattern=pattern)
+
+    print '{} ratings, {} components, {} threads'.format(
+        args.size, n_components, kernels.get_num_threads())
+    for backend in kernels.available_backends():
+        kernels.set_backend(backend)
+        for name, separate, fused in [
+                ('inner', two_inner,
+                 lambda: kernels.inner2(beta1, beta2, theta, rows, cols)),
+                ('ratio_dot_users', two_ratio_dot_users,
+                 lambda: kernels.ratio_dot_users2(X_data, beta1, beta2, theta,
+                                                  rows, cols, pattern=pattern))]:
+            separate_time = best_time(separate, args.repeat)
+            fused_time = best_time(fused, args.repeat)
+            print '{:>10} {:>16}: two sweeps {:.4f} sec, fused {:.4f} sec, ' \
+                '{:.2f}x'.format(backend, name, separate_time, fused_time,
+                                 separate_time / fused_time)
+
+
+def bench_categories(args):
+    '''
+    The observed-attribute user update and predictive likelihood with the
+    category indicators as a dense beta against the same beta in CSR, which
+    runs the *_sparse kernels over each paper's few categories
+    '''
+    rng = np.random.RandomState(args.seed)
+    n_items, n_users, n_components = 20000, 50000, 166
+    rows = rng.randint(n_items, size=args.size).astype(np.int32)
+    cols = rng.randint(n_users, size=args.size).astype(np.int32)
+    X_data = np.ones(args.size, dtype=np.float32)
+    pattern = kernels.SparsityPattern(rows, cols, (n_items, n_users))
+    # 1 to 4 categories per paper, as on arxiv
+    n_categories = rng.randint(1, 5, size=n_items)
+    dense = np.zeros((n_items, n_components), dtype=np.float32)
+    dense[np.repeat(np.arange(n_items), n_categories),
+          rng.randint(n_components, size=n_categories.sum())] = 1
+    csr = sparse.csr_matrix(dense)
+    theta = rng.gamma(1., 1., size=(n_components, n_users)).astype(np.float32)
+
+    print '{} ratings, {} components, {:.1f} categories per item, ' \
+        '{} threads'.format(args.size, n_components,
+                            csr.nnz / float(n_items), kernels.get_num_threads())
+    for backend in kernels.available_backends():
+        kernels.set_backend(backend)
+        for name, func in [
+                ('inner', lambda beta: kernels.inner(beta, theta, rows, cols)),
+                ('ratio_dot_users',
+                 lambda beta: kernels.ratio_dot_users(
+                     X_data, beta, theta, rows, cols, pattern=pattern))]:
+            dense_time = best_time(lambda: func(dense), args.repeat)
+            sparse_time = best_time(lambda: func(csr), args.repeat)
+            print '{:>10} {:>16}: dense {:.4f} sec, csr {:.4f} sec, ' \
+                '{:.2f}x'.format(backend, name, dense_time, sparse_time,
+                                 dense_time / sparse_time)
+
+
+def bench_masked(args):
+    '''
+    The in-category item update as the full ratio_dot_items, keeping only the
+    entries in each paper's categories, against ratio_dot_items_masked, which
+    accumulates only those entries
+    '''
+    rng = np.random.RandomState(args.seed)
+    n_items, n_users, n_components = 20000, 50000, 166
+    rows = rng.randint(n_items, size=args.size).astype(np.int32)
+    cols = rng.randint(n_users, size=args.size).astype(np.int32)
+    X_data = np.ones(args.size, dtype=np.float32)
+    pattern = kernels.SparsityPattern(rows, cols, (n_items, n_users))
+    mask = sparse.csr_matrix(
+        (np.ones(n_items * 4), (np.repeat(np.arange(n_items), 4),
+                                rng.randint(n_components, size=n_items * 4))),
+        shape=(n_items, n_components))
+    mask_rows = np.repeat(np.arange(n_items), np.diff(mask.indptr))
+    beta = rng.gamma(1., 1., size=(n_items, n_components)).astype(np.float32)
+    theta = rng.gamma(1., 1., size=(n_components, n_users)).astype(np.float32)
+    full = np.empty((n_items, n_components), dtype=np.float32)
+    masked = np.empty(mask.nnz, dtype=np.float32)
+
+    print '{} ratings, {} components, {:.1f} active components per item, ' \
+        '{} threads'.format(args.size, n_components,
+                            mask.nnz / float(n_items), kernels.get_num_threads())
+    for backend in kernels.available_backends():
+        kernels.set_backend(backend)
+        full_time = best_time(lambda: kernels.ratio_dot_items(
+            X_data, beta, theta, rows, cols, pattern=pattern,
+            out=full)[mask_rows, mask.indices], args.repeat)
+        masked_time = best_time(lambda: kernels.ratio_dot_items_masked(
+            X_data, beta, theta, rows, cols, mask.indptr, mask.indices,
+            pattern=pattern, out=masked), args.repeat)
+        print '{:>10}: full {:.4f} sec, masked {:.4f} sec, {:.2f}x'.format(
+            backend, full_time, masked_time, full_time / masked_time)
+
+
+class CountingSchedule(variational.EvalSchedule):
+    '''
+    Scores every iteration, counting them and the scores (squarem scores
+    its extrapolated iterates too), and recording each iteration's score
+    and the best
+    '''
+    iterations = 0
+    scores = 0
+    best = (-np.inf, 0)
+
+    def __init__(self, *args, **kwargs):
+        super(CountingSchedule, self).__init__(*args, **kwargs)
+        self.history = []
+        self._due = False
+
+    def due(self, iteration):
+        # over all stages of a staged item_fit_type
+        self.iterations += 1
+        self._due = super(CountingSchedule, self).due(iteration)
+        return self._due
+
+    def score(self, model, X_new, rows_new, cols_new):
+        score = super(CountingSchedule, self).score(model, X_new, rows_new,
+                                                    cols_new)
+        self.scores += 1
+        if self._due:
+            self._due = False
+            self.history.append(score)
+            self.best = max(self.best, (score, self.iterations))
+        return score
+
+
+def bench_init(args):
+    '''
+    Iterations of batch pmf until the validation log-likelihood improves by
+    less than --tol (after --min_iter), from each init strategy: of the model without
+    categories from random, subsample and svd starting values, and of the
+    categorywise model (in-category components first) from random and
+    categories ones. On the arxiv dataset in --data_dir, else on synthetic
+    clicks
+    '''
+    data = _dataset(args)
+    X, rows, cols = data['train']
+    validation, vad_rows, vad_cols = data['validation']
+    vad = dict(X_new=validation.data, rows_new=vad_rows, cols_new=vad_cols)
+    categories = data['observed_categories']
+    n_components = categories.shape[1]
+
+    print '{} items, {} users, {} ratings, {} components, tol {} after ' \
+        '{} iterations'.format(X.shape[0], X.shape[1], X.nnz, n_components,
+                               args.tol, args.min_iter)
+    for model, init, fit_kwargs in [
+            ('pmf', 'random', dict()),
+            ('pmf', 'subsample', dict()),
+            ('pmf', 'svd', dict()),
+            ('categorywise', 'random', dict(beta=categories)),
+            ('categorywise', 'categories', dict(beta=categories))]:
+        if 'beta' in fit_kwargs:
+            fit_kwargs.update(categorywise=True,
+                              item_fit_type='converge_in_category_first')
+        schedule = CountingSchedule()
+        coder = pmf.PoissonMF(n_components=n_components, max_iter=1000,
+                              min_iter=args.min_iter, tol=args.tol,
+                              random_state=args.seed,
+                              eval_schedule=schedule, init=init)
+        start = time.time()
+        coder.fit(X, rows, cols, vad, **fit_kwargs)
+        print '{:>12} {:>10}: {:4d} iterations, {:8.1f} sec, best ' \
+            'validation ll {:.5f} after {} iterations'.format(
+                model, init, schedule.iterations, time.time() - start,
+                *schedule.best)
+
+
+def bench_squarem(args):
+    '''
+    Batch passes of pmf, hpmf and ctpf until the validation log-likelihood
+    improves by less than --tol (after --min_iter), and the validation
+    log-likelihood they end on, with and without accelerate='squarem'
+    (which also scores its extrapolated iterates), and the pass at which
+    squarem first reaches the plain fit's final score. On the arxiv
+    dataset in --data_dir, else on synthetic clicks
+    '''
+    data = _dataset(args)
+    X, rows, cols = data['train']
+    validation, vad_rows, vad_cols = data['validation']
+    vad = dict(X_new=validation.data, rows_new=vad_rows, cols_new=vad_cols)
+    n_components = data['observed_categories'].shape[1]
+
+    print '{} items, {} users, {} ratings, {} components, tol {} after ' \
+        '{} iterations'.format(X.shape[0], X.shape[1], X.nnz, n_components,
+                               args.tol, args.min_iter)
+    for name, estimator in [('pmf', pmf.PoissonMF),
+                            ('hpmf', hpmf.HPoissonMF),
+                            ('ctpf', ctpf.PoissonMF)]:
+        for accelerate in (None, 'squarem'):
+            schedule = CountingSchedule()
+            coder = estimator(n_components=n_components, max_iter=1000,
+                              min_iter=args.min_iter, tol=args.tol,
+                              random_state=args.seed,
+                              eval_schedule=schedule, accelerate=accelerate)
+            start = time.time()
+            coder.fit(X, rows, cols, vad)
+            seconds = time.time() - start
+            final = coder.pred_loglikeli(**vad)
+            if accelerate is None:
+                plain = final
+                reached = ''
+            else:
+                # one batch pass per iteration
+                passes = [n + 1 for n, score in enumerate(schedule.history)
+                          if score >= plain]
+                reached = ', plain ll reached after {} passes'.format(
+                    passes[0] if passes else 'no')
+            print '{:>5} {:>8}: {:4d} passes, {:4d} validation scores, ' \
+                '{:6.1f} sec, final validation ll {:.5f}{}'.format(
+                    name, accelerate or 'plain', schedule.iterations,
+                    schedule.scores, seconds, final, reached)
+
+
+def _dataset(args):
+    ''' The arxiv dataset in --data_dir, else synthetic clicks '''
+    if not args.data_dir:
+        return _synthetic_clicks(np.random.RandomState(args.seed),
+                                 clicks=args.clicks)
+    names = dict(train='train.tsv', validation='validation.tsv',
+                 test='test.tsv', item_info='items_arxiv_info.tsv',
+                 user_info='users.tsv')
+    files = dict((split, os.path.join(args.data_dir, name))
+                 for split, name in names.items())
+    if args.cache_dir:
+        return datacache.load(args.cache_dir, files, True)
+    return datacache.parse(files, True)
+
+
+def _synthetic_clicks(rng, n_items=3000, n_users=6000, n_categories=20,
+                      clicks=30):
+    '''
+    parse's dict for clicks of users, each interested in a few categories,
+    on papers in 1 to 4 categories, with about clicks expected clicks per
+    user
+    '''
+    n_paper_categories = rng.randint(1, 5, size=n_items)
+    categories = sparse.csr_matrix(
+        (np.ones(n_paper_categories.sum(), dtype=np.float32),
+         (np.repeat(np.arange(n_items), n_paper_categories),
+          rng.randint(n_categories, size=n_paper_categories.sum()))),
+        shape=(n_items, n_categories))
+    categories.data[:] = 1
+    preferences = rng.gamma(0.2, 1., size=(n_categories, n_users))
+    rates = categories.dot(preferences)
+    rates *= float(clicks) / rates.sum(axis=0)
+    clicks = sparse.csr_matrix(rng.poisson(rates) > 0, dtype=np.int16)
+    coo = clicks.tocoo()
+    validation = rng.rand(coo.nnz) < 0.1
+    data = dict(n_docs=n_items, n_users=n_users,
+                observed_categories=categories,
+                category_list=[str(k) for k in xrange(n_categories)])
+    for split, keep in (('train', ~validation), ('validation', validation)):
+        matrix = sparse.csr_matrix(
+            (coo.data[keep], (coo.row[keep], coo.col[keep])),
+            shape=clicks.shape)
+        split_coo = matrix.tocoo()
+        data[split] = (matrix, split_coo.row.astype(np.int32),
+                       split_coo.col.astype(np.int32))
+    return data
+
+
+BENCHMARKS = dict(digamma=bench_digamma, dual=bench_dual,
+                  categories=bench_categories, masked=bench_masked,
+                  init=bench_init, squarem=bench_squarem)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--n_threads', type=int, default=1,
+                        help='threads used by the kernels')
+    parser.add_argument('--size', type=int, default=2 * 10 ** 6,
+                        help='number of elements per benchmark array')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='report the best of this many runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data_dir',
+                        help='init, squarem: the arxiv dataset, else '
+                        'synthetic clicks')
+    parser.add_argument('--cache_dir',
+                        help='init, squarem: dataset cache, see '
+                        'datacache.load')
+    parser.add_argument('--clicks', type=int, default=30,
+                        help='init, squarem: expected clicks per synthetic '
+                        'user')
+    parser.add_argument('--tol', type=float, default=1e-4,
+                        help='init, squarem: convergence tolerance of the '
+                        'fits')
+    parser.add_argument('--min_iter', type=int, default=10,
+                        help='init, squarem: iterations before checking tol')
+    args = parser.parse_args()
+    kernels.set_num_threads(args.n_threads)
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,130 @@
+"""
+
+Mid-fit checkpoints of the variational estimators (pmf, hpmf, ctpf), so that
+an interrupted fit can resume where it stopped instead of from scratch
+
+"""
+import logging
+import os
+import h5py
+import numpy as np
+from scipy import sparse
+
+import variational
+
+
+class Checkpoint(object):
+    '''
+    The full variational state of a fit, written to an h5 file every few
+    iterations: the estimator attributes named in its _checkpoint_names
+    (gamma/rho and expectations of every factor, plus flags that change
+    during the fit), its stack of stage positions (stage, iteration, last
+    scores, best-iterate snapshots) and numpy's global random state.
+
+    Each checkpoint is written to a temporary file that then replaces the
+    previous one, so an interruption while writing leaves the last complete
+    checkpoint in place.
+
+    path : str
+        The checkpoint file
+    every : int
+        Write a checkpoint every this many iterations of a stage, 0 for never
+    resume : bool
+        Whether load returns the state in an existing checkpoint file, rather
+        than letting the fit start over and overwrite it
+    '''
+    def __init__(self, path, every=1, resume=False):
+        self.path = path
+        self.every = every
+        self.resume = resume
+        self.logger = logging.getLogger(__name__)
+
+    def due(self, iteration):
+        return self.every > 0 and iteration % self.every == 0
+
+    def save(self, model, frames):
+        '''
+        Write model's state and its stage positions, frames being a list of
+        dicts from the outermost stage (fit) in, whose values are scalars,
+        strings, arrays, dicts of those or variational.Snapshots
+        '''
+        tmp_path = self.path + '.tmp'
+        with h5py.File(tmp_path, 'w') as h5f:
+            _write(h5f.create_group('model'), dict(
+                (name, getattr(model, name, None))
+                for name in model._checkpoint_names))
+            for depth, frame in enumerate(frames):
+                _write(h5f.create_group('frames/{}'.format(depth)), frame)
+            kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+            h5f.create_dataset('random_state', data=keys)
+            h5f['random_state'].attrs.update(dict(
+                kind=kind, pos=pos, has_gauss=has_gauss,
+                cached_gaussian=cached_gaussian))
+        os.rename(tmp_path, self.path)
+        self.logger.info('wrote checkpoint {} at {}'.format(
+            self.path, ', '.join('{}={}'.format(key, frames[-1][key])
+                                 for key in sorted(frames[-1])
+                                 if np.isscalar(frames[-1][key]))))
+
+    def load(self, model):
+        '''
+        Set model's state from the checkpoint and return its stage
+        positions, or [] when there is nothing to resume from
+        '''
+        if not self.resume or not os.path.exists(self.path):
+            return []
+        with h5py.File(self.path, 'r') as h5f:
+            for name, value in _read(h5f['model']).items():
+                setattr(model, name, value)
+            frames = [_read(h5f['frames/{}'.format(depth)])
+                      for depth in xrange(len(h5f.get('frames', ())))]
+            attrs = h5f['random_state'].attrs
+            np.random.set_state((str(attrs['kind']), h5f['random_state'][:],
+                                 int(attrs['pos']), int(attrs['has_gauss']),
+                                 float(attrs['cached_gaussian'])))
+        self.logger.info('resuming from checkpoint {}'.format(self.path))
+        return frames
+
+
+def _write(group, values):
+    none = []
+    for key, value in values.items():
+        if isinstance(value, (variational.Snapshot, variational.Squarem)):
+            value = value.dump()
+        if value is None:
+            none.append(key)
+        elif isinstance(value, dict):
+            _write(group.create_group(key), value)
+        elif sparse.issparse(value):
+            # e.g. a sparse observed Eb, as its CSR arrays
+            value = sparse.csr_matrix(value)
+            csr = group.create_group(key)
+            for name in ('data', 'indices', 'indptr'):
+                csr.create_dataset(name, data=getattr(value, name))
+            csr.attrs['csr_shape'] = value.shape
+        elif isinstance(value, np.ndarray):
+            group.create_dataset(key, data=value)
+        else:
+            group.attrs[key] = value
+    group.attrs['none'] = np.array(none, dtype='S')
+
+
+def _read(group):
+    values = dict((key, None) for key in group.attrs['none'])
+    for key, value in group.attrs.items():
+        if key == 'none':
+            continue
+        if isinstance(value, np.generic):
+            # back to python scalars, e.g. the estimators' boolean flags
+            value = value.item()
+        values[key] = value
+    for key, value in group.items():
+        if isinstance(value, h5py.Group) and 'csr_shape' in value.attrs:
+            values[key] = sparse.csr_matrix(
+                (value['data'][()], value['indices'][()],
+                 value['indptr'][()]), shape=tuple(value.attrs['csr_shape']))
+        elif isinstance(value, h5py.Group):
+            values[key] = _read(value)
+        else:
+            values[key] = value[()]
+    return values
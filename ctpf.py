@@ -10,15 +10,26 @@ MODIFIED: 2015-03-25 13:06:12 by Jaan Altosaar <altosaar@princeton.edu>
 
 import sys
 import numpy as np
-from scipy import sparse, special, weave
 import pandas as pd
+from scipy import sparse
 from sklearn.base import BaseEstimator, TransformerMixin
 import logging
+import kernels
+import variational
 
 class PoissonMF(BaseEstimator, TransformerMixin):
     ''' Poisson matrix factorization with batch inference '''
+    # the variational state written to a checkpoint
+    _checkpoint_names = ('gamma_bs', 'rho_bs', 'Eb', 'Elogb',
+                         'gamma_t', 'rho_t', 'Et', 'Elogt',
+                         'gamma_eps', 'rho_eps', 'Eeps', 'Elogeps',
+                         'observed_user_preferences',
+                         'observed_item_corrections')
+
     def __init__(self, n_components=100, max_iter=100, min_iter=1, tol=0.0001,
                  smoothness=100, random_state=None, verbose=False,
+                 dtype=np.float32, eval_schedule=None, snapshot_memory=None,
+                 checkpoint=None,
                  beta=False, theta=False,
                  categorywise=False,
                  item_fit_type='all_categories',
@@ -26,6 +37,7 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                  observed_item_attributes=False,
                  observed_user_preferences=False,
                  zero_untrained_components=False,
+                 accelerate=None,
                  **kwargs):
 
         self.n_components = n_components
@@ -35,6 +47,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.smoothness = smoothness
         self.random_state = random_state
         self.verbose = verbose
+        self.dtype = dtype
+        if eval_schedule is None:
+            eval_schedule = variational.EvalSchedule()
+        self.eval_schedule = eval_schedule
+        self.snapshot_memory = snapshot_memory
+        self.checkpoint = checkpoint
+        self.accelerate = accelerate
         self.max_iter_fixed = 4
         self.observed_user_preferences = observed_user_preferences
         self.observed_item_attributes = observed_item_attributes
@@ -45,11 +64,11 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.observed_item_corrections = False
 
         if observed_user_preferences:
-            self.Et = theta
+            self.Et = np.asarray(theta, dtype=self.dtype)
         if observed_item_attributes:
-            self.Eb = beta
+            self.Eb = variational.observed_factor(beta, self.dtype)
         if categorywise:
-            if not type(beta) == np.ndarray:
+            if not variational.observed(beta):
                 raise Exception('need observed categories for categorywise')
 
         if type(self.random_state) is int:
@@ -59,6 +78,9 @@ class PoissonMF(BaseEstimator, TransformerMixin):
 
         self._parse_args(**kwargs)
         self.logger = logging.getLogger(__name__)
+        self.exp_cache = variational.ExpCache(self)
+        self.workspace = variational.Workspace(dtype)
+        self.ratings_cache = variational.RatingsCache()
 
 
     def _parse_args(self, **kwargs):
@@ -92,12 +114,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_t = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(self.n_components, n_users)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_t = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(self.n_components, n_users)
-                                ).astype(np.float32)
-            self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+                                ).astype(self.dtype)
+            self.Et, self.Elogt = _compute_expectations(
+                self.gamma_t, self.rho_t, self.dtype)
 
     def _init_items(self, n_items):
         # if we pass in observed betas:
@@ -112,12 +135,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_bs = 0.01 * self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_bs = 0.01 * self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
-            self.Eb, self.Elogb = _compute_expectations(self.gamma_bs, self.rho_bs)
+                                ).astype(self.dtype)
+            self.Eb, self.Elogb = _compute_expectations(
+                self.gamma_bs, self.rho_bs, self.dtype)
 
     def _init_item_corrections(self, n_items):
         self.logger.info('initializing item_corrections normally from gamma')
@@ -125,12 +149,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.gamma_eps = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
                             size=(n_items, self.n_components)
-                            ).astype(np.float32)
+                            ).astype(self.dtype)
         self.rho_eps = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
                             size=(n_items, self.n_components)
-                            ).astype(np.float32)
-        self.Eeps, self.Elogeps = _compute_expectations(self.gamma_eps, self.rho_eps)
+                            ).astype(self.dtype)
+        self.Eeps, self.Elogeps = _compute_expectations(
+            self.gamma_eps, self.rho_eps, self.dtype)
 
     def fit(self, X, rows, cols, vad):
         '''Fit the model to the data in X.
@@ -145,14 +170,29 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self: object
             Returns the instance itself.
         '''
+        variational.check_accelerate(self.accelerate)
         n_items, n_users = X.shape
+        self._pattern = kernels.SparsityPattern(rows, cols, X.shape)
         self.n_users = n_users
         self._init_items(n_items)
         self._init_users(n_users)
         self._init_item_corrections(n_items)
+        self._categories = None
+        if self.categorywise:
+            self._categories = variational.CategoryMask(self.Eb)
+        resume = []
+        if self.checkpoint is not None:
+            resume = self.checkpoint.load(self)
         if self.user_fit_type == 'converge_separately':
-            best_validation_ll = -np.inf
-            for switch_idx in xrange(self.max_iter_fixed):
+            best = variational.Snapshot(['Eeps', 'Eb', 'Et'],
+                                        max_memory=self.snapshot_memory)
+            first_switch = 0
+            if resume:
+                first_switch = resume[0]['switch_idx']
+                # users stages keep the previous items stage's categories
+                update_categories = resume[0]['update_categories']
+                best.load(resume[0]['best'])
+            for switch_idx in xrange(first_switch, self.max_iter_fixed):
                 if switch_idx % 2 == 0:
                     update_users_or_corrections = 'items'
                     if switch_idx % 4 == 0:
@@ -168,170 +208,327 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                     initialize_users = 'none'
                 self.logger.info('=> only updating {}, switch number {}'
                     .format(update_users_or_corrections, switch_idx))
-                validation_ll, best_pll_dict = self._update(
+                self._frames = [dict(switch_idx=switch_idx,
+                                     update_categories=update_categories,
+                                     best=best)]
+                validation_ll, stage_best = self._update(
                     X, rows, cols, vad,
                     initialize_users=initialize_users,
                     update_users_or_corrections=update_users_or_corrections,
-                    update_categories=update_categories)
-                new_validation_ll = best_pll_dict['pred_ll']
+                    update_categories=update_categories,
+                    resume=resume[1:])
+                resume = []
                 self.logger.info('set params to best pll {}, old one was {}'
-                    .format(new_validation_ll, validation_ll))
-                validation_ll = new_validation_ll
-                self.Eeps = best_pll_dict['best_Eeps']
-                self.Eb = best_pll_dict['best_Eb']
-                self.Et = best_pll_dict['best_Et']
-                self.Elogeps = best_pll_dict['best_Elogeps']
-                self.Elogb = best_pll_dict['best_Elogb']
-                self.Elogt = best_pll_dict['best_Elogt']
-                if validation_ll > best_validation_ll:
-                    best_Eeps = self.Eeps
-                    best_Eb = self.Eb
-                    best_Et = self.Et
-                    best_validation_ll = validation_ll
+                    .format(stage_best.score, validation_ll))
+                stage_best.restore(self)
+                best.offer(self, stage_best.score)
                 self.logger.info('best validation ll was {}'.format(
-                    best_validation_ll))
-                self.Eeps = best_Eeps
-                self.Eb = best_Eb
-                self.Et = best_Et
+                    best.score))
+                best.restore(self)
         else:
-            self._update(X, rows, cols, vad)
+            self._frames = [dict()]
+            self._update(X, rows, cols, vad, resume=resume[1:])
+        self.exp_cache.log_stats()
+        self.workspace.log_stats()
         return self
 
+    def transform(self, X):
+        '''Encode unseen users by their preferences, see fold_in_users.
+
+        Parameters
+        ----------
+        X : sparse matrix, shape (n_songs, n_users)
+            Ratings of the users, over the songs the model was fit on.
+
+        Returns
+        -------
+        X_new : array-like, shape (n_users, n_components)
+            E[theta] of the users.
+        '''
+        return self.fold_in_users(X).T
+
+    def fold_in_users(self, X, max_iter=100, tol=1e-4, batch_size=None):
+        '''
+        E[theta] (n_components x n_users, like Et) of users unseen in fit
+        with ratings X (sparse, n_songs x n_users), from user-only updates
+        against the frozen item factors, beta and the corrections epsilon.
+        The fitted model is not modified. Users are updated together,
+        batch_size at a time, until the mean relative change of E[theta]
+        drops below tol.
+        '''
+        return variational.fold_in_users(self, X, max_iter=max_iter, tol=tol,
+                                         batch_size=batch_size)
+
+    def _fold_in(self, X_data, rows, cols, n_users, max_iter, tol):
+        pattern = kernels.SparsityPattern(rows, cols,
+                                          (self.Eb.shape[0], n_users))
+        if self.observed_item_attributes:
+            beta_b = self.Eb
+        else:
+            beta_b = self.exp_cache.get('Elogb')
+        if self.observed_item_corrections:
+            beta_eps = self.Eeps
+        else:
+            beta_eps = self.exp_cache.get('Elogeps')
+        rho_t = self.b + np.sum(self.Eeps, axis=0, keepdims=True).T + \
+            variational.factor_sums(self.Eb)
+        # start every user from the prior shape
+        Et, Elogt = _compute_expectations(
+            np.full((self.n_components, n_users), self.a, dtype=self.dtype),
+            rho_t, self.dtype)
+        for _ in xrange(max_iter):
+            expElogt = np.exp(Elogt)
+            gamma_t, ratio_dot_eps = kernels.ratio_dot_users2(X_data, beta_b,
+                beta_eps, expElogt, rows, cols, pattern=pattern)
+            gamma_t += ratio_dot_eps
+            gamma_t *= expElogt
+            gamma_t += self.a
+            Et_old = Et
+            Et, Elogt = _compute_expectations(gamma_t, rho_t, self.dtype)
+            if variational.converged(Et, Et_old, tol):
+                break
+        return Et
+
+    def fold_in_items(self, categories=None, X=None, max_iter=100, tol=1e-4):
+        '''
+        Append items (documents) unseen in fit, e.g. new papers that have
+        categories but no clicks yet, and return their row indices. Their
+        corrections epsilon (and beta_s, unless the item attributes are
+        observed) start from the prior given the frozen user preferences,
+        and are updated on the new items' ratings X (sparse,
+        n_new_items x n_users) if there are any. Existing rows are not
+        changed.
+
+        categories : array, shape (n_new_items, n_components)
+            Observed attributes of the new items, needed when the model's
+            item attributes are observed
+        '''
+        n_items, n_users = self.Eeps.shape[0], self.Et.shape[1]
+        if self.observed_item_attributes:
+            if categories is None:
+                raise ValueError('the item attributes are observed, so new '
+                                 'items need their categories')
+            Eb = variational.observed_factor(categories, self.dtype)
+            n_new = Eb.shape[0]
+        elif X is None:
+            raise ValueError('beta is fit, so new items need ratings')
+        else:
+            n_new = X.shape[0]
+        if X is None:
+            X = sparse.coo_matrix((n_new, n_users), dtype=self.dtype)
+        X = sparse.coo_matrix(X)
+        if X.shape != (n_new, n_users):
+            raise ValueError('X must have shape {}, got {}'.format(
+                (n_new, n_users), X.shape))
+        X_data = X.data.astype(self.dtype)
+        rows, cols = X.row.astype(np.int32), X.col.astype(np.int32)
+        pattern = kernels.SparsityPattern(rows, cols, X.shape)
+        if self.observed_user_preferences:
+            theta = self.Et
+        else:
+            theta = self.exp_cache.get('Elogt')
+
+        # start from the prior shapes, i.e. the update without ratings
+        shape = (n_new, self.n_components)
+        Et_sum = np.sum(self.Et, axis=1)
+        gamma_eps = np.full(shape, self.c, dtype=self.dtype)
+        rho_eps = np.broadcast_to(self.d + Et_sum, shape)
+        Eeps, Elogeps = _compute_expectations(gamma_eps, rho_eps, self.dtype)
+        if not self.observed_item_attributes:
+            gamma_bs = np.full(shape, self.f, dtype=self.dtype)
+            rho_bs = np.broadcast_to(self.g + Et_sum, shape)
+            Eb, Elogb = _compute_expectations(gamma_bs, rho_bs, self.dtype)
+        # the new items' rows only, for the convergence check
+        Eb_new = variational.to_dense(Eb)
+        for _ in xrange(max_iter if X.nnz else 0):
+            E_old = Eb_new + Eeps
+            expElogeps = np.exp(Elogeps)
+            gamma_eps = kernels.ratio_dot_items(X_data, expElogeps, theta,
+                rows, cols, pattern=pattern)
+            gamma_eps *= expElogeps
+            gamma_eps += self.c
+            Eeps, Elogeps = _compute_expectations(gamma_eps, rho_eps,
+                                                  self.dtype)
+            if not self.observed_item_attributes:
+                expElogb = np.exp(Elogb)
+                gamma_bs = kernels.ratio_dot_items(X_data, expElogb, theta,
+                    rows, cols, pattern=pattern)
+                gamma_bs *= expElogb
+                gamma_bs += self.f
+                Eb, Elogb = _compute_expectations(gamma_bs, rho_bs,
+                                                  self.dtype)
+                Eb_new = Eb
+            if variational.converged(Eb_new + Eeps, E_old, tol):
+                break
+
+        self.gamma_eps = _append_rows(self.gamma_eps, gamma_eps, n_items)
+        self.rho_eps = _append_rows(self.rho_eps, rho_eps, n_items)
+        self.Eeps = _append_rows(self.Eeps, Eeps, n_items)
+        self.Elogeps = _append_rows(self.Elogeps, Elogeps, n_items)
+        self.Eb = _append_rows(self.Eb, Eb, n_items)
+        if not self.observed_item_attributes:
+            self.gamma_bs = _append_rows(self.gamma_bs, gamma_bs, n_items)
+            self.rho_bs = _append_rows(self.rho_bs, rho_bs, n_items)
+            self.Elogb = _append_rows(self.Elogb, Elogb, n_items)
+        return np.arange(n_items, n_items + n_new)
+
     def _update(self, X, rows, cols, vad,
         initialize_users='none',
         update_users_or_corrections='both',
-        update_categories='all_categories'):
+        update_categories='all_categories',
+        resume=()):
         # alternating between update latent components and weights
-        old_pll = -np.inf
-        best_pll_dict = dict(pred_ll = -np.inf)
+        old_pll = pred_ll = -np.inf
+        best = variational.Snapshot(
+            ['Eeps', 'Elogeps', 'Eb', 'Elogb', 'Et', 'Elogt'],
+            max_memory=self.snapshot_memory)
+        # this stage's position, as written to a checkpoint
+        frame = dict(update_categories=update_categories, best=best,
+                     initial=dict())
+        squarem = None
+        if self.accelerate == 'squarem':
+            squarem = variational.Squarem(
+                ['bs', 'eps'],
+                lambda model: self.eval_schedule.score(model, **vad),
+                expectations=dict(bs='b'))
+            frame['squarem'] = squarem
+        start, converged = 0, False
+        if resume:
+            state, resume = resume[0], resume[1:]
+            start, old_pll, pred_ll = (state['iteration'], state['old_pll'],
+                                       state['pred_ll'])
+            best.load(state['best'])
+            frame['initial'] = state['initial']
+            if squarem is not None:
+                squarem.load(state['squarem'])
+            # more frames mean the checkpoint was written in the stage this
+            # one converged into
+            converged = bool(resume)
+        self._frames.append(frame)
 
         # user update logic
-        for i in xrange(self.max_iter):
-            if (update_users_or_corrections == 'items' or
-                (self.observed_user_preferences and self.user_fit_type == 'default')):
-                pass
-            elif (update_users_or_corrections == 'users'):
-                if initialize_users == 'initialize' and i == 0:
-                    #self.observed_user_preferences = False
-                    #self._init_users(self.n_users)
-                    self.logger.info('switching from obs user prefs: {}'.format(self.observed_user_preferences))
-                    self._update_users(X, rows, cols, switch_from_observed_user_preferences=True)
-                    self.logger.info('switched from obs user prefs, now it is: {}'.format(self.observed_user_preferences))
+        for i in xrange(start, self.max_iter):
+            if converged:
+                break
+            if (i > start and self.checkpoint is not None and
+                    self.checkpoint.due(i)):
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll)
+                self.checkpoint.save(self, self._frames)
+            for _ in variational.steps(squarem, self):
+                if (update_users_or_corrections == 'items' or
+                    (self.observed_user_preferences and self.user_fit_type == 'default')):
+                    pass
+                elif (update_users_or_corrections == 'users'):
+                    if initialize_users == 'initialize' and i == 0:
+                        #self.observed_user_preferences = False
+                        #self._init_users(self.n_users)
+                        self.logger.info('switching from obs user prefs: {}'.format(self.observed_user_preferences))
+                        self._update_users(X, rows, cols, switch_from_observed_user_preferences=True)
+                        self.logger.info('switched from obs user prefs, now it is: {}'.format(self.observed_user_preferences))
+                    else:
+                        self._update_users(X, rows, cols)
                 else:
-                    self._update_users(X, rows, cols)
-            else:
-                self.logger.info('BEFORE updating users')
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-
-            # item update logic
-            if self.observed_item_attributes:
-                pass
-            else:
-                self._update_items(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-
-            # zero out in-category or out_category item_corrections
-            if self.item_fit_type == 'converge_in_category_first' or self.item_fit_type == 'converge_out_category_first':
-                if self.zero_untrained_components and i == 0 and update_categories == 'all_categories':
-                    # store the initial values somewhere, then zero them out,
-                    # then load them back in once they've been fit
-                    beta_bool = self.Eb.astype(bool)
-                    beta_bool_not = np.logical_not(beta_bool)
-                    small_num = 1e-5
-                    if self.item_fit_type == 'converge_in_category_first':
-                        # zero out out_category components
-                        gamma_eps_out_category = self.gamma_eps[beta_bool_not]
-                        rho_eps_out_category = self.rho_eps[beta_bool_not]
-                        self.gamma_eps[beta_bool_not] = small_num
-                        self.rho_eps[beta_bool_not] = small_num
-                    elif self.item_fit_type == 'converge_out_category_first':
-                        # zero out in_category components
-                        gamma_eps_in_category = self.gamma_eps[beta_bool]
-                        rho_eps_in_category = self.rho_eps[beta_bool]
-                        self.gamma_eps[beta_bool] = small_num
-                        self.rho_eps[beta_bool] = small_num
-
-            # item correction (artist) update logic
-            if update_users_or_corrections == 'items':
-                # if (self.categorywise and
-                #     self.item_fit_type == 'converge_in_category_first' and
-                #     update_categories == 'all_categories'):
-                #         self._update_item_corrections(X, rows, cols, update_categories='in_category')
-                # elif (self.categorywise and
-                #     self.item_fit_type == 'converge_out_category_first' and
-                #     update_categories == 'all_categories'):
-                #         self._update_item_corrections(X,rows,cols, update_categories='out_category')
-                # else:
-                self._update_item_corrections(X,rows,cols, update_categories=update_categories)
-            elif update_users_or_corrections == 'both':
-                self._update_item_corrections(X,rows,cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-
-            pred_ll = self.pred_loglikeli(**vad)
-            # train_ll = self.pred_loglikeli(X.data, rows, cols)
-            # self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-            #         .format(train_ll))
+                    for _ in xrange(5):
+                        self._update_users(X, rows, cols)
+
+                # item update logic
+                if self.observed_item_attributes:
+                    pass
+                else:
+                    self._update_items(X, rows, cols)
+
+                # zero out in-category or out_category item_corrections
+                if self.item_fit_type == 'converge_in_category_first' or self.item_fit_type == 'converge_out_category_first':
+                    if self.zero_untrained_components and i == 0 and update_categories == 'all_categories':
+                        # store the initial values somewhere, then zero them out,
+                        # then load them back in once they've been fit
+                        categories = self._categories
+                        small_num = 1e-5
+                        if self.item_fit_type == 'converge_in_category_first':
+                            # zero out out_category components
+                            frame['initial'] = dict(
+                                gamma_eps=categories.take(self.gamma_eps, False),
+                                rho_eps=categories.take(self.rho_eps, False))
+                            categories.put(self.gamma_eps, small_num, False)
+                            categories.put(self.rho_eps, small_num, False)
+                            # their expectations are recomputed by the first in-category update
+                            categories.stale = True
+                        elif self.item_fit_type == 'converge_out_category_first':
+                            # zero out in_category components
+                            frame['initial'] = dict(
+                                gamma_eps=categories.take(self.gamma_eps),
+                                rho_eps=categories.take(self.rho_eps))
+                            categories.put(self.gamma_eps, small_num)
+                            categories.put(self.rho_eps, small_num)
+
+                # item correction (artist) update logic
+                if update_users_or_corrections == 'items':
+                    # if (self.categorywise and
+                    #     self.item_fit_type == 'converge_in_category_first' and
+                    #     update_categories == 'all_categories'):
+                    #         self._update_item_corrections(X, rows, cols, update_categories='in_category')
+                    # elif (self.categorywise and
+                    #     self.item_fit_type == 'converge_out_category_first' and
+                    #     update_categories == 'all_categories'):
+                    #         self._update_item_corrections(X,rows,cols, update_categories='out_category')
+                    # else:
+                    self._update_item_corrections(X,rows,cols, update_categories=update_categories)
+                elif update_users_or_corrections == 'both':
+                    self._update_item_corrections(X,rows,cols)
+            self.eval_schedule.log_train(self, X, rows, cols, i)
+            if not self.eval_schedule.due(i):
+                continue
+            pred_ll = self.eval_schedule.score(self, **vad)
             if np.isnan(pred_ll):
                 self.logger.error('got nan in predictive ll')
                 raise Exception('nan in predictive ll')
             else:
-                if pred_ll > best_pll_dict['pred_ll']:
-                    best_pll_dict['pred_ll'] = pred_ll
+                if best.offer(self, pred_ll):
                     self.logger.info('logged new best pred_ll as {}'
                         .format(pred_ll))
-                    best_pll_dict['best_Eeps'] = self.Eeps
-                    best_pll_dict['best_Elogeps'] = self.Elogeps
-                    best_pll_dict['best_Eb'] = self.Eb
-                    best_pll_dict['best_Elogb'] = self.Elogb
-                    best_pll_dict['best_Et'] = self.Et
-                    best_pll_dict['best_Elogt'] = self.Elogt
-            improvement = (pred_ll - old_pll) / abs(old_pll)
+            if squarem is None:
+                improvement = (pred_ll - old_pll) / abs(old_pll)
+            else:
+                # the jumps may lower the score on the way to a higher one
+                improvement = squarem.improvement(pred_ll)
             if self.verbose:
                 string = 'ITERATION: %d\tPred_ll: %.2f\tOld Pred_ll: %.2f\tImprovement: %.5f' % (i, pred_ll, old_pll, improvement)
                 self.logger.info(string)
             if improvement < self.tol and i >= self.min_iter:
-                # if we're converging in category or out category components, need to re-load the initial values!
-                if update_categories == 'all_categories' and self.item_fit_type != 'default':
-                    if self.item_fit_type == 'converge_in_category_first':
-                        # we converged in-category. now converge out_category
-                        if self.zero_untrained_components:
-                            self.logger.info('re-load initial values for out_category')
-                            self.gamma_eps[beta_bool_not] = gamma_eps_out_category
-                            self.rho_eps[beta_bool_not] = rho_eps_out_category
-                        self._update(X, rows, cols, vad, update_categories='out_category')
-                    if self.item_fit_type == 'converge_out_category_first':
-                        # we converged out-category. now converge in_category
-                        if zero_untrained_components:
-                            self.logger.info('re-load initial values for in_category')
-                            self.gamma_eps[beta_bool] = gamma_eps_in_category
-                            self.rho_eps[beta_bool] = rho_eps_in_category
-                        self._update(X, rows, cols, vad, update_categories='in_category')
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll)
+                converged = True
                 break
             old_pll = pred_ll
-        #pass
-        return pred_ll, best_pll_dict
+        # if we're converging in category or out category components, need to re-load the initial values!
+        if (converged and update_categories == 'all_categories' and
+                self.item_fit_type != 'default'):
+            # the zeroed-out initial values are re-loaded (once, a resumed
+            # sub-stage has them already)
+            initial, frame['initial'] = frame['initial'], dict()
+            categories = self._categories
+            if self.item_fit_type == 'converge_in_category_first':
+                # we converged in-category. now converge out_category
+                if initial:
+                    self.logger.info('re-load initial values for out_category')
+                    categories.put(self.gamma_eps, initial['gamma_eps'], False)
+                    categories.put(self.rho_eps, initial['rho_eps'], False)
+                self._update(X, rows, cols, vad, update_categories='out_category',
+                             resume=resume)
+            if self.item_fit_type == 'converge_out_category_first':
+                # we converged out-category. now converge in_category
+                if initial:
+                    self.logger.info('re-load initial values for in_category')
+                    categories.put(self.gamma_eps, initial['gamma_eps'])
+                    categories.put(self.rho_eps, initial['rho_eps'])
+                self._update(X, rows, cols, vad, update_categories='in_category',
+                             resume=resume)
+        if not best.saved:
+            # nothing was scored (evaluation off), the last iterate stands in
+            best.save(self, pred_ll)
+        if squarem is not None:
+            squarem.log_stats()
+        self._frames.pop()
+        return pred_ll, best
 
     def _update_users(self, X, rows, cols, switch_from_observed_user_preferences=False):
         self.logger.info('updating users')
@@ -339,26 +536,37 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         if self.observed_item_attributes:
             expElogb = self.Eb
         else:
-            expElogb = np.exp(self.Elogb)
+            expElogb = self.exp_cache.get('Elogb')
 
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
+            expElogt = self.exp_cache.get('Elogt')
 
         if self.observed_item_corrections:
             expElogeps = self.Eeps
         else:
-            expElogeps = np.exp(self.Elogeps)
-
-        ratioTb = sparse.csr_matrix((X.data / self._xexplog_b(rows, cols), (rows, cols)),
-            dtype=np.float32, shape=X.shape).transpose()
-        ratioTeps = sparse.csr_matrix((X.data / self._xexplog_eps(rows, cols), (rows, cols)),
-            dtype=np.float32, shape=X.shape).transpose()
-        self.gamma_t = self.a + expElogt * ratioTb.dot(expElogb).T + expElogt * ratioTeps.dot(expElogeps).T
-        self.rho_t = self.b + np.sum(self.Eeps, axis=0, keepdims=True).T + np.sum(self.Eb, axis=0, keepdims=True).T
-
-        self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+            expElogeps = self.exp_cache.get('Elogeps')
+
+        # both item terms share the user factor, so one sweep serves both
+        beta_b, theta = self._xexplog_b_factors()
+        beta_eps, _ = self._xexplog_eps_factors()
+        shape = (self.n_components, X.shape[1])
+        self.gamma_t = self.workspace.get('gamma_t', shape)
+        ratio_dot_eps = self.workspace.get('ratio_dot_eps', shape)
+        kernels.ratio_dot_users2(X.data, beta_b, beta_eps, theta, rows, cols,
+            beta_acc1=expElogb, beta_acc2=expElogeps, pattern=self._pattern,
+            out1=self.gamma_t, out2=ratio_dot_eps)
+        self.gamma_t *= expElogt
+        self.gamma_t += self.a
+        ratio_dot_eps *= expElogt
+        self.gamma_t += ratio_dot_eps
+        self.rho_t = self.b + np.sum(self.Eeps, axis=0, keepdims=True).T + variational.factor_sums(self.Eb)
+
+        self.Et, self.Elogt = _compute_expectations(
+            self.gamma_t, self.rho_t, self.dtype,
+            out=self.workspace.expectations('t', shape))
+        self.exp_cache.invalidate('Elogt')
 
         # switch off after updating once using fixed user preferences!
         if switch_from_observed_user_preferences:
@@ -371,108 +579,148 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
-
-        ratio = sparse.csr_matrix((X.data / self._xexplog_b(rows, cols), (rows, cols)), dtype=np.float32, shape=X.shape)
-        self.gamma_bs = self.f + np.exp(self.Elogb) * ratio.dot(expElogt.T)
+            expElogt = self.exp_cache.get('Elogt')
+
+        beta_b, theta_b = self._xexplog_b_factors()
+        shape = (X.shape[0], self.n_components)
+        self.gamma_bs = self.workspace.get('gamma_bs', shape)
+        kernels.ratio_dot_items(X.data, beta_b, theta_b, rows, cols,
+                                theta_acc=expElogt, pattern=self._pattern,
+                                out=self.gamma_bs)
+        self.gamma_bs *= self.exp_cache.get('Elogb')
+        self.gamma_bs += self.f
         self.rho_bs = self.g + np.sum(self.Et, axis=1)
-        self.Eb, self.Elogb = _compute_expectations(self.gamma_bs, self.rho_bs)
+        self.Eb, self.Elogb = _compute_expectations(
+            self.gamma_bs, self.rho_bs, self.dtype,
+            out=self.workspace.expectations('b', shape))
+        self.exp_cache.invalidate('Elogb')
 
     def _update_item_corrections(self, X, rows, cols,
         update_categories='all_categories'):
 
         self.logger.info('updating epsilons / item_corrections')
 
-        ratio = sparse.csr_matrix((X.data / self._xexplog_eps(rows, cols), (rows, cols)), dtype=np.float32, shape=X.shape)
+        beta_eps, theta_eps = self._xexplog_eps_factors()
 
         if self.observed_user_preferences:
-            expElogt = self.Et.T
+            expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt.T)
-
-        gamma_eps_updated = self.c + np.exp(self.Elogeps) * ratio.dot(expElogt)
+            expElogt = self.exp_cache.get('Elogt')
+
+        shape = (X.shape[0], self.n_components)
+        categories = self._categories
+        if update_categories == 'in_category':
+            self.logger.info('updating *only* in-category parameters')
+            # computed only at the in-category entries, the rest stay frozen
+            gamma_eps_updated = self.workspace.get('gamma_eps_masked',
+                                                   categories.cols.shape)
+            kernels.ratio_dot_items_masked(
+                X.data, beta_eps, theta_eps, rows, cols, categories.indptr,
+                categories.cols, theta_acc=expElogt, pattern=self._pattern,
+                out=gamma_eps_updated)
+            gamma_eps_updated *= categories.take(
+                self.exp_cache.get('Elogeps'))
+            gamma_eps_updated += self.c
+            variational.update_in_category(
+                self, 'eps', gamma_eps_updated,
+                self.d + np.sum(self.Et, axis=1))
+            return
+
+        # the out-category update keeps the other entries of gamma_eps, so it
+        # needs a scratch buffer distinct from it
+        if update_categories == 'all_categories':
+            gamma_eps_updated = self.workspace.get('gamma_eps', shape)
+        else:
+            gamma_eps_updated = self.workspace.get('gamma_eps_updated', shape)
+        kernels.ratio_dot_items(X.data, beta_eps, theta_eps, rows, cols,
+                                theta_acc=expElogt, pattern=self._pattern,
+                                out=gamma_eps_updated)
+        gamma_eps_updated *= self.exp_cache.get('Elogeps')
+        gamma_eps_updated += self.c
         rho_eps_updated = self.d + np.sum(self.Et, axis=1)
 
-        if update_categories == 'in_category' or update_categories == 'out_category':
-
-            beta_bool = self.Eb.astype(bool)
-
-            if update_categories == 'in_category':
-                    self.logger.info('updating *only* in-category parameters')
-                    self.gamma_eps[beta_bool] = gamma_eps_updated[beta_bool]
-                    self.rho_eps[beta_bool] = rho_eps_updated[beta_bool]
-            elif update_categories == 'out_category':
-                    beta_bool_not = np.logical_not(beta_bool)
-                    self.logger.info('updating *only* out-category parameters')
-                    self.gamma_eps[beta_bool_not] = gamma_eps_updated[beta_bool_not]
-                    self.rho_eps[beta_bool_not] = \
-                        rho_eps_updated[beta_bool_not]
+        if update_categories == 'out_category':
+            self.logger.info('updating *only* out-category parameters')
+            categories.copyto(self.gamma_eps, gamma_eps_updated, False)
+            categories.copyto(self.rho_eps, rho_eps_updated, False)
         elif update_categories == 'all_categories':
             self.gamma_eps = gamma_eps_updated
             self.rho_eps = rho_eps_updated
 
-        self.Eeps, self.Elogeps = _compute_expectations(self.gamma_eps, self.rho_eps)
+        self.Eeps, self.Elogeps = _compute_expectations(
+            self.gamma_eps, self.rho_eps, self.dtype,
+            out=self.workspace.expectations('eps', shape))
+        self.exp_cache.invalidate('Elogeps')
 
 
-    def _xexplog_b(self, rows, cols):
+    def _xexplog_b_factors(self):
         '''
+        Item and user factors whose inner product for user i, doc d is
         sum_k exp(E[log theta_{ik} * beta_s_{kd}])
         '''
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
+            expElogt = self.exp_cache.get('Elogt')
 
         if self.observed_item_attributes:
             expElogb = self.Eb
         else:
-            expElogb = np.exp(self.Elogb)
+            expElogb = self.exp_cache.get('Elogb')
 
-        data = _inner(expElogb, expElogt, rows, cols)
+        return expElogb, expElogt
 
-        return data
-
-    def _xexplog_eps(self, rows, cols):
+    def _xexplog_eps_factors(self):
         '''
-        user i, doc d
+        Item and user factors whose inner product for user i, doc d is
         sum_k exp(E[log theta_{ik} * eps_{kd}])
         '''
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
-
-        data = _inner(np.exp(self.Elogeps), expElogt, rows, cols)
+            expElogt = self.exp_cache.get('Elogt')
 
-        return data
+        return self.exp_cache.get('Elogeps'), expElogt
 
     def pred_loglikeli(self, X_new, rows_new, cols_new):
-        X_pred_bs = _inner(self.Eb, self.Et, rows_new, cols_new)
-        #rows_item_corrections_new = np.array([self.song2artist[song] for song in rows_new], dtype=np.int32)
-        rows_item_corrections_new = np.array([song for song in rows_new], dtype=np.int32)
-        X_pred_ba = _inner(self.Eeps, self.Et, rows_item_corrections_new, cols_new)
-        X_pred = X_pred_bs + X_pred_ba
-        pred_ll = np.mean(X_new * np.log(X_pred) - X_pred)
+        X_new, rows_new, cols_new = self.ratings_cache.get(
+            X_new, rows_new, cols_new, (self.Eb.shape[0], self.Et.shape[1]))
+        # Eeps is indexed by song like Eb, and the two terms are only
+        # scored as a sum, so one inner product with Eb + Eeps does
+        Eb_sum = self.workspace.get('Eb_sum', self.Eeps.shape)
+        if sparse.issparse(self.Eb):
+            # the stored entries of a sparse observed Eb, added onto Eeps
+            np.copyto(Eb_sum, self.Eeps)
+            Eb = self.Eb.tocoo()
+            Eb_sum[Eb.row, Eb.col] += Eb.data
+        else:
+            np.add(self.Eb, self.Eeps, out=Eb_sum)
+        X_pred = kernels.inner(Eb_sum, self.Et, rows_new, cols_new)
+        pred_ll = np.log(X_pred)
+        pred_ll *= X_new
+        pred_ll -= X_pred
+        pred_ll = np.mean(pred_ll)
         return pred_ll
 
-def _inner(beta, theta, rows, cols):
-    n_ratings = rows.size
-    n_components, n_users = theta.shape
-    data = np.empty(n_ratings, dtype=np.float32)
-    code = r"""
-    for (int i = 0; i < n_ratings; i++) {
-       data[i] = 0.0;
-       for (int j = 0; j < n_components; j++) {
-           data[i] += beta[rows[i] * n_components + j] * theta[j * n_users + cols[i]];
-       }
-    }
-    """
-    weave.inline(code, ['data', 'theta', 'beta', 'rows', 'cols',
-                        'n_ratings', 'n_components', 'n_users'])
-    return data
-
-def _compute_expectations(alpha, beta):
+def _append_rows(x, new, n_rows):
+    '''
+    The n_rows rows of x followed by the rows of new, where x may be a
+    single row shared by all items (e.g. rho_eps after an unmasked update),
+    or a sparse observed Eb
+    '''
+    if sparse.issparse(x):
+        return sparse.vstack([x, new], format='csr')
+    return np.concatenate([np.broadcast_to(x, (n_rows, new.shape[1])), new])
+
+def _compute_expectations(alpha, beta, dtype, out=None):
     '''
-    Given x ~ Gam(alpha, beta), compute E[x] and E[log x]
+    Given x ~ Gam(alpha, beta), compute E[x] and E[log x], checking that
+    nothing was promoted away from the model dtype. With out=(Ex, Elogx)
+    the expectations are written into those buffers instead
     '''
-    return (alpha / beta, special.psi(alpha) - np.log(beta))
\ No newline at end of file
+    if out is None:
+        Ex, Elogx = alpha / beta, variational.psi(alpha) - np.log(beta)
+    else:
+        Ex, Elogx = variational.gamma_expectations(alpha, beta, *out)
+    variational.check_dtype(dtype, alpha=alpha, beta=beta, Ex=Ex, Elogx=Elogx)
+    return Ex, Elogx
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+
+Binary cache of the preprocessed arxiv dataset (train/validation/test CSR
+matrices, the document-category matrix and the document/user counts), so that
+jobs after the first open memory-mapped arrays instead of re-parsing the tsvs
+
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import rec_eval
+
+logger = logging.getLogger(__name__)
+
+# bump when the cached arrays or their meaning change, to invalidate old caches
+FORMAT_VERSION = 2
+
+SPLITS = ['train', 'validation', 'test']
+
+
+def parse(files, binarize, categories=True):
+    '''
+    Parse the dataset tsvs into a dict of
+        train, validation, test : (csr_matrix, rows, cols) as from
+            rec_eval.load_data
+        observed_categories : n_docs x n_categories float32 csr_matrix of
+            category indicators, or None when categories is False
+        category_list : the category names, in column order
+        n_docs, n_users : int
+
+    files : dict
+        Paths (or open files) for train, validation, test, item_info and
+        user_info
+    '''
+    id2arxiv_info = pd.read_csv(files['item_info'], header=None, delimiter='\t', names=['arxiv_id', 'categories', 'title', 'date'])
+    n_docs = np.unique(id2arxiv_info.index).shape[0]
+    data = dict(n_docs=n_docs, observed_categories=None, category_list=[])
+    if categories:
+        data['observed_categories'], data['category_list'] = \
+            category_indicators(id2arxiv_info['categories'])
+    id2arxiv_uid = pd.read_csv(files['user_info'], header=None, delimiter='\t', names=['uid'])
+    data['n_users'] = np.unique(id2arxiv_uid.uid).shape[0]
+    data.update(zip(SPLITS, rec_eval.load_datasets(
+        [files[split] for split in SPLITS],
+        (data['n_docs'], data['n_users']), binarize)))
+    return data
+
+
+def category_indicators(categories):
+    '''
+    The n_docs x n_categories float32 csr_matrix of indicators of each
+    document's space-separated categories, and the category names in column
+    order (sorted, as in get_dummies), built without a dense matrix
+    '''
+    doc_categories = categories.fillna('').str.split()
+    lengths = doc_categories.str.len().values
+    names, indices = np.unique([name for doc in doc_categories for name in doc],
+                               return_inverse=True)
+    indptr = np.zeros(lengths.size + 1, dtype=np.int32)
+    np.cumsum(lengths, out=indptr[1:])
+    indicators = sparse.csr_matrix(
+        (np.ones(indices.size, dtype=np.float32), indices.astype(np.int32),
+         indptr), shape=(lengths.size, names.size))
+    # a category listed twice is still a single indicator
+    indicators.sum_duplicates()
+    indicators.data[:] = 1
+    return indicators, list(names)
+
+
+def load(cache_dir, files, binarize):
+    '''
+    parse's dict for files, from the cache entry under cache_dir for these
+    file contents and binarize, which is built first if there is none. The
+    arrays are memory-mapped copy-on-write, so opening the entry reads only
+    what is used and writing to an array never changes the cache.
+    '''
+    key = cache_key(files, binarize)
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(path, 'manifest.json')):
+        logger.info('building dataset cache {}'.format(path))
+        _build(cache_dir, path, key, files, binarize)
+    logger.info('loading dataset cache {}'.format(path))
+    return _open(path)
+
+
+def cache_key(files, binarize):
+    ''' sha1 of the format version, binarize and the contents of files '''
+    key = hashlib.sha1('{}:{}'.format(FORMAT_VERSION, bool(binarize)))
+    for name in sorted(files):
+        key.update('{}:{}'.format(name, _file_sha1(files[name])))
+    return key.hexdigest()
+
+
+def _file_sha1(f, block_size=2 ** 20):
+    file_hash = hashlib.sha1()
+    with open(getattr(f, 'name', f), 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), ''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _build(cache_dir, path, key, files, binarize):
+    data = parse(files, binarize)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # written next to the entry and renamed into place, so that readers never
+    # see a partial entry and concurrent builders of the same entry keep one
+    tmp_path = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+    observed_categories = data['observed_categories']
+    arrays = dict(categories_indptr=observed_categories.indptr,
+                  categories_indices=observed_categories.indices,
+                  categories_data=observed_categories.data)
+    for split in SPLITS:
+        matrix, rows, cols = data[split]
+        arrays.update({split + '_indptr': matrix.indptr,
+                       split + '_indices': matrix.indices,
+                       split + '_data': matrix.data,
+                       split + '_rows': rows,
+                       split + '_cols': cols})
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    manifest = dict(
+        version=FORMAT_VERSION, binarize=bool(binarize),
+        files=dict((name, getattr(f, 'name', f)) for name, f in files.items()),
+        n_docs=data['n_docs'], n_users=data['n_users'],
+        category_list=data['category_list'],
+        arrays=dict((name, dict(dtype=str(array.dtype), shape=array.shape))
+                    for name, array in arrays.items()))
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            raise
+        shutil.rmtree(tmp_path)
+
+
+def _open(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                 mmap_mode='c'))
+                  for name in manifest['arrays'])
+    shape = (manifest['n_docs'], manifest['n_users'])
+    data = dict(n_docs=manifest['n_docs'], n_users=manifest['n_users'],
+                category_list=[str(name) for name in manifest['category_list']])
+    data['observed_categories'] = sparse.csr_matrix(
+        (arrays['categories_data'], arrays['categories_indices'],
+         arrays['categories_indptr']),
+        shape=(manifest['n_docs'], len(data['category_list'])))
+    for split in SPLITS:
+        matrix = sparse.csr_matrix((arrays[split + '_data'],
+                                    arrays[split + '_indices'],
+                                    arrays[split + '_indptr']), shape=shape)
+        # as written by rec_eval.load_data
+        matrix.has_canonical_format = True
+        data[split] = (matrix, arrays[split + '_rows'], arrays[split + '_cols'])
+    return data
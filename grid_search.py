@@ -8,6 +8,8 @@ import logging
 #in_dir = '/home/statler/lcharlin/arxiv/dat/dataset_toy/'
 in_dir = '/home/statler/lcharlin/arxiv/dat/dataset_2003-2012_clean/'
 out_dir = '/home/waldorf/altosaar/projects/arxiv/fit/'
+# parsed once by the first job, then memory-mapped by the rest
+cache_dir = out_dir + 'cache/'
 
 def dict_product(dicts):
     return (dict(izip(dicts, x)) for x in product(*dicts.itervalues()))
@@ -32,6 +34,7 @@ parameters = dict(model = ['pmf', 'ctpf'],
   test_file = [test_file],
   item_info_file = [item_info_file],
   user_info_file = [user_info_file],
+  cache_dir = [cache_dir],
   trained_user_preferences_file = [trained_user_preferences_file],
   min_iterations = ['3'],
   stdout = ['stdout'],
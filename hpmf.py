@@ -8,17 +8,26 @@ CREATED: 2014-11-17 16:06:50 by Dawen Liang <dliang@ee.columbia.edu>
 
 import sys
 import numpy as np
-from scipy import sparse, special, weave
 import logging
 
 from sklearn.base import BaseEstimator, TransformerMixin
 
+import kernels
+import variational
+
 
 class HPoissonMF(BaseEstimator, TransformerMixin):
     ''' Hierarchical Poisson matrix factorization with batch inference '''
+    # the variational state written to a checkpoint
+    _checkpoint_names = ('gamma_b', 'rho_b', 'Eb', 'Elogb',
+                         'gamma_t', 'rho_t', 'Et', 'Elogt',
+                         'gamma_ksi', 'rho_ksi', 'Eksi',
+                         'gamma_eta', 'rho_eta', 'Eeta')
+
     def __init__(self, n_components=100, max_iter=100, min_iter=1, tol=0.0001,
                  smoothness=100, random_state=None, verbose=False,
-                 **kwargs):
+                 dtype=np.float32, eval_schedule=None, checkpoint=None,
+                 accelerate=None, init='random', **kwargs):
         ''' Hierarchical Poisson matrix factorization
 
         Arguments
@@ -42,10 +51,35 @@ class HPoissonMF(BaseEstimator, TransformerMixin):
         verbose : bool
             Whether to show progress during model fitting
 
+        dtype : numpy dtype
+            Floating point type of every variational parameter. Updates that
+            would silently promote away from it raise a TypeError
+
+        eval_schedule : variational.EvalSchedule
+            When fit scores the validation and training sets, by default the
+            full validation set on every iteration
+
+        checkpoint : checkpoint.Checkpoint or None
+            Where fit periodically writes its full state, and resumes from
+
+        accelerate : None or 'squarem'
+            Extrapolate the item factors every third batch iteration
+            from the two before it with variational.Squarem, keeping only
+            jumps that score at least as well on the validation set (which
+            is scored for that even with evaluation off)
+
+        init : 'random', 'subsample' or 'svd'
+            Starting values of the unobserved factors, the random draws or
+            ones computed from the ratings, see variational.init_factors.
+            'categories' is for pmf only: categorywise fits of hpmf keep
+            beta observed, without variational item parameters to seed
+
         **kwargs: dict
             Model hyperparameters
         '''
         self.logger = logging.getLogger(__name__)
+        self.exp_cache = variational.ExpCache(self)
+        self.workspace = variational.Workspace(dtype)
 
         self.n_components = n_components
         self.max_iter = max_iter
@@ -53,6 +87,13 @@ class HPoissonMF(BaseEstimator, TransformerMixin):
         self.smoothness = smoothness
         self.random_state = random_state
         self.verbose = verbose
+        self.dtype = dtype
+        if eval_schedule is None:
+            eval_schedule = variational.EvalSchedule()
+        self.eval_schedule = eval_schedule
+        self.checkpoint = checkpoint
+        self.accelerate = accelerate
+        self.init = init
         self.min_iter = min_iter
 
         if type(self.random_state) is int:
@@ -75,26 +116,28 @@ class HPoissonMF(BaseEstimator, TransformerMixin):
         self.gamma_t = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
                             size=(self.n_components, n_users)
-                            ).astype(np.float32)
+                            ).astype(self.dtype)
         self.rho_t = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
                             size=(self.n_components, n_users)
-                            ).astype(np.float32)
-        self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+                            ).astype(self.dtype)
+        self.Et, self.Elogt = _compute_expectations(
+            self.gamma_t, self.rho_t, self.dtype)
         # variational parameters for user activity
         self.gamma_ksi = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
-                            size=n_users).astype(np.float32)
+                            size=n_users).astype(self.dtype)
         self.rho_ksi = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
-                            size=n_users).astype(np.float32)
-        self.Eksi, _ = _compute_expectations(self.gamma_ksi, self.rho_ksi)
+                            size=n_users).astype(self.dtype)
+        self.Eksi, _ = _compute_expectations(
+            self.gamma_ksi, self.rho_ksi, self.dtype)
 
     def _init_items(self, n_items, beta=False):
         # if observed cats:
-        if type(beta) == np.ndarray:
+        if variational.observed(beta):
             self.logger.info('initializing beta to be observed')
-            self.Eb = beta
+            self.Eb = variational.observed_factor(beta, self.dtype)
             self.Elogb = None
             self.gamma_b = None
             self.rho_b = None
@@ -107,20 +150,22 @@ class HPoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_b = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_b = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
-            self.Eb, self.Elogb = _compute_expectations(self.gamma_b, self.rho_b)
+                                ).astype(self.dtype)
+            self.Eb, self.Elogb = _compute_expectations(
+                self.gamma_b, self.rho_b, self.dtype)
             # variational parameters for item popularity
             self.gamma_eta = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
-                                size=(n_items, 1)).astype(np.float32)
+                                size=(n_items, 1)).astype(self.dtype)
             self.rho_eta = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
-                                size=(n_items, 1)).astype(np.float32)
-            self.Eeta, _ = _compute_expectations(self.gamma_eta, self.rho_eta)
+                                size=(n_items, 1)).astype(self.dtype)
+            self.Eeta, _ = _compute_expectations(
+                self.gamma_eta, self.rho_eta, self.dtype)
 
     def fit(self, X, rows, cols, vad,
         beta=False, theta=False, categorywise=False, item_fit_type='default',
@@ -137,223 +182,334 @@ class HPoissonMF(BaseEstimator, TransformerMixin):
         self: object
             Returns the instance itself.
         '''
+        variational.check_accelerate(self.accelerate)
+        variational.check_init(self.init)
+        if self.init == 'categories':
+            raise ValueError('init categories is for pmf only, hpmf keeps '
+                             'the observed categories as beta')
         n_items, n_users = X.shape
+        self._pattern = kernels.SparsityPattern(rows, cols, X.shape)
         self._init_items(n_items, beta=beta)
         self._init_users(n_users)
+        self._categories = None
+        if variational.observed(beta) and categorywise:
+            self._categories = variational.CategoryMask(beta)
+        resume = []
+        if self.checkpoint is not None:
+            resume = self.checkpoint.load(self)
+        if not resume:
+            # a resumed fit has its factors from the checkpoint
+            variational.init_factors(self, X, beta=beta)
+        self._frames = [dict()]
         self._update(X, rows, cols, vad, beta=beta, categorywise=categorywise,
             item_fit_type=item_fit_type,
-            zero_untrained_components=zero_untrained_components)
+            zero_untrained_components=zero_untrained_components,
+            resume=resume[1:])
+        self.exp_cache.log_stats()
+        self.workspace.log_stats()
         return self
 
-    #def transform(self, X, attr=None):
-    #    '''Encode the data as a linear combination of the latent components.
-
-    #    Parameters
-    #    ----------
-    #    X : array-like, shape (n_samples, n_feats)
-
-    #    attr: string
-    #        The name of attribute, default 'Eb'. Can be changed to Elogb to
-    #        obtain E_q[log beta] as transformed data.
-
-    #    Returns
-    #    -------
-    #    X_new : array-like, shape(n_samples, n_filters)
-    #        Transformed data, as specified by attr.
-    #    '''
-
-    #    if not hasattr(self, 'Eb'):
-    #        raise ValueError('There are no pre-trained components.')
-    #    n_samples, n_feats = X.shape
-    #    if n_feats != self.Eb.shape[1]:
-    #        raise ValueError('The dimension of the transformed data '
-    #                         'does not match with the existing components.')
-    #    if attr is None:
-    #        attr = 'Et'
-    #    self._init_weights(n_samples)
-    #    self._update(X, update_beta=False)
-    #    return getattr(self, attr)
+    def transform(self, X):
+        '''Encode unseen users by their preferences, see fold_in_users.
+
+        Parameters
+        ----------
+        X : sparse matrix, shape (n_items, n_users)
+            Ratings of the users, over the items the model was fit on.
+
+        Returns
+        -------
+        X_new : array-like, shape (n_users, n_components)
+            E[theta] of the users.
+        '''
+        return self.fold_in_users(X).T
+
+    def fold_in_users(self, X, max_iter=100, tol=1e-4, batch_size=None):
+        '''
+        E[theta] (n_components x n_users, like Et) of users unseen in fit
+        with ratings X (sparse, n_items x n_users), from user-only updates
+        of theta and the user activity against the frozen item factors. The
+        fitted model is not modified. Users are updated together,
+        batch_size at a time, until the mean relative change of E[theta]
+        drops below tol.
+        '''
+        return variational.fold_in_users(self, X, max_iter=max_iter, tol=tol,
+                                         batch_size=batch_size)
+
+    def _fold_in(self, X_data, rows, cols, n_users, max_iter, tol):
+        pattern = kernels.SparsityPattern(rows, cols,
+                                          (self.Eb.shape[0], n_users))
+        if self.Elogb is None:
+            # beta was observed
+            beta_x = self.Eb
+        else:
+            beta_x = self.exp_cache.get('Elogb')
+        Eb_sum = variational.factor_sums(self.Eb)
+        # start every user from the prior shapes and the prior mean activity
+        Eksi = np.full(n_users, self.a_ksi / self.b_ksi, dtype=self.dtype)
+        Et, Elogt = _compute_expectations(
+            np.full((self.n_components, n_users), self.a, dtype=self.dtype),
+            Eksi + Eb_sum, self.dtype)
+        gamma_ksi = self.a_ksi + self.n_components * self.a
+        for _ in xrange(max_iter):
+            expElogt = np.exp(Elogt)
+            gamma_t = kernels.ratio_dot_users(X_data, beta_x, expElogt, rows,
+                                              cols, pattern=pattern)
+            gamma_t *= expElogt
+            gamma_t += self.a
+            Et_old = Et
+            Et, Elogt = _compute_expectations(gamma_t, Eksi + Eb_sum,
+                                              self.dtype)
+            Eksi, _ = _compute_expectations(
+                gamma_ksi, self.b_ksi + np.sum(Et, axis=0), self.dtype)
+            if variational.converged(Et, Et_old, tol):
+                break
+        return Et
 
     def _update(self, X, rows, cols, vad, beta=False, categorywise=False,
-        item_fit_type='default', update='default', zero_untrained_components=False):
+        item_fit_type='default', update='default', zero_untrained_components=False,
+        resume=()):
         # alternating between update latent components and weights
-        old_pll = -np.inf
-        for i in xrange(self.max_iter):
-            self._update_users(X, rows, cols, beta=beta)
-            if type(beta) == np.ndarray and not categorywise:
-                pass
-            elif item_fit_type != 'default':
-                if zero_untrained_components and i == 1 and update == 'default':
-                    # store the initial values somewhere, then zero them out,
-                    # then load them back in once they've been fit
-                    beta_bool = beta.astype(bool)
-                    beta_bool_not = np.logical_not(beta_bool)
-                    small_num = 1e-5
-                    if item_fit_type == 'converge_in_category_first':
-                        # zero out out_category components
-                        gamma_b_out_category = self.gamma_b[beta_bool_not]
-                        rho_b_out_category = self.rho_b[beta_bool_not]
-                        self.gamma_b[beta_bool_not] = small_num
-                        self.rho_b[beta_bool_not] = small_num
-                    elif item_fit_type == 'converge_out_category_first':
-                        # zero out in_category components
-                        gamma_b_in_category = self.gamma_b[beta_bool]
-                        rho_b_in_category = self.rho_b[beta_bool]
-                        self.gamma_b[beta_bool] = small_num
-                        self.rho_b[beta_bool] = small_num
-                if (type(beta) == np.ndarray and categorywise and
-                    item_fit_type == 'alternating_updates'):
-                    # alternate between updating in-category and out-category components of items
-                    if i % 2 == 0:
-                        self._update_items(X, rows, cols, beta=beta,
-                            categorywise=categorywise, iteration=i,
-                            update='in_category')
-                    else:
-                        self._update_items(X, rows, cols, beta=beta,
-                            categorywise=categorywise, iteration=i,
-                            update='out_category')
-                elif (type(beta) == np.ndarray and categorywise and
-                    item_fit_type == 'converge_in_category_first'):
-                    # first update in-category components
-                    if update == 'default':
-                        self._update_items(X, rows, cols, beta=beta,
-                            categorywise=categorywise, update='in_category')
-                    else:
-                        self._update_items(X, rows, cols, beta=beta,
-                            categorywise=categorywise, update=update)
-                elif (type(beta) == np.ndarray and categorywise and
-                    item_fit_type == 'converge_out_category_first'):
-                    # first update out-category components
-                    if update == 'default':
-                        self._update_items(X, rows, cols, beta=beta,
-                            categorywise=categorywise, update='out_category')
-                    else:
-                        self._update_items(X, rows, cols, beta=beta,
-                            categorywise=categorywise, update=update)
-            else:
-                self._update_items(X, rows, cols)
-            pred_ll = self.pred_loglikeli(**vad)
+        old_pll = pred_ll = -np.inf
+        # this stage's position, as written to a checkpoint
+        frame = dict(update=update, initial=dict())
+        squarem = None
+        if self.accelerate == 'squarem':
+            squarem = variational.Squarem(
+                ['b'],
+                lambda model: self.eval_schedule.score(model, **vad))
+            frame['squarem'] = squarem
+        start, converged = 0, False
+        if resume:
+            state, resume = resume[0], resume[1:]
+            start, old_pll, pred_ll = (state['iteration'], state['old_pll'],
+                                       state['pred_ll'])
+            frame['initial'] = state['initial']
+            if squarem is not None:
+                squarem.load(state['squarem'])
+            # more frames mean the checkpoint was written in the stage this
+            # one converged into
+            converged = bool(resume)
+        self._frames.append(frame)
+        for i in xrange(start, self.max_iter):
+            if converged:
+                break
+            if (i > start and self.checkpoint is not None and
+                    self.checkpoint.due(i)):
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll)
+                self.checkpoint.save(self, self._frames)
+            for _ in variational.steps(squarem, self):
+                self._update_users(X, rows, cols, beta=beta)
+                if variational.observed(beta) and not categorywise:
+                    pass
+                elif item_fit_type != 'default':
+                    if zero_untrained_components and i == 1 and update == 'default':
+                        # store the initial values somewhere, then zero them out,
+                        # then load them back in once they've been fit
+                        categories = self._categories
+                        small_num = 1e-5
+                        if item_fit_type == 'converge_in_category_first':
+                            # zero out out_category components
+                            frame['initial'] = dict(
+                                gamma_b=categories.take(self.gamma_b, False),
+                                rho_b=categories.take(self.rho_b, False))
+                            categories.put(self.gamma_b, small_num, False)
+                            categories.put(self.rho_b, small_num, False)
+                            # their expectations are recomputed by the first in-category update
+                            categories.stale = True
+                        elif item_fit_type == 'converge_out_category_first':
+                            # zero out in_category components
+                            frame['initial'] = dict(
+                                gamma_b=categories.take(self.gamma_b),
+                                rho_b=categories.take(self.rho_b))
+                            categories.put(self.gamma_b, small_num)
+                            categories.put(self.rho_b, small_num)
+                    if (variational.observed(beta) and categorywise and
+                        item_fit_type == 'alternating_updates'):
+                        # alternate between updating in-category and out-category components of items
+                        if i % 2 == 0:
+                            self._update_items(X, rows, cols, beta=beta,
+                                categorywise=categorywise, iteration=i,
+                                update='in_category')
+                        else:
+                            self._update_items(X, rows, cols, beta=beta,
+                                categorywise=categorywise, iteration=i,
+                                update='out_category')
+                    elif (variational.observed(beta) and categorywise and
+                        item_fit_type == 'converge_in_category_first'):
+                        # first update in-category components
+                        if update == 'default':
+                            self._update_items(X, rows, cols, beta=beta,
+                                categorywise=categorywise, update='in_category')
+                        else:
+                            self._update_items(X, rows, cols, beta=beta,
+                                categorywise=categorywise, update=update)
+                    elif (variational.observed(beta) and categorywise and
+                        item_fit_type == 'converge_out_category_first'):
+                        # first update out-category components
+                        if update == 'default':
+                            self._update_items(X, rows, cols, beta=beta,
+                                categorywise=categorywise, update='out_category')
+                        else:
+                            self._update_items(X, rows, cols, beta=beta,
+                                categorywise=categorywise, update=update)
+                else:
+                    self._update_items(X, rows, cols)
+            if not self.eval_schedule.due(i):
+                continue
+            pred_ll = self.eval_schedule.score(self, **vad)
             if np.isnan(pred_ll):
                 self.logger.error('got nan in predictive ll')
                 raise Exception('nan in predictive ll')
-            improvement = (pred_ll - old_pll) / abs(old_pll)
+            if squarem is None:
+                improvement = (pred_ll - old_pll) / abs(old_pll)
+            else:
+                # the jumps may lower the score on the way to a higher one
+                improvement = squarem.improvement(pred_ll)
             if self.verbose:
                 self.logger.info('ITERATION: %d\tPred_ll: %.2f\tOld Pred_ll: %.2f\t'
                       'Improvement: %.5f' % (i, pred_ll, old_pll, improvement))
                 sys.stdout.flush()
             if improvement < self.tol and i > self.min_iter:
-                if update == 'default' and item_fit_type != 'default':
-                    if item_fit_type == 'converge_in_category_first':
-                        # we converged in-category. now converge out_category
-                        if zero_untrained_components:
-                            self.logger.info(
-                                're-load initial values for out_category')
-                            self.gamma_b[beta_bool_not] = gamma_b_out_category
-                            self.rho_b[beta_bool_not] = rho_b_out_category
-                        self._update(X, rows, cols, vad, beta=beta,
-                            categorywise=categorywise, item_fit_type=item_fit_type,
-                            update='out_category')
-                    if item_fit_type == 'converge_out_category_first':
-                        # we converged out-category. now converge in_category
-                        if zero_untrained_components:
-                            self.logger.info(
-                                're-load initial values for in_category')
-                            self.gamma_b[beta_bool] = gamma_b_in_category
-                            self.rho_b[beta_bool] = rho_b_in_category
-                        self._update(X, rows, cols, vad, beta=beta,
-                            categorywise=categorywise, item_fit_type=item_fit_type,
-                            update='in_category')
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll)
+                converged = True
                 break
             old_pll = pred_ll
-        pass
+        if converged and update == 'default' and item_fit_type != 'default':
+            # the zeroed-out initial values are re-loaded (once, a resumed
+            # sub-stage has them already)
+            initial, frame['initial'] = frame['initial'], dict()
+            categories = self._categories
+            if item_fit_type == 'converge_in_category_first':
+                # we converged in-category. now converge out_category
+                if initial:
+                    self.logger.info(
+                        're-load initial values for out_category')
+                    categories.put(self.gamma_b, initial['gamma_b'], False)
+                    categories.put(self.rho_b, initial['rho_b'], False)
+                self._update(X, rows, cols, vad, beta=beta,
+                    categorywise=categorywise, item_fit_type=item_fit_type,
+                    update='out_category', resume=resume)
+            if item_fit_type == 'converge_out_category_first':
+                # we converged out-category. now converge in_category
+                if initial:
+                    self.logger.info(
+                        're-load initial values for in_category')
+                    categories.put(self.gamma_b, initial['gamma_b'])
+                    categories.put(self.rho_b, initial['rho_b'])
+                self._update(X, rows, cols, vad, beta=beta,
+                    categorywise=categorywise, item_fit_type=item_fit_type,
+                    update='in_category', resume=resume)
+        if squarem is not None:
+            squarem.log_stats()
+        self._frames.pop()
 
     def _update_users(self, X, rows, cols, beta=False, categorywise=False):
-        xexplog = self._xexplog(rows, cols, beta=beta)
-        ratioT = sparse.csr_matrix((X.data / xexplog,
-                                    (rows, cols)),
-                                   dtype=np.float32, shape=X.shape).transpose()
-        if type(beta) == np.ndarray and not categorywise:
-            self.gamma_t = self.a + np.exp(self.Elogt) * \
-                ratioT.dot(self.Eb).T
+        beta_x, theta_x = self._xexplog_factors(beta=beta)
+        shape = (self.n_components, X.shape[1])
+        self.gamma_t = self.workspace.get('gamma_t', shape)
+        if variational.observed(beta) and not categorywise:
+            kernels.ratio_dot_users(X.data, beta_x, theta_x, rows, cols,
+                                    beta_acc=self.Eb, pattern=self._pattern,
+                                    out=self.gamma_t)
         else:
-            self.gamma_t = self.a + np.exp(self.Elogt) * \
-                ratioT.dot(np.exp(self.Elogb)).T
-
-        self.rho_t = self.Eksi + np.sum(self.Eb, axis=0, keepdims=True).T
-        self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+            kernels.ratio_dot_users(X.data, beta_x, theta_x, rows, cols,
+                                    beta_acc=self.exp_cache.get('Elogb'),
+                                    pattern=self._pattern, out=self.gamma_t)
+        self.gamma_t *= self.exp_cache.get('Elogt')
+        self.gamma_t += self.a
+
+        self.rho_t = self.Eksi + variational.factor_sums(self.Eb)
+        self.Et, self.Elogt = _compute_expectations(
+            self.gamma_t, self.rho_t, self.dtype,
+            out=self.workspace.expectations('t', shape))
+        self.exp_cache.invalidate('Elogt')
 
         # update user activity hyperprior
         self.gamma_ksi = self.a_ksi + self.n_components * self.a
         self.rho_ksi = self.b_ksi + np.sum(self.Et, axis=0)
-        self.Eksi, _ = _compute_expectations(self.gamma_ksi, self.rho_ksi)
+        self.Eksi, _ = _compute_expectations(
+            self.gamma_ksi, self.rho_ksi, self.dtype,
+            out=self.workspace.expectations('ksi', self.rho_ksi.shape))
 
     def _update_items(self, X, rows, cols, beta=False, categorywise=False,
         update='default', iteration=None):
-        ratio = sparse.csr_matrix((X.data / self._xexplog(rows, cols),
-                                   (rows, cols)),
-                                  dtype=np.float32, shape=X.shape)
-        if type(beta) == np.ndarray and categorywise:
-            beta_bool = beta.astype(bool)
-            gamma_b_updated = self.c + np.exp(self.Elogb) * \
-                ratio.dot(np.exp(self.Elogt.T))
-            rho_b_updated = self.Eeta + np.sum(self.Et, axis=1)
-            if update == 'in_category':
-                self.logger.info('updating *only* in-category parameters')
-                self.gamma_b[beta_bool] = gamma_b_updated[beta_bool]
-                self.rho_b[beta_bool] = rho_b_updated[beta_bool]
-            elif update == 'out_category':
-                beta_bool_not = np.logical_not(beta_bool)
-                self.logger.info('updating *only* out-category parameters')
-                self.gamma_b[beta_bool_not] = gamma_b_updated[beta_bool_not]
-                self.rho_b[beta_bool_not] = \
-                    rho_b_updated[beta_bool_not]
-            self.Eb, self.Elogb = _compute_expectations(self.gamma_b, self.rho_b)
+        beta_x, theta_x = self._xexplog_factors()
+        shape = (X.shape[0], self.n_components)
+        categories = self._categories
+        if (variational.observed(beta) and categorywise and
+                update == 'in_category'):
+            self.logger.info('updating *only* in-category parameters')
+            # computed only at the in-category entries, the rest stay frozen
+            gamma_b_updated = self.workspace.get('gamma_b_masked',
+                                                 categories.cols.shape)
+            kernels.ratio_dot_items_masked(
+                X.data, beta_x, theta_x, rows, cols, categories.indptr,
+                categories.cols, pattern=self._pattern, out=gamma_b_updated)
+            gamma_b_updated *= categories.take(self.exp_cache.get('Elogb'))
+            gamma_b_updated += self.c
+            variational.update_in_category(
+                self, 'b', gamma_b_updated,
+                self.Eeta + np.sum(self.Et, axis=1))
         else:
-            self.gamma_b = self.c + np.exp(self.Elogb) * \
-                ratio.dot(np.exp(self.Elogt.T))
-            self.rho_b = self.Eeta + np.sum(self.Et, axis=1)
-            self.Eb, self.Elogb = _compute_expectations(self.gamma_b, self.rho_b)
+            if variational.observed(beta) and categorywise:
+                gamma_b_updated = self.workspace.get('gamma_b_updated', shape)
+                kernels.ratio_dot_items(X.data, beta_x, theta_x, rows, cols,
+                                        pattern=self._pattern,
+                                        out=gamma_b_updated)
+                gamma_b_updated *= self.exp_cache.get('Elogb')
+                gamma_b_updated += self.c
+                rho_b_updated = self.Eeta + np.sum(self.Et, axis=1)
+                if update == 'out_category':
+                    self.logger.info('updating *only* out-category parameters')
+                    categories.copyto(self.gamma_b, gamma_b_updated, False)
+                    categories.copyto(self.rho_b, rho_b_updated, False)
+            else:
+                self.gamma_b = self.workspace.get('gamma_b', shape)
+                kernels.ratio_dot_items(X.data, beta_x, theta_x, rows, cols,
+                                        pattern=self._pattern,
+                                        out=self.gamma_b)
+                self.gamma_b *= self.exp_cache.get('Elogb')
+                self.gamma_b += self.c
+                self.rho_b = self.Eeta + np.sum(self.Et, axis=1)
+            self.Eb, self.Elogb = _compute_expectations(
+                self.gamma_b, self.rho_b, self.dtype,
+                out=self.workspace.expectations('b', shape))
+            self.exp_cache.invalidate('Elogb')
 
         # update item popularity hyperprior, regardless
         self.gamma_eta = self.c_eta + self.n_components * self.c
         self.rho_eta = self.d_eta + np.sum(self.Eb, axis=1, keepdims=True)
-        self.Eeta, _ = _compute_expectations(self.gamma_eta, self.rho_eta)
+        self.Eeta, _ = _compute_expectations(
+            self.gamma_eta, self.rho_eta, self.dtype,
+            out=self.workspace.expectations('eta', self.rho_eta.shape))
 
-    def _xexplog(self, rows, cols, beta=False):
+    def _xexplog_factors(self, beta=False):
         '''
+        Item and user factors whose inner product for user i, doc d is
         sum_k exp(E[log theta_{ik} * beta_{kd}])
         '''
-        if type(beta) == np.ndarray:
-            data = _inner(self.Eb, np.exp(self.Elogt), rows, cols)
+        if variational.observed(beta):
+            return self.Eb, self.exp_cache.get('Elogt')
         else:
-            data = _inner(np.exp(self.Elogb), np.exp(self.Elogt), rows, cols)
-        return data
+            return self.exp_cache.get('Elogb'), self.exp_cache.get('Elogt')
 
     def pred_loglikeli(self, X_new, rows_new, cols_new):
-        X_pred = _inner(self.Eb, self.Et, rows_new, cols_new)
+        X_pred = kernels.inner(self.Eb, self.Et, rows_new, cols_new)
         pred_ll = np.mean(X_new * np.log(X_pred) - X_pred)
         return pred_ll
 
 
-def _inner(beta, theta, rows, cols):
-    n_ratings = rows.size
-    n_components, n_users = theta.shape
-    data = np.empty(n_ratings, dtype=np.float32)
-    code = r"""
-    for (int i = 0; i < n_ratings; i++) {
-       data[i] = 0.0;
-       for (int j = 0; j < n_components; j++) {
-           data[i] += beta[rows[i] * n_components + j] * theta[j * n_users + cols[i]];
-       }
-    }
-    """
-    weave.inline(code, ['data', 'theta', 'beta', 'rows', 'cols',
-                        'n_ratings', 'n_components', 'n_users'])
-    return data
-
-
-def _compute_expectations(alpha, beta):
+
+def _compute_expectations(alpha, beta, dtype, out=None):
     '''
-    Given x ~ Gam(alpha, beta), compute E[x] and E[log x]
+    Given x ~ Gam(alpha, beta), compute E[x] and E[log x], checking that
+    nothing was promoted away from the model dtype. With out=(Ex, Elogx)
+    the expectations are written into those buffers instead
     '''
-    return (alpha / beta, special.psi(alpha) - np.log(beta))
+    if out is None:
+        Ex, Elogx = alpha / beta, variational.psi(alpha) - np.log(beta)
+    else:
+        Ex, Elogx = variational.gamma_expectations(alpha, beta, *out)
+    variational.check_dtype(dtype, alpha=alpha, beta=beta, Ex=Ex, Elogx=Elogx)
+    return Ex, Elogx
@@ -10,6 +10,10 @@ import pandas as pd
 import numpy as np
 import scipy
 import pmf, hpmf, uaspmf, uaspmf_original, ctpf
+import checkpoint
+import datacache
+import kernels
+import variational
 import logging
 import util
 import h5py
@@ -42,6 +46,10 @@ parser.add_argument('--trained_user_preferences_file',
   type=str,
   help="trained theta matrix")
 
+parser.add_argument('--cache_dir',
+  type=str,
+  help='directory for binary caches of the parsed input files, reused by later jobs on the same files')
+
 parser.add_argument('--out_dir',
   action='store',
   help='directory for output')
@@ -85,7 +93,7 @@ parser.add_argument('--stdout',
 parser.add_argument('--resume',
   dest='resume',
   action='store_true',
-  help='resume and load')
+  help='load a finished fit from fit.h5, or continue an interrupted one from its checkpoint')
 
 parser.add_argument('--model',
   type=str,
@@ -149,6 +157,83 @@ parser.add_argument('--min_iterations',
   default=1,
   help='minimum number of iterations')
 
+parser.add_argument('--kernel_backend',
+  type=str,
+  default=kernels.get_backend(),
+  help='backend for the sparse kernels: {}'.format(
+    ', '.join(kernels.available_backends())))
+
+parser.add_argument('--dtype',
+  type=str,
+  default='float32',
+  help='floating point type of the variational parameters')
+
+parser.add_argument('--eval',
+  type=str,
+  default='full',
+  help='validation schedule: full, off, every:N or subsample:M')
+
+parser.add_argument('--eval_train_every',
+  type=int,
+  default=1,
+  help='log the training log-likelihood every this many iterations, 0 for never')
+
+parser.add_argument('--snapshot_memory_mb',
+  type=int,
+  default=None,
+  help='spill best-iterate snapshots larger than this to disk')
+
+parser.add_argument('--inference',
+  type=str,
+  default='batch',
+  help='pmf inference: batch, or svi over minibatches of users')
+
+parser.add_argument('--batch_size',
+  type=int,
+  default=1000,
+  help='users per svi minibatch')
+
+parser.add_argument('--learning_offset',
+  type=float,
+  default=10.,
+  help='svi step size is (learning_offset + t) ** -learning_decay')
+
+parser.add_argument('--learning_decay',
+  type=float,
+  default=0.7,
+  help='svi step size decay, in (0.5, 1]')
+
+parser.add_argument('--active_tol',
+  type=float,
+  default=None,
+  help='pmf batch inference skips users and items that moved less than this')
+
+parser.add_argument('--sweep_every',
+  type=int,
+  default=10,
+  help='with --active_tol, update every user and item this often')
+
+parser.add_argument('--accelerate',
+  type=str,
+  default=None,
+  help='extrapolate batch iterations of pmf, ctpf and hpmf: squarem')
+
+parser.add_argument('--init',
+  type=str,
+  default='random',
+  help='starting values of pmf: random, subsample, svd or categories; of '
+    'hpmf: random, subsample or svd')
+
+parser.add_argument('--checkpoint_every',
+  type=int,
+  default=5,
+  help='write the full fit state to checkpoint.h5 every this many iterations, 0 for never')
+
+parser.add_argument('--n_threads',
+  type=int,
+  default=1,
+  help='number of threads for the sparse kernels')
+
 args = parser.parse_args()
 
 # validate arguments
@@ -187,45 +272,49 @@ if args.stdout:
 for arg, value in sorted(vars(args).items()):
   logger.info("{}: {}".format(arg, value))
 
-logger.info('=>loading metadata')
-id2arxiv_info = pd.read_csv(args.item_info_file, header=None, delimiter='\t', names=['arxiv_id', 'categories', 'title', 'date'])
-unique_did = list(id2arxiv_info.index)
-n_docs = np.unique(unique_did).shape[0]
+kernels.set_backend(args.kernel_backend)
+kernels.set_num_threads(args.n_threads)
+eval_schedule = variational.EvalSchedule.parse(args.eval,
+  train_every=args.eval_train_every)
+snapshot_memory = None
+if args.snapshot_memory_mb is not None:
+  snapshot_memory = args.snapshot_memory_mb * 2 ** 20
+
+logger.info('=>loading data')
+files = dict(train=args.train_file, validation=args.validation_file,
+  test=args.test_file, item_info=args.item_info_file,
+  user_info=args.user_info_file)
+if args.cache_dir:
+  data = datacache.load(args.cache_dir, files, args.binarize)
+else:
+  data = datacache.parse(files, args.binarize,
+    categories=args.observed_item_attributes or args.categorywise)
+n_docs, n_users = data['n_docs'], data['n_users']
 
 if args.observed_item_attributes or args.categorywise:
-  document_category_dummies = id2arxiv_info['categories'].str.join(sep='').str.get_dummies(sep=' ')
-  category_list = list(document_category_dummies.columns)
+  category_list = data['category_list']
   n_categories = len(category_list)
   #logging.info('observed topics => num categories (k) = {}'.format(n_categories))
-  observed_categories = document_category_dummies.as_matrix().astype(np.float32)
+  observed_categories = data['observed_categories']
   # check if we have zeros in all rows for some docs
-  assert len(np.where(~observed_categories.any(axis=1))[0]) == 0
+  assert np.all(np.diff(observed_categories.indptr) > 0)
 else:
   n_categories = 166
   observed_categories = False
 
 logger.info('number of categories is k={}'.format(n_categories))
 
-# load num_users
-id2arxiv_uid = pd.read_csv(args.user_info_file, header=None, delimiter='\t', names=['uid'])
-n_users = np.unique(id2arxiv_uid.uid).shape[0]
-
 logger.info('num docs is {}, num users is {}'.format(n_docs, n_users))
 
-
-logger.info('=>loading data')
-train_data, rows, cols = rec_eval.load_data(
-  args.train_file, (n_docs, n_users), args.binarize)
+train_data, rows, cols = data['train']
 train = dict(X_new=train_data.data, rows_new=rows, cols_new=cols)
 
-validation_smat, rows_validation, cols_validation = rec_eval.load_data(
-  args.validation_file, (n_docs, n_users), args.binarize)
+validation_smat, rows_validation, cols_validation = data['validation']
 validation = dict(X_new=validation_smat.data,
            rows_new=rows_validation,
            cols_new=cols_validation)
 
-test_smat, rows_test, cols_test = rec_eval.load_data(args.test_file,
-  (n_docs, n_users), args.binarize)
+test_smat, rows_test, cols_test = data['test']
 test = dict(X_new=test_smat.data,
   rows_new=rows_test,
   cols_new=cols_test)
@@ -241,13 +330,29 @@ else:
 
 logger.info('=>running fit')
 
-h5f = h5py.File('{}fit.h5'.format(args.out_dir), 'w')
+# append mode, so that a resumed job keeps the output of the interrupted one
+h5f = h5py.File('{}fit.h5'.format(args.out_dir), 'a')
+# a finished fit is loaded, an unfinished one continues from its checkpoint
+finished = args.resume and 'Et_t' in h5f
+fit_checkpoint = checkpoint.Checkpoint('{}checkpoint.h5'.format(args.out_dir),
+  every=args.checkpoint_every, resume=args.resume)
+
+def save_dataset(name, data):
+  if name in h5f:
+    del h5f[name]
+  h5f.create_dataset(name, data=data)
 
 if args.model == 'pmf':
   coder = pmf.PoissonMF(n_components=n_categories, random_state=args.seed,
-    verbose=True, a=0.1, b=0.1, c=0.1, d=0.1, logger=logger, tol=args.tolerance,
+    verbose=True, dtype=np.dtype(args.dtype), eval_schedule=eval_schedule,
+    snapshot_memory=snapshot_memory, checkpoint=fit_checkpoint,
+    inference=args.inference, batch_size=args.batch_size,
+    learning_offset=args.learning_offset, learning_decay=args.learning_decay,
+    active_tol=args.active_tol, sweep_every=args.sweep_every,
+    accelerate=args.accelerate, init=args.init,
+    a=0.1, b=0.1, c=0.1, d=0.1, logger=logger, tol=args.tolerance,
     min_iter=args.min_iterations)
-  if args.resume:
+  if finished:
     Eb_t = h5f['Eb_t'][:]
     Et_t = h5f['Et_t'][:]
     logging.info('loaded fit!')
@@ -261,16 +366,18 @@ if args.model == 'pmf':
       coder.fit(train_data, rows, cols, validation)
 
     Et_t = np.ascontiguousarray(coder.Et.T)
-    Eb_t = np.ascontiguousarray(coder.Eb.T)
-    h5f.create_dataset('Eb_t', data=Eb_t)
-    h5f.create_dataset('Et_t', data=Et_t)
+    Eb_t = np.ascontiguousarray(variational.to_dense(coder.Eb).T)
+    save_dataset('Eb_t', Eb_t)
+    save_dataset('Et_t', Et_t)
 
 elif args.model == 'ctpf':
   song2artist = np.array([n for n in range(n_docs)])
   # first fit vanilla poisson factorization for user preferences
   hyper = 0.3
   coder = ctpf.PoissonMF(n_components=n_categories, smoothness=100,
-      max_iter=8, random_state=98765, verbose=True,
+      max_iter=8, random_state=98765, verbose=True, dtype=np.dtype(args.dtype),
+      eval_schedule=eval_schedule, snapshot_memory=snapshot_memory,
+      checkpoint=fit_checkpoint,
       a=hyper, b=hyper, c=hyper, d=hyper, f=hyper, g=hyper, s2a=song2artist,
       min_iter=args.min_iterations,
       beta=observed_categories,
@@ -280,12 +387,12 @@ elif args.model == 'ctpf':
       user_fit_type=args.user_fit_type,
       observed_item_attributes=args.observed_item_attributes,
       observed_user_preferences=args.observed_user_preferences,
-      zero_untrained_components=args.zero_untrained_components)
-  if args.resume:
-    Eba_t = h5f['Eba_t'][:]
-    Ebs_t = h5f['Ebs_t'][:]
+      zero_untrained_components=args.zero_untrained_components,
+      accelerate=args.accelerate)
+  if finished:
+    # Eb_t was saved with the epsilons already added
+    Eb_t = h5f['Eb_t'][:]
     Et_t = h5f['Et_t'][:]
-    Eb_t = Ebs_t + Eba_t
     logging.info('loaded fit!')
   else:
     if args.observed_item_attributes:
@@ -307,12 +414,12 @@ elif args.model == 'ctpf':
       coder.fit(train_data, rows, cols, validation)
 
     Et_t = np.ascontiguousarray(coder.Et.T)
-    Eb_t = np.ascontiguousarray(coder.Eb.T)
+    Eb_t = np.ascontiguousarray(variational.to_dense(coder.Eb).T)
     Eeps_t = np.ascontiguousarray(coder.Eeps.T)
     Eb_t = Eb_t + Eeps_t
-    h5f.create_dataset('Et_t', data=Et_t)
-    h5f.create_dataset('Eb_t', data=Eb_t)
-    h5f.create_dataset('Eeps_t', data=Eeps_t)
+    save_dataset('Et_t', Et_t)
+    save_dataset('Eb_t', Eb_t)
+    save_dataset('Eeps_t', Eeps_t)
 
 elif args.model == 'ctpf_original':
   song2artist = np.array([n for n in range(n_docs)])
@@ -321,7 +428,7 @@ elif args.model == 'ctpf_original':
   coder = uaspmf_original.PoissonMF(n_components=n_categories, smoothness=100,
       max_iter=8, random_state=98765, verbose=True,
       a=hyper, b=hyper, c=hyper, d=hyper, f=hyper, g=hyper, s2a=song2artist)
-  if args.resume:
+  if finished:
     Eba_t = h5f['Eba_t'][:]
     Ebs_t = h5f['Ebs_t'][:]
     Et_t = h5f['Et_t'][:]
@@ -334,15 +441,17 @@ elif args.model == 'ctpf_original':
   Eba_t = np.ascontiguousarray(coder.Eba.T)
   Ebs_t = np.ascontiguousarray(coder.Ebs.T)
   Eb_t = Ebs_t + np.ascontiguousarray(coder.Eba[song2artist].T)
-  h5f.create_dataset('Et_t', data=Et_t)
-  h5f.create_dataset('Eba_t', data=Eba_t)
-  h5f.create_dataset('Ebs_t', data=Ebs_t)
+  save_dataset('Et_t', Et_t)
+  save_dataset('Eba_t', Eba_t)
+  save_dataset('Ebs_t', Ebs_t)
 
 elif args.model == 'hpmf':
   coder = hpmf.HPoissonMF(n_components=n_categories, max_iter=500,
     random_state=98765, verbose=True, min_iter=args.min_iterations,
+    dtype=np.dtype(args.dtype), eval_schedule=eval_schedule,
+    checkpoint=fit_checkpoint, accelerate=args.accelerate, init=args.init,
     a=0.3, c=0.3, a_ksi=0.3, b_ksi=0.3, c_eta=0.3, d_eta=0.3)
-  if args.resume:
+  if finished:
     Eb_t = h5f['Eb_t'][:]
     Et_t = h5f['Et_t'][:]
     logging.info('loaded fit!')
@@ -354,12 +463,12 @@ elif args.model == 'hpmf':
     else:
       coder.fit(train_data, rows, cols, validation)
     Et_t = np.ascontiguousarray(coder.Et.T)
-    Eb_t = np.ascontiguousarray(coder.Eb.T)
-    h5f.create_dataset('Eb_t', data=Eb_t)
-    h5f.create_dataset('Et_t', data=Et_t)
+    Eb_t = np.ascontiguousarray(variational.to_dense(coder.Eb).T)
+    save_dataset('Eb_t', Eb_t)
+    save_dataset('Et_t', Et_t)
 h5f.close()
 
-if not args.resume:
+if not finished:
   # print coder.Eb
   # print '^eb'
   # print coder.Et
@@ -368,4 +477,6 @@ if not args.resume:
 
 rec_eval.calc_all(train_data, validation_smat, test_smat, Et_t, Eb_t)
 
+kernels.log_timings()
+
 
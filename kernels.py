@@ -0,0 +1,724 @@
+"""
+
+Shared sparse kernels for the Poisson factorization models, with selectable
+backends.
+
+The 'compiled' backend is the _kernels extension, built ahead of time with
+`python setup.py build_ext --inplace`. The 'numpy' backend is a blocked,
+vectorized fallback used when the extension is not available.
+
+Item factors (beta, beta_acc) may also be scipy sparse matrices, e.g. an
+observed category indicator matrix. Those go through the *_sparse kernels,
+which only touch the stored entries of each item's row, so they cost
+O(ratings x categories per item) instead of O(ratings x K).
+ratio_dot_items_masked likewise accumulates only a given set of (item,
+component) pairs, for the in-category updates of the categorywise fits.
+
+"""
+import logging
+import time
+import numpy as np
+from scipy import sparse, special
+from multiprocessing.pool import ThreadPool
+
+try:
+    import _kernels
+except ImportError:
+    _kernels = None
+
+logger = logging.getLogger(__name__)
+
+# number of ratings handled per block by the numpy backend
+BLOCK_SIZE = 4096
+
+_backends = dict()
+_timings = dict()
+_backend = dict(name=None)
+_threads = dict(n=1, pool=None)
+
+
+def register_backend(name, **kernels):
+    ''' Register a backend as a set of named kernel functions '''
+    _backends[name] = kernels
+    _timings[name] = dict()
+
+
+def available_backends():
+    return sorted(_backends.keys())
+
+
+def set_backend(name):
+    if name not in _backends:
+        raise ValueError('unknown kernel backend {}, choose from {}'
+                         .format(name, available_backends()))
+    logger.info('using {} kernel backend'.format(name))
+    _backend['name'] = name
+
+
+def get_backend():
+    return _backend['name']
+
+
+def set_num_threads(n_threads):
+    ''' Split the ratings of each kernel call across n_threads threads '''
+    n_threads = max(1, int(n_threads))
+    if n_threads != _threads['n'] and _threads['pool'] is not None:
+        _threads['pool'].close()
+        _threads['pool'] = None
+    _threads['n'] = n_threads
+
+
+def get_num_threads():
+    return _threads['n']
+
+
+def _parallel(func, n_ratings):
+    '''
+    Call func(slice) over contiguous chunks of the ratings. The compiled
+    kernels release the GIL, so the chunks run concurrently.
+    '''
+    n_threads = _threads['n']
+    if n_threads == 1 or n_ratings < n_threads * BLOCK_SIZE:
+        func(slice(0, n_ratings))
+        return
+    if _threads['pool'] is None:
+        _threads['pool'] = ThreadPool(n_threads)
+    bounds = np.linspace(0, n_ratings, n_threads + 1).astype(int)
+    _threads['pool'].map(func, [slice(start, end) for start, end
+                                in zip(bounds[:-1], bounds[1:])])
+
+
+def _parallel_rows(func, indptr):
+    '''
+    Call func(slice) over contiguous ranges of rows of a CSR/CSC structure,
+    balanced by number of ratings. Each call owns its rows of the output.
+    '''
+    n_rows = indptr.size - 1
+    n_threads = _threads['n']
+    if n_threads == 1 or indptr[-1] < n_threads * BLOCK_SIZE:
+        func(slice(0, n_rows))
+        return
+    if _threads['pool'] is None:
+        _threads['pool'] = ThreadPool(n_threads)
+    bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], n_threads + 1))
+    bounds[0], bounds[-1] = 0, n_rows
+    _threads['pool'].map(func, [slice(start, end) for start, end
+                                in zip(bounds[:-1], bounds[1:])])
+
+
+class SparsityPattern(object):
+    '''
+    CSR (item-major) and CSC (user-major) index structure of the ratings
+    (rows, cols), with the permutations from (rows, cols) order. The pattern
+    does not change during fit, so it is built once and every ratio matrix
+    only swaps in a new data array. Each of the two structures is sorted out
+    on first use.
+    '''
+    def __init__(self, rows, cols, shape):
+        self.rows = rows
+        self.cols = cols
+        self.shape = shape
+        self.rows32 = np.ascontiguousarray(rows, dtype=np.int32)
+        self.cols32 = np.ascontiguousarray(cols, dtype=np.int32)
+        self._structures = dict()
+
+    def _structure(self, name):
+        if name not in self._structures:
+            if name == 'csr':
+                self._structures[name] = _index_structure(
+                    self.rows32, self.cols32, self.shape[0])
+            else:
+                self._structures[name] = _index_structure(
+                    self.cols32, self.rows32, self.shape[1])
+        return self._structures[name]
+
+    csr_order = property(lambda self: self._structure('csr')[0])
+    csr_indices = property(lambda self: self._structure('csr')[1])
+    csr_indptr = property(lambda self: self._structure('csr')[2])
+    csc_order = property(lambda self: self._structure('csc')[0])
+    csc_indices = property(lambda self: self._structure('csc')[1])
+    csc_indptr = property(lambda self: self._structure('csc')[2])
+
+    def matches(self, rows, cols):
+        return rows is self.rows and cols is self.cols
+
+    def user_ratings(self, users):
+        '''
+        Positions in (rows, cols) order of the ratings of the given users,
+        grouped by user in the order of users
+        '''
+        _, entries = _segments(self.csc_indptr, np.asarray(users))
+        return self.csc_order[entries]
+
+    def item_ratings(self, items):
+        '''
+        Positions in (rows, cols) order of the ratings of the given items,
+        grouped by item in the order of items
+        '''
+        _, entries = _segments(self.csr_indptr, np.asarray(items))
+        return self.csr_order[entries]
+
+    def users_subset(self, X_data, users):
+        '''
+        The ratings of the given users as (X_data, rows, cols, pattern), with
+        each user renumbered by its position in users
+        '''
+        users = np.asarray(users)
+        idx = self.user_ratings(users)
+        rows = self.rows32[idx]
+        counts = np.diff(self.csc_indptr)[users]
+        cols = np.repeat(np.arange(users.size, dtype=np.int32), counts)
+        pattern = SparsityPattern(rows, cols, (self.shape[0], users.size))
+        # the ratings come grouped by user, sorted by item, so they are in
+        # CSC order already
+        pattern._structures['csc'] = (np.arange(idx.size, dtype=np.int32),
+                                      rows, _indptr(counts))
+        return np.asarray(X_data)[idx], rows, cols, pattern
+
+    def items_subset(self, X_data, items):
+        '''
+        The ratings of the given items as (X_data, rows, cols, pattern), with
+        each item renumbered by its position in items
+        '''
+        items = np.asarray(items)
+        idx = self.item_ratings(items)
+        counts = np.diff(self.csr_indptr)[items]
+        rows = np.repeat(np.arange(items.size, dtype=np.int32), counts)
+        cols = self.cols32[idx]
+        pattern = SparsityPattern(rows, cols, (items.size, self.shape[1]))
+        # grouped by item, sorted by user, so in CSR order already
+        pattern._structures['csr'] = (np.arange(idx.size, dtype=np.int32),
+                                      cols, _indptr(counts))
+        return np.asarray(X_data)[idx], rows, cols, pattern
+
+    def ratio(self, values):
+        ''' n_items x n_users csr_matrix with values in (rows, cols) order '''
+        return sparse.csr_matrix((values[self.csr_order], self.csr_indices,
+                                  self.csr_indptr), shape=self.shape)
+
+    def ratioT(self, values):
+        ''' n_users x n_items csr_matrix, the transpose of ratio(values) '''
+        return sparse.csr_matrix((values[self.csc_order], self.csc_indices,
+                                  self.csc_indptr),
+                                 shape=(self.shape[1], self.shape[0]))
+
+
+def _segments(indptr, index):
+    '''
+    The positions of the entries of rows index of a CSR/CSC structure,
+    grouped by row in the order of index, and for each the position in index
+    of the row it belongs to
+    '''
+    starts = indptr[index]
+    counts = indptr[index + 1] - starts
+    owners = np.repeat(np.arange(index.size), counts)
+    return owners, np.arange(counts.sum()) + (starts - (np.cumsum(counts) -
+                                                         counts))[owners]
+
+
+def _index_structure(major, minor, n_major):
+    order = np.lexsort((minor, major)).astype(np.int32)
+    return order, minor[order], _indptr(np.bincount(major,
+                                                    minlength=n_major))
+
+
+def _indptr(counts):
+    indptr = np.zeros(len(counts) + 1, dtype=np.int32)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr
+
+
+def timings():
+    ''' Per-backend {kernel: (number of calls, total seconds)} '''
+    return dict((name, dict(t)) for name, t in _timings.items() if t)
+
+
+def reset_timings():
+    for name in _timings:
+        _timings[name] = dict()
+
+
+def log_timings():
+    for name, kernel_timings in sorted(timings().items()):
+        for kernel, (calls, seconds) in sorted(kernel_timings.items()):
+            logger.info('{} backend: {} called {} times, {:.2f} sec total'
+                        .format(name, kernel, calls, seconds))
+
+
+def _call(kernel, *args):
+    name = _backend['name']
+    start = time.time()
+    result = _backends[name][kernel](*args)
+    calls, seconds = _timings[name].get(kernel, (0, 0.))
+    _timings[name][kernel] = (calls + 1, seconds + time.time() - start)
+    return result
+
+
+def inner(beta, theta, rows, cols):
+    '''
+    For each rating i, sum_k beta[rows[i], k] * theta[k, cols[i]], in the
+    common floating dtype of beta and theta
+    '''
+    dtype = _float_dtype(beta, theta)
+    beta = _factor(beta, dtype)
+    theta = np.ascontiguousarray(theta, dtype=dtype)
+    rows = np.ascontiguousarray(rows, dtype=np.int32)
+    cols = np.ascontiguousarray(cols, dtype=np.int32)
+    data = np.empty(rows.size, dtype=dtype)
+    _call(_sparse_variant('inner', beta), beta, theta, rows, cols, data)
+    return data
+
+
+def inner2(beta1, beta2, theta, rows, cols):
+    '''
+    inner(beta1, theta, rows, cols) and inner(beta2, theta, rows, cols) in
+    one sweep, reading each theta column once for both
+    '''
+    if sparse.issparse(beta1) or sparse.issparse(beta2):
+        return (inner(beta1, theta, rows, cols),
+                inner(beta2, theta, rows, cols))
+    dtype = _float_dtype(beta1, beta2, theta)
+    beta1 = np.ascontiguousarray(beta1, dtype=dtype)
+    beta2 = np.ascontiguousarray(beta2, dtype=dtype)
+    theta = np.ascontiguousarray(theta, dtype=dtype)
+    rows = np.ascontiguousarray(rows, dtype=np.int32)
+    cols = np.ascontiguousarray(cols, dtype=np.int32)
+    data1 = np.empty(rows.size, dtype=dtype)
+    data2 = np.empty(rows.size, dtype=dtype)
+    _call('inner2', beta1, beta2, theta, rows, cols, data1, data2)
+    return data1, data2
+
+
+def ratio_dot_items(X_data, beta, theta, rows, cols, theta_acc=None,
+                    pattern=None, out=None):
+    '''
+    The ratio matrix X / (beta theta) times theta_acc.T, in one pass over the
+    ratings without building the ratio matrix. Returns an n_items x K array,
+    written into out if given. theta_acc defaults to theta. pattern is the
+    SparsityPattern of (rows, cols), if one was built.
+    '''
+    if theta_acc is None:
+        theta_acc = theta
+    dtype = _float_dtype(beta, theta, theta_acc)
+    X_data, beta, theta, theta_acc, rows, cols, pattern = _prepare(
+        dtype, X_data, beta, theta, theta_acc, rows, cols, pattern)
+    out = _output(out, (beta.shape[0], theta_acc.shape[0]), dtype)
+    _call(_sparse_variant('ratio_dot_items', beta), X_data, beta, theta,
+          rows, cols, theta_acc, pattern, out)
+    return out
+
+
+def ratio_dot_items_masked(X_data, beta, theta, rows, cols, indptr, indices,
+                           theta_acc=None, pattern=None, out=None):
+    '''
+    The entries of ratio_dot_items in a mask of (item, component) pairs,
+    given in CSR form: item d's are (d, indices[p]) for p in
+    indptr[d]..indptr[d + 1]. Returns them as an array in that order, written
+    into out if given. Only the ratings' ratios cost O(K); the accumulation
+    visits only the masked pairs.
+    '''
+    if theta_acc is None:
+        theta_acc = theta
+    dtype = _float_dtype(beta, theta, theta_acc)
+    X_data, beta, theta, theta_acc, rows, cols, pattern = _prepare(
+        dtype, X_data, beta, theta, theta_acc, rows, cols, pattern)
+    indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+    indices = np.ascontiguousarray(indices, dtype=np.int32)
+    out = _output(out, indices.shape, dtype)
+    ratio = np.empty(rows.size, dtype=dtype)
+    _call(_sparse_variant('inner', beta), beta, theta, rows, cols, ratio)
+    np.divide(X_data, ratio, out=ratio)
+    _call('masked_dot_items', ratio, theta_acc, rows, cols, indptr, indices,
+          pattern, out)
+    return out
+
+
+def ratio_dot_users(X_data, beta, theta, rows, cols, beta_acc=None,
+                    pattern=None, out=None):
+    '''
+    The transposed ratio matrix X / (beta theta) times beta_acc, transposed,
+    in one pass over the ratings. Returns a K x n_users array, written into
+    out if given. beta_acc defaults to beta. pattern is the SparsityPattern
+    of (rows, cols), if one was built.
+    '''
+    if beta_acc is None:
+        beta_acc = beta
+    dtype = _float_dtype(beta, theta, beta_acc)
+    X_data, beta, theta, beta_acc, rows, cols, pattern = _prepare(
+        dtype, X_data, beta, theta, beta_acc, rows, cols, pattern)
+    out = _output(out, (beta_acc.shape[1], theta.shape[1]), dtype)
+    _call(_sparse_variant('ratio_dot_users', beta, beta_acc), X_data, beta,
+          theta, rows, cols, beta_acc, pattern, out)
+    return out
+
+
+def ratio_dot_users2(X_data, beta1, beta2, theta, rows, cols, beta_acc1=None,
+                     beta_acc2=None, pattern=None, out1=None, out2=None):
+    '''
+    ratio_dot_users(X_data, beta1, theta, ..., beta_acc1) and
+    ratio_dot_users(X_data, beta2, theta, ..., beta_acc2) in one sweep over
+    the ratings, for models with two item factors sharing the user factor.
+    Returns both K x n_users arrays.
+    '''
+    if beta_acc1 is None:
+        beta_acc1 = beta1
+    if beta_acc2 is None:
+        beta_acc2 = beta2
+    if any(sparse.issparse(b) for b in (beta1, beta2, beta_acc1, beta_acc2)):
+        return (ratio_dot_users(X_data, beta1, theta, rows, cols,
+                                beta_acc=beta_acc1, pattern=pattern, out=out1),
+                ratio_dot_users(X_data, beta2, theta, rows, cols,
+                                beta_acc=beta_acc2, pattern=pattern, out=out2))
+    dtype = _float_dtype(beta1, beta2, theta, beta_acc1, beta_acc2)
+    X_data, beta1, theta, beta_acc1, rows, cols, pattern = _prepare(
+        dtype, X_data, beta1, theta, beta_acc1, rows, cols, pattern)
+    beta2 = np.ascontiguousarray(beta2, dtype=dtype)
+    beta_acc2 = np.ascontiguousarray(beta_acc2, dtype=dtype)
+    shape = (beta_acc1.shape[1], theta.shape[1])
+    out1, out2 = _output(out1, shape, dtype), _output(out2, shape, dtype)
+    _call('ratio_dot_users2', X_data, beta1, beta2, theta, rows, cols,
+          beta_acc1, beta_acc2, pattern, out1, out2)
+    return out1, out2
+
+
+def digamma(x, out=None):
+    '''
+    psi(x) for positive x. float32 x goes through the backend's float32
+    kernel, which is accurate to float32 precision and avoids the round
+    trip through double precision that scipy.special.psi makes. Any other
+    dtype goes to scipy.special.psi, as the kernel's series is only good to
+    about 1e-11 in float64. The result is cast into out, whatever its
+    floating dtype and layout.
+    '''
+    x = np.asarray(x)
+    if x.dtype != np.float32:
+        return special.psi(x, out=out)
+    x = np.ascontiguousarray(x)
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    if out.shape != x.shape:
+        raise ValueError('out has shape {}, x has {}'.format(out.shape,
+                                                             x.shape))
+    result = out
+    if out.dtype != np.float32 or not out.flags.c_contiguous:
+        result = np.empty(x.shape, dtype=np.float32)
+    _call('digamma', x.reshape(-1), result.reshape(-1))
+    if result is not out:
+        out[...] = result
+    return out
+
+
+def _float_dtype(*factors):
+    ''' Common floating dtype of the factors, at least float32 '''
+    return np.result_type(np.float32, *[f.dtype for f in factors])
+
+
+def _factor(beta, dtype):
+    ''' An item factor as a C-contiguous array, or canonical CSR if sparse '''
+    if not sparse.issparse(beta):
+        return np.ascontiguousarray(beta, dtype=dtype)
+    if beta.format != 'csr' or beta.dtype != dtype:
+        beta = sparse.csr_matrix(beta, dtype=dtype)
+    if not beta.has_canonical_format:
+        beta = beta.copy()
+        beta.sum_duplicates()
+    return beta
+
+
+def _csr_arrays(beta):
+    ''' (data, indices, indptr) of a canonical CSR beta, for _kernels '''
+    return (beta.data, np.ascontiguousarray(beta.indices, dtype=np.int32),
+            np.ascontiguousarray(beta.indptr, dtype=np.int32))
+
+
+def _sparse_variant(kernel, *factors):
+    ''' kernel, or its *_sparse variant when an item factor is sparse '''
+    if any(sparse.issparse(f) for f in factors):
+        return kernel + '_sparse'
+    return kernel
+
+
+def _output(out, shape, dtype):
+    ''' A zeroed output array, reusing out when the caller preallocated one '''
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    if out.shape != shape or out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError('out must be a C-contiguous {} array of shape {}, '
+                         'got {} {}'.format(np.dtype(dtype), shape,
+                                            out.dtype, out.shape))
+    out.fill(0)
+    return out
+
+
+def _prepare(dtype, X_data, beta, theta, acc, rows, cols, pattern):
+    if pattern is not None and pattern.matches(rows, cols):
+        rows, cols = pattern.rows32, pattern.cols32
+    else:
+        pattern = None
+    return (np.ascontiguousarray(X_data, dtype=dtype), _factor(beta, dtype),
+            np.ascontiguousarray(theta, dtype=dtype), _factor(acc, dtype),
+            np.ascontiguousarray(rows, dtype=np.int32),
+         np.ascontiguousarray(cols, dtype=np.int32), pattern)
+
+
+def _inner_numpy(beta, theta, rows, cols, data):
+    def chunk(idx):
+        for start in xrange(idx.start, idx.stop, BLOCK_SIZE):
+            end = min(idx.stop, start + BLOCK_SIZE)
+            data[start:end] = np.einsum('ij,ji->i', beta[rows[start:end]],
+                                        theta[:, cols[start:end]])
+    _parallel(chunk, rows.size)
+
+
+def _inner2_numpy(beta1, beta2, theta, rows, cols, data1, data2):
+    def chunk(idx):
+        for start in xrange(idx.start, idx.stop, BLOCK_SIZE):
+            end = min(idx.stop, start + BLOCK_SIZE)
+            theta_block = theta[:, cols[start:end]]
+            data1[start:end] = np.einsum('ij,ji->i', beta1[rows[start:end]],
+                                         theta_block)
+            data2[start:end] = np.einsum('ij,ji->i', beta2[rows[start:end]],
+                                         theta_block)
+    _parallel(chunk, rows.size)
+
+
+def _inner_sparse_numpy(beta, theta, rows, cols, data):
+    # one term per stored entry of each rating's item row, instead of K
+    def chunk(idx):
+        for start in xrange(idx.start, idx.stop, BLOCK_SIZE):
+            end = min(idx.stop, start + BLOCK_SIZE)
+            owners, entries = _segments(beta.indptr, rows[start:end])
+            data[start:end] = np.bincount(
+                owners, weights=beta.data[entries] *
+                theta[beta.indices[entries], cols[start:end][owners]],
+                minlength=end - start)
+    _parallel(chunk, rows.size)
+
+
+def _ratio_numpy(X_data, beta, theta, rows, cols):
+    ratio = np.empty(rows.size, dtype=beta.dtype)
+    if sparse.issparse(beta):
+        _inner_sparse_numpy(beta, theta, rows, cols, ratio)
+    else:
+        _inner_numpy(beta, theta, rows, cols, ratio)
+    np.divide(X_data, ratio, out=ratio)
+    return ratio
+
+
+def _ratio_dot_items_numpy(X_data, beta, theta, rows, cols, theta_acc,
+                           pattern, out):
+    ratio = _ratio_numpy(X_data, beta, theta, rows, cols)
+    if pattern is not None:
+        out[:] = pattern.ratio(ratio).dot(theta_acc.T)
+        return
+    for k in xrange(out.shape[1]):
+        out[:, k] = np.bincount(rows, weights=ratio * theta_acc[k, cols],
+                                minlength=out.shape[0])
+
+
+def _ratio_dot_users_numpy(X_data, beta, theta, rows, cols, beta_acc,
+                           pattern, out):
+    ratio = _ratio_numpy(X_data, beta, theta, rows, cols)
+    if sparse.issparse(beta_acc):
+        if pattern is not None:
+            ratio = pattern.ratio(ratio)
+        else:
+            ratio = sparse.csr_matrix((ratio, (rows, cols)),
+                                      shape=(beta_acc.shape[0], out.shape[1]))
+        out[:] = beta_acc.T.dot(ratio).toarray()
+        return
+    if pattern is not None:
+        out[:] = pattern.ratioT(ratio).dot(beta_acc).T
+        return
+    for k in xrange(out.shape[0]):
+        out[k] = np.bincount(cols, weights=ratio * beta_acc[rows, k],
+                             minlength=out.shape[1])
+
+
+def _masked_dot_items_numpy(ratio, theta_acc, rows, cols, indptr, indices,
+                            pattern, out):
+    # ratings in item order, so that each block adds into a contiguous range
+    # of out, one term per (rating, masked component of its item) pair
+    if pattern is not None:
+        order = pattern.csr_order
+    else:
+        order = np.argsort(rows, kind='mergesort')
+    for start in xrange(0, order.size, BLOCK_SIZE):
+        block = order[start:start + BLOCK_SIZE]
+        block_rows = rows[block]
+        owners, entries = _segments(indptr, block_rows)
+        lo, hi = indptr[block_rows[0]], indptr[block_rows[-1] + 1]
+        out[lo:hi] += np.bincount(
+            entries - lo, weights=ratio[block][owners] *
+            theta_acc[indices[entries], cols[block][owners]],
+            minlength=hi - lo)
+
+
+def _digamma_numpy(x, out):
+    # a vectorized series is no faster than scipy's psi under numpy, so the
+    # fallback only splits scipy's psi across the threads
+    def chunk(idx):
+        special.psi(x[idx], out=out[idx])
+    _parallel(chunk, x.size)
+
+
+def _ratio_dot_users2_numpy(X_data, beta1, beta2, theta, rows, cols,
+                            beta_acc1, beta_acc2, pattern, out1, out2):
+    ratio1 = np.empty(rows.size, dtype=beta1.dtype)
+    ratio2 = np.empty(rows.size, dtype=beta1.dtype)
+    _inner2_numpy(beta1, beta2, theta, rows, cols, ratio1, ratio2)
+    np.divide(X_data, ratio1, out=ratio1)
+    np.divide(X_data, ratio2, out=ratio2)
+    for ratio, beta_acc, out in ((ratio1, beta_acc1, out1),
+                                 (ratio2, beta_acc2, out2)):
+        if pattern is not None:
+            out[:] = pattern.ratioT(ratio).dot(beta_acc).T
+            continue
+        for k in xrange(out.shape[0]):
+            out[k] = np.bincount(cols, weights=ratio * beta_acc[rows, k],
+                                 minlength=out.shape[1])
+
+
+def _inner_compiled(beta, theta, rows, cols, data):
+    def chunk(idx):
+        _kernels.inner(beta, theta, rows[idx], cols[idx], data[idx])
+    _parallel(chunk, rows.size)
+
+
+def _digamma_compiled(x, out):
+    def chunk(idx):
+        _kernels.digamma(x[idx], out[idx])
+    _parallel(chunk, x.size)
+
+
+def _inner2_compiled(beta1, beta2, theta, rows, cols, data1, data2):
+    def chunk(idx):
+        _kernels.inner2(beta1, beta2, theta, rows[idx], cols[idx],
+                        data1[idx], data2[idx])
+    _parallel(chunk, rows.size)
+
+
+def _ratio_dot_items_compiled(X_data, beta, theta, rows, cols, theta_acc,
+                              pattern, out):
+    if pattern is None:
+        _kernels.ratio_dot_items(X_data, beta, theta, rows, cols, theta_acc,
+                                 out)
+        return
+    def chunk(idx):
+        _kernels.ratio_dot_items_csr(X_data, beta, theta, cols,
+                                     pattern.csr_order, pattern.csr_indptr,
+                                     theta_acc, out, idx.start, idx.stop)
+    _parallel_rows(chunk, pattern.csr_indptr)
+
+
+def _ratio_dot_users_compiled(X_data, beta, theta, rows, cols, beta_acc,
+                              pattern, out):
+    if pattern is None:
+        _kernels.ratio_dot_users(X_data, beta, theta, rows, cols, beta_acc,
+                                 out)
+        return
+    def chunk(idx):
+        _kernels.ratio_dot_users_csc(X_data, beta, theta, rows,
+                                     pattern.csc_order, pattern.csc_indptr,
+                                     beta_acc, out, idx.start, idx.stop)
+    _parallel_rows(chunk, pattern.csc_indptr)
+
+
+def _ratio_dot_users2_compiled(X_data, beta1, beta2, theta, rows, cols,
+                               beta_acc1, beta_acc2, pattern, out1, out2):
+    if pattern is None:
+        _kernels.ratio_dot_users2(X_data, beta1, beta2, theta, rows, cols,
+                                  beta_acc1, beta_acc2, out1, out2)
+        return
+    def chunk(idx):
+        _kernels.ratio_dot_users2_csc(X_data, beta1, beta2, theta, rows,
+                                      pattern.csc_order, pattern.csc_indptr,
+                                      beta_acc1, beta_acc2, out1, out2,
+                                      idx.start, idx.stop)
+    _parallel_rows(chunk, pattern.csc_indptr)
+
+
+def _masked_dot_items_compiled(ratio, theta_acc, rows, cols, indptr, indices,
+                               pattern, out):
+    if pattern is None:
+        _kernels.masked_dot_items(ratio, theta_acc, rows, cols, indptr,
+                                  indices, out)
+        return
+    def chunk(idx):
+        _kernels.masked_dot_items_csr(ratio, theta_acc, cols,
+                                      pattern.csr_order, pattern.csr_indptr,
+                                      indptr, indices, out, idx.start,
+                                      idx.stop)
+    _parallel_rows(chunk, pattern.csr_indptr)
+
+
+def _inner_sparse_compiled(beta, theta, rows, cols, data):
+    b_data, b_indices, b_indptr = _csr_arrays(beta)
+    def chunk(idx):
+        _kernels.inner_sparse(b_data, b_indices, b_indptr, theta, rows[idx],
+                              cols[idx], data[idx])
+    _parallel(chunk, rows.size)
+
+
+def _ratio_dot_items_sparse_compiled(X_data, beta, theta, rows, cols,
+                                     theta_acc, pattern, out):
+    if pattern is None:
+        _ratio_dot_items_numpy(X_data, beta, theta, rows, cols, theta_acc,
+                               pattern, out)
+        return
+    b_data, b_indices, b_indptr = _csr_arrays(beta)
+    def chunk(idx):
+        _kernels.ratio_dot_items_sparse_csr(
+            X_data, b_data, b_indices, b_indptr, theta, cols,
+            pattern.csr_order, pattern.csr_indptr, theta_acc, out,
+            idx.start, idx.stop)
+    _parallel_rows(chunk, pattern.csr_indptr)
+
+
+def _ratio_dot_users_sparse_compiled(X_data, beta, theta, rows, cols,
+                                     beta_acc, pattern, out):
+    if not (sparse.issparse(beta) and sparse.issparse(beta_acc)):
+        # a dense factor next to a sparse one is left to scipy
+        _ratio_dot_users_numpy(X_data, beta, theta, rows, cols, beta_acc,
+                               pattern, out)
+        return
+    b_data, b_indices, b_indptr = _csr_arrays(beta)
+    a_data, a_indices, a_indptr = _csr_arrays(beta_acc)
+    if pattern is None:
+        _kernels.ratio_dot_users_sparse(X_data, b_data, b_indices, b_indptr,
+                                        theta, rows, cols, a_data, a_indices,
+                                        a_indptr, out)
+        return
+    def chunk(idx):
+        _kernels.ratio_dot_users_sparse_csc(
+            X_data, b_data, b_indices, b_indptr, theta, rows,
+            pattern.csc_order, pattern.csc_indptr, a_data, a_indices,
+            a_indptr, out, idx.start, idx.stop)
+    _parallel_rows(chunk, pattern.csc_indptr)
+
+
+register_backend('numpy', inner=_inner_numpy, inner2=_inner2_numpy,
+                 ratio_dot_items=_ratio_dot_items_numpy,
+                 ratio_dot_users=_ratio_dot_users_numpy,
+                 ratio_dot_users2=_ratio_dot_users2_numpy,
+                 digamma=_digamma_numpy,
+                 inner_sparse=_inner_sparse_numpy,
+                 ratio_dot_items_sparse=_ratio_dot_items_numpy,
+                 ratio_dot_users_sparse=_ratio_dot_users_numpy,
+                 masked_dot_items=_masked_dot_items_numpy)
+if _kernels is not None:
+    register_backend('compiled', inner=_inner_compiled,
+                     inner2=_inner2_compiled,
+                     ratio_dot_items=_ratio_dot_items_compiled,
+                     ratio_dot_users=_ratio_dot_users_compiled,
+                     ratio_dot_users2=_ratio_dot_users2_compiled,
+                     digamma=_digamma_compiled,
+                     inner_sparse=_inner_sparse_compiled,
+                     ratio_dot_items_sparse=_ratio_dot_items_sparse_compiled,
+                     ratio_dot_users_sparse=_ratio_dot_users_sparse_compiled,
+                     masked_dot_items=_masked_dot_items_compiled)
+    set_backend('compiled')
+else:
+    logger.warning('_kernels extension not built, falling back to numpy '
+                   'kernels. run `python setup.py build_ext --inplace`')
+    set_backend('numpy')
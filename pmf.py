@@ -7,16 +7,26 @@ CREATED: 2014-03-25 02:06:52 by Dawen Liang <dliang@ee.columbia.edu>
 """
 import logging
 import numpy as np
-from scipy import sparse, special, weave
 
 from sklearn.base import BaseEstimator, TransformerMixin
 
+import kernels
+import variational
+
 
 class PoissonMF(BaseEstimator, TransformerMixin):
     ''' Poisson matrix factorization with batch inference '''
+    # the variational state written to a checkpoint
+    _checkpoint_names = ('gamma_b', 'rho_b', 'Eb', 'Elogb',
+                         'gamma_t', 'rho_t', 'Et', 'Elogt')
+
     def __init__(self, n_components=100, max_iter=100, min_iter=1, tol=0.0001,
                  smoothness=100, random_state=None, verbose=False,
-                 items_init_scale=1, **kwargs):
+                 dtype=np.float32, eval_schedule=None, snapshot_memory=None,
+                 checkpoint=None, inference='batch', batch_size=1000,
+                 learning_offset=10., learning_decay=0.7, local_iter=10,
+                 items_init_scale=1, active_tol=None, sweep_every=10,
+                 accelerate=None, init='random', **kwargs):
         ''' Poisson matrix factorization
 
         Arguments
@@ -43,10 +53,63 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         verbose : bool
             Whether to show progress during model fitting
 
+        dtype : numpy dtype
+            Floating point type of every variational parameter. Updates that
+            would silently promote away from it raise a TypeError
+
+        eval_schedule : variational.EvalSchedule
+            When fit scores the validation and training sets, by default the
+            full validation set on every iteration
+
+        snapshot_memory : int or None
+            Bytes of memory the best-iterate snapshots may use; larger ones
+            go to temporary files on disk. None keeps them in memory
+
+        checkpoint : checkpoint.Checkpoint or None
+            Where fit periodically writes its full state, and resumes from
+
+        inference : 'batch' or 'svi'
+            Batch coordinate ascent over all ratings, or stochastic
+            variational inference over minibatches of users. An iteration of
+            svi is one pass over the users
+
+        batch_size : int
+            Number of users per svi minibatch
+
+        learning_offset, learning_decay : float
+            The svi step size for minibatch t is
+            (learning_offset + t) ** -learning_decay, with learning_decay in
+            (0.5, 1] for the steps to satisfy the Robbins-Monro conditions
+
+        local_iter : int
+            Number of user factor updates per svi minibatch
+
+        active_tol : float or None
+            If given, batch inference of the unobserved model updates only
+            the users and items whose E[theta]/E[beta] changed by at least
+            this (relative to their total) when last updated, see
+            variational.ActiveSet. None updates all of them every iteration
+
+        sweep_every : int
+            With active_tol, every this many iterations all users and items
+            are updated, re-admitting frozen ones that drifted
+
+        accelerate : None or 'squarem'
+            Extrapolate the item factors every third batch iteration
+            from the two before it with variational.Squarem, keeping only
+            jumps that score at least as well on the validation set (which
+            is scored for that even with evaluation off)
+
+        init : 'random', 'subsample', 'svd' or 'categories'
+            Starting values of the unobserved factors, the random draws or
+            ones computed from the ratings, see variational.init_factors
+
         **kwargs: dict
             Model hyperparameters
         '''
         self.logger = logging.getLogger(__name__)
+        self.exp_cache = variational.ExpCache(self)
+        self.workspace = variational.Workspace(dtype)
 
         self.n_components = n_components
         self.max_iter = max_iter
@@ -56,6 +119,21 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.items_init_scale = items_init_scale
         self.random_state = random_state
         self.verbose = verbose
+        self.dtype = dtype
+        if eval_schedule is None:
+            eval_schedule = variational.EvalSchedule()
+        self.eval_schedule = eval_schedule
+        self.snapshot_memory = snapshot_memory
+        self.checkpoint = checkpoint
+        self.inference = inference
+        self.batch_size = batch_size
+        self.learning_offset = learning_offset
+        self.learning_decay = learning_decay
+        self.local_iter = local_iter
+        self.active_tol = active_tol
+        self.sweep_every = sweep_every
+        self.accelerate = accelerate
+        self.init = init
         self.max_iter_fixed = 10 # max number of times to switch between fixed user udpates and fixed item updates
 
         if type(self.random_state) is int:
@@ -74,7 +152,7 @@ class PoissonMF(BaseEstimator, TransformerMixin):
     def _init_users(self, n_users, theta=False):
         if type(theta) == np.ndarray:
             self.logger.info('initializing theta to be the observed one')
-            self.Et = theta
+            self.Et = np.asarray(theta, dtype=self.dtype)
             self.Elogt = None
             self.gamma_t = None
             self.rho_t = None
@@ -83,18 +161,19 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_t = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(self.n_components, n_users)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_t = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(self.n_components, n_users)
-                                ).astype(np.float32)
-            self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+                                ).astype(self.dtype)
+            self.Et, self.Elogt = _compute_expectations(
+                self.gamma_t, self.rho_t, self.dtype)
 
     def _init_items(self, n_items, beta=False, categorywise=False):
         # if we pass in observed betas:
-        if type(beta) == np.ndarray and not categorywise:
+        if variational.observed(beta) and not categorywise:
             self.logger.info('initializing beta to be the observed one')
-            self.Eb = beta
+            self.Eb = variational.observed_factor(beta, self.dtype)
             self.Elogb = None
             self.gamma_b = None
             self.rho_b = None
@@ -104,12 +183,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_b = self.items_init_scale * self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_b = self.items_init_scale * self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
-            self.Eb, self.Elogb = _compute_expectations(self.gamma_b, self.rho_b)
+                                ).astype(self.dtype)
+            self.Eb, self.Elogb = _compute_expectations(
+                self.gamma_b, self.rho_b, self.dtype)
 
     def fit(self, X, rows, cols, vad,
         beta=False, theta=False, categorywise=False, item_fit_type='default',
@@ -127,16 +207,59 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self: object
             Returns the instance itself.
         '''
+        if self.inference not in ('batch', 'svi'):
+            raise ValueError('unknown inference {}, use batch or svi'.format(
+                self.inference))
+        if self.inference == 'svi' and (
+                variational.observed(beta) or type(theta) == np.ndarray or
+                user_fit_type != 'default'):
+            raise ValueError('svi fits the unobserved model only, without '
+                             'beta, theta or a user_fit_type')
+        if self.active_tol is not None and (
+                self.inference != 'batch' or variational.observed(beta) or
+                type(theta) == np.ndarray or categorywise or
+                user_fit_type != 'default'):
+            raise ValueError('active_tol is for batch inference of the '
+                             'unobserved model only, without beta, theta, '
+                             'categorywise or a user_fit_type')
+        variational.check_accelerate(self.accelerate)
+        if self.accelerate is not None and self.inference != 'batch':
+            raise ValueError('accelerate is for batch inference only')
+        variational.check_init(self.init)
+        if self.inference == 'svi' and not 0.5 < self.learning_decay <= 1:
+            raise ValueError('learning_decay must be in (0.5, 1], got {}'
+                             .format(self.learning_decay))
+        if self.inference == 'svi' and self.local_iter < 1:
+            raise ValueError('local_iter must be at least 1, got {}'
+                             .format(self.local_iter))
         n_items, n_users = X.shape
+        self._pattern = kernels.SparsityPattern(rows, cols, X.shape)
         self.n_users = n_users
         if type(theta) == np.ndarray:
             observed_user_preferences = True
 
         self._init_items(n_items, beta=beta, categorywise=categorywise)
         self._init_users(n_users, theta=theta)
-        if user_fit_type != 'default':
-            best_validation_ll = -np.inf
-            for switch_idx in xrange(self.max_iter_fixed):
+        self._categories = None
+        if variational.observed(beta) and categorywise:
+            self._categories = variational.CategoryMask(beta)
+        resume = []
+        if self.checkpoint is not None:
+            resume = self.checkpoint.load(self)
+        if not resume:
+            # a resumed fit has its factors from the checkpoint
+            variational.init_factors(self, X, beta=beta)
+        if self.inference == 'svi':
+            self._frames = [dict()]
+            self._update_svi(X, rows, cols, vad, resume=resume[1:])
+        elif user_fit_type != 'default':
+            best = variational.Snapshot(['Eb', 'Et'],
+                                        max_memory=self.snapshot_memory)
+            first_switch = 0
+            if resume:
+                first_switch = resume[0]['switch_idx']
+                best.load(resume[0]['best'])
+            for switch_idx in xrange(first_switch, self.max_iter_fixed):
                 if user_fit_type == 'converge_separately':
                     if switch_idx % 2 == 0:
                         only_update = 'items'
@@ -149,7 +272,8 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                         initialize_users = 'none'
                 self.logger.info('=> only updating {}, switch number {}'
                     .format(only_update, switch_idx))
-                validation_ll, best_pll_dict = self._update(X, rows, cols, vad, beta=beta,
+                self._frames = [dict(switch_idx=switch_idx, best=best)]
+                validation_ll, stage_best = self._update(X, rows, cols, vad, beta=beta,
                     theta=theta,
                     observed_user_preferences=observed_user_preferences,
                     categorywise=categorywise,
@@ -157,65 +281,78 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                     item_fit_type=item_fit_type,
                     initialize_users = initialize_users,
                     zero_untrained_components=zero_untrained_components,
-                    only_update=only_update)
+                    only_update=only_update,
+                    resume=resume[1:])
+                resume = []
                 # set to best run
-                new_validation_ll = best_pll_dict['pred_ll']
                 self.logger.info('set params to best pll {}, old one was {}'
-                    .format(new_validation_ll, validation_ll))
-                validation_ll = new_validation_ll
-                self.Eb = best_pll_dict['best_Eb']
-                self.Et = best_pll_dict['best_Et']
-                self.Elogb = best_pll_dict['best_Elogb']
-                self.Elogt = best_pll_dict['best_Elogt']
-                if validation_ll > best_validation_ll:
-                    best_Eb = self.Eb
-                    # print best_Eb
-                    # print '^Eb'
-                    best_Et = self.Et
-                    # print best_Et
-                    # print '^Et'
-                    # best_self = self
-                    best_validation_ll = validation_ll
-            # self = best_self
-            self.logger.info('best validation ll was {}'.format(best_validation_ll))
-            self.Eb = best_Eb
-            self.Et = best_Et
+                    .format(stage_best.score, validation_ll))
+                stage_best.restore(self)
+                best.offer(self, stage_best.score)
+            self.logger.info('best validation ll was {}'.format(best.score))
+            best.restore(self)
         else:
+            self._frames = [dict()]
             _, _ = self._update(X, rows, cols, vad, beta=beta,
                                 categorywise=categorywise,
                                 user_fit_type=user_fit_type,
                                 item_fit_type=item_fit_type,
-                                zero_untrained_components=zero_untrained_components)
+                                zero_untrained_components=zero_untrained_components,
+                                resume=resume[1:])
+        self.exp_cache.log_stats()
+        self.workspace.log_stats()
         return self
 
-    #def transform(self, X, attr=None):
-    #    '''Encode the data as a linear combination of the latent components.
-
-    #    Parameters
-    #    ----------
-    #    X : array-like, shape (n_samples, n_feats)
-
-    #    attr: string
-    #        The name of attribute, default 'Eb'. Can be changed to Elogb to
-    #        obtain E_q[log beta] as transformed data.
-
-    #    Returns
-    #    -------
-    #    X_new : array-like, shape(n_samples, n_filters)
-    #        Transformed data, as specified by attr.
-    #    '''
-
-    #    if not hasattr(self, 'Eb'):
-    #        raise ValueError('There are no pre-trained components.')
-    #    n_samples, n_feats = X.shape
-    #    if n_feats != self.Eb.shape[1]:
-    #        raise ValueError('The dimension of the transformed data '
-    #                         'does not match with the existing components.')
-    #    if attr is None:
-    #        attr = 'Et'
-    #    self._init_weights(n_samples)
-    #    self._update(X, update_beta=False)
-    #    return getattr(self, attr)
+    def transform(self, X):
+        '''Encode unseen users by their preferences, see fold_in_users.
+
+        Parameters
+        ----------
+        X : sparse matrix, shape (n_items, n_users)
+            Ratings of the users, over the items the model was fit on.
+
+        Returns
+        -------
+        X_new : array-like, shape (n_users, n_components)
+            E[theta] of the users.
+        '''
+        return self.fold_in_users(X).T
+
+    def fold_in_users(self, X, max_iter=100, tol=1e-4, batch_size=None):
+        '''
+        E[theta] (n_components x n_users, like Et) of users unseen in fit
+        with ratings X (sparse, n_items x n_users), from user-only updates
+        against the frozen item factors. The fitted model is not modified.
+        Users are updated together, batch_size at a time, until the mean
+        relative change of E[theta] drops below tol.
+        '''
+        return variational.fold_in_users(self, X, max_iter=max_iter, tol=tol,
+                                         batch_size=batch_size)
+
+    def _fold_in(self, X_data, rows, cols, n_users, max_iter, tol):
+        pattern = kernels.SparsityPattern(rows, cols,
+                                          (self.Eb.shape[0], n_users))
+        if self.Elogb is None:
+            # beta was observed
+            beta_x = self.Eb
+        else:
+            beta_x = self.exp_cache.get('Elogb')
+        rho_t = self.b + variational.factor_sums(self.Eb)
+        # start every user from the prior shape
+        Et, Elogt = _compute_expectations(
+            np.full((self.n_components, n_users), self.a, dtype=self.dtype),
+            rho_t, self.dtype)
+        for _ in xrange(max_iter):
+            expElogt = np.exp(Elogt)
+            gamma_t = kernels.ratio_dot_users(X_data, beta_x, expElogt, rows,
+                                              cols, pattern=pattern)
+            gamma_t *= expElogt
+            gamma_t += self.a
+            Et_old = Et
+            Et, Elogt = _compute_expectations(gamma_t, rho_t, self.dtype)
+            if variational.converged(Et, Et_old, tol):
+                break
+        return Et
 
     def _update(self, X, rows, cols, vad, beta=False,
         theta=False,
@@ -226,183 +363,422 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         update='default',
         zero_untrained_components=False,
         initialize_users='none',
-        only_update=None):
+        only_update=None,
+        resume=()):
         # alternating between update latent components and weights
-        old_pll = -np.inf
-        best_pll_dict = dict(pred_ll = -np.inf)
-        for i in xrange(self.max_iter):
-            # if user prefs observed, do nothing
-            if (only_update == 'items' or observed_user_preferences and
-                update != 'default'):
-                pass
-            elif (only_update == 'users'):
-                if initialize_users == 'default':
-                    if i == 0:
-                        self.logger.info('initializing default users')
-                        self._init_users(self.n_users)
-                    self._update_users(X, rows, cols, beta=False,
-                        observed_user_preferences=False,
-                        only_update=only_update)
-                elif initialize_users == 'trained':
-                    if i == 0:
-                        self.logger.info('updating users with trained prefs')
-                        self._update_users(X, rows, cols, beta=beta,
-                            theta=theta,
-                            observed_user_preferences=True,
-                            observed_item_attributes=False,
+        old_pll = pred_ll = -np.inf
+        best = variational.Snapshot(['Eb', 'Elogb', 'Et', 'Elogt'],
+                                    max_memory=self.snapshot_memory)
+        # this stage's position, as written to a checkpoint
+        frame = dict(update=update, best=best, initial=dict())
+        active = None
+        if self.active_tol is not None:
+            active = dict(
+                users=variational.ActiveSet(X.shape[1], self.active_tol,
+                                            self.sweep_every),
+                items=variational.ActiveSet(X.shape[0], self.active_tol,
+                                            self.sweep_every))
+            frame['active'] = dict()
+        squarem = None
+        if self.accelerate == 'squarem':
+            squarem = variational.Squarem(
+                ['b'],
+                lambda model: self.eval_schedule.score(model, **vad))
+            frame['squarem'] = squarem
+        start, converged = 0, False
+        if resume:
+            state, resume = resume[0], resume[1:]
+            start, old_pll, pred_ll = (state['iteration'], state['old_pll'],
+                                       state['pred_ll'])
+            best.load(state['best'])
+            frame['initial'] = state['initial']
+            if active is not None:
+                for name, rows_active in state.get('active', dict()).items():
+                    active[name].rows = rows_active
+            if squarem is not None:
+                squarem.load(state['squarem'])
+            # more frames mean the checkpoint was written in the stage this
+            # one converged into
+            converged = bool(resume)
+        self._frames.append(frame)
+        for i in xrange(start, self.max_iter):
+            if converged:
+                break
+            if (i > start and self.checkpoint is not None and
+                    self.checkpoint.due(i)):
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll)
+                if active is not None:
+                    frame['active'] = dict((name, a.rows)
+                                           for name, a in active.items())
+                self.checkpoint.save(self, self._frames)
+            for _ in variational.steps(squarem, self):
+                # if user prefs observed, do nothing
+                if (only_update == 'items' or observed_user_preferences and
+                    update != 'default'):
+                    pass
+                elif (only_update == 'users'):
+                    if initialize_users == 'default':
+                        if i == 0:
+                            self.logger.info('initializing default users')
+                            self._init_users(self.n_users)
+                        self._update_users(X, rows, cols, beta=False,
+                            observed_user_preferences=False,
                             only_update=only_update)
-                    if i > 0:
-                        self._update_users(X, rows, cols, beta=beta,
-                            theta=theta,
+                    elif initialize_users == 'trained':
+                        if i == 0:
+                            self.logger.info('updating users with trained prefs')
+                            self._update_users(X, rows, cols, beta=beta,
+                                theta=theta,
+                                observed_user_preferences=True,
+                                observed_item_attributes=False,
+                                only_update=only_update)
+                        if i > 0:
+                            self._update_users(X, rows, cols, beta=beta,
+                                theta=theta,
+                                observed_user_preferences=False,
+                                observed_item_attributes=False,
+                                only_update=only_update)
+                    elif initialize_users == 'none':
+                        self._update_users(X, rows, cols, beta=False,
                             observed_user_preferences=False,
-                            observed_item_attributes=False,
                             only_update=only_update)
-                elif initialize_users == 'none':
-                    self._update_users(X, rows, cols, beta=False,
-                        observed_user_preferences=False,
-                        only_update=only_update)
-            else:
-                self._update_users(X, rows, cols, beta=beta)
-
-            if (type(beta) == np.ndarray and not categorywise or
-                update == 'users' or only_update == 'users'):
-                # do nothing if we have observed betas or are only updating users
-                pass
-            elif item_fit_type != 'default':
-                if zero_untrained_components and i == 0 and update == 'default':
-                    # store the initial values somewhere, then zero them out,
-                    # then load them back in once they've been fit
-                    beta_bool = beta.astype(bool)
-                    beta_bool_not = np.logical_not(beta_bool)
-                    small_num = 1e-5
-                    if item_fit_type == 'converge_in_category_first':
-                        # zero out out_category components
-                        gamma_b_out_category = self.gamma_b[beta_bool_not]
-                        rho_b_out_category = self.rho_b[beta_bool_not]
-                        self.gamma_b[beta_bool_not] = small_num
-                        self.rho_b[beta_bool_not] = small_num
-                    elif item_fit_type == 'converge_out_category_first':
-                        # zero out in_category components
-                        gamma_b_in_category = self.gamma_b[beta_bool]
-                        rho_b_in_category = self.rho_b[beta_bool]
-                        self.gamma_b[beta_bool] = small_num
-                        self.rho_b[beta_bool] = small_num
-                if (type(beta) == np.ndarray and categorywise and
-                    item_fit_type == 'alternating_updates'):
-                    # alternate between updating in-category and out-category components of items
-                    if i % 2 == 0:
-                        self._update_items(X, rows, cols, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, iteration=i,
-                            update='in_category')
-                    else:
-                        self._update_items(X, rows, cols, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, iteration=i,
-                            update='out_category')
-                elif (type(beta) == np.ndarray and categorywise and
-                    item_fit_type == 'converge_in_category_first'):
-                    # first update in-category components
-                    if update == 'default':
-                        self._update_items(X, rows, cols, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, update='in_category')
-                    else:
-                        self._update_items(X, rows, cols, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, update=update)
-                elif (type(beta) == np.ndarray and categorywise and
-                    item_fit_type == 'converge_out_category_first'):
-                    # first update out-category components
-                    if update == 'default':
-                        self._update_items(X, rows, cols, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, update='out_category')
-                    else:
-                        self._update_items(X, rows, cols, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, update=update)
-            else:
-                self._update_items(X, rows, cols)
-            pred_ll = self.pred_loglikeli(**vad)
+                elif active is not None:
+                    self._update_users_active(X, active['users'], i)
+                else:
+                    self._update_users(X, rows, cols, beta=beta)
+
+                if (variational.observed(beta) and not categorywise or
+                    update == 'users' or only_update == 'users'):
+                    # do nothing if we have observed betas or are only updating users
+                    pass
+                elif item_fit_type != 'default':
+                    if zero_untrained_components and i == 0 and update == 'default':
+                        # store the initial values somewhere, then zero them out,
+                        # then load them back in once they've been fit
+                        categories = self._categories
+                        small_num = 1e-5
+                        if item_fit_type == 'converge_in_category_first':
+                            # zero out out_category components
+                            frame['initial'] = dict(
+                                gamma_b=categories.take(self.gamma_b, False),
+                                rho_b=categories.take(self.rho_b, False))
+                            categories.put(self.gamma_b, small_num, False)
+                            categories.put(self.rho_b, small_num, False)
+                            # their expectations are recomputed by the first in-category update
+                            categories.stale = True
+                        elif item_fit_type == 'converge_out_category_first':
+                            # zero out in_category components
+                            frame['initial'] = dict(
+                                gamma_b=categories.take(self.gamma_b),
+                                rho_b=categories.take(self.rho_b))
+                            categories.put(self.gamma_b, small_num)
+                            categories.put(self.rho_b, small_num)
+                    if (variational.observed(beta) and categorywise and
+                        item_fit_type == 'alternating_updates'):
+                        # alternate between updating in-category and out-category components of items
+                        if i % 2 == 0:
+                            self._update_items(X, rows, cols, beta=beta,
+                                observed_user_preferences=observed_user_preferences,
+                                categorywise=categorywise, iteration=i,
+                                update='in_category')
+                        else:
+                            self._update_items(X, rows, cols, beta=beta,
+                                observed_user_preferences=observed_user_preferences,
+                                categorywise=categorywise, iteration=i,
+                                update='out_category')
+                    elif (variational.observed(beta) and categorywise and
+                        item_fit_type == 'converge_in_category_first'):
+                        # first update in-category components
+                        if update == 'default':
+                            self._update_items(X, rows, cols, beta=beta,
+                                observed_user_preferences=observed_user_preferences,
+                                categorywise=categorywise, update='in_category')
+                        else:
+                            self._update_items(X, rows, cols, beta=beta,
+                                observed_user_preferences=observed_user_preferences,
+                                categorywise=categorywise, update=update)
+                    elif (variational.observed(beta) and categorywise and
+                        item_fit_type == 'converge_out_category_first'):
+                        # first update out-category components
+                        if update == 'default':
+                            self._update_items(X, rows, cols, beta=beta,
+                                observed_user_preferences=observed_user_preferences,
+                                categorywise=categorywise, update='out_category')
+                        else:
+                            self._update_items(X, rows, cols, beta=beta,
+                                observed_user_preferences=observed_user_preferences,
+                                categorywise=categorywise, update=update)
+                elif active is not None:
+                    self._update_items_active(X, active['items'], i)
+                else:
+                    self._update_items(X, rows, cols)
+            if not self.eval_schedule.due(i):
+                continue
+            pred_ll = self.eval_schedule.score(self, **vad)
             if np.isnan(pred_ll):
                 self.logger.error('got nan in predictive ll')
                 raise Exception('nan in predictive ll')
             else:
-                if pred_ll > best_pll_dict['pred_ll']:
-                    best_pll_dict['pred_ll'] = pred_ll
+                if best.offer(self, pred_ll):
                     self.logger.info('logged new best pred_ll as {}'
                         .format(pred_ll))
-                    best_pll_dict['best_Eb'] = self.Eb
-                    best_pll_dict['best_Elogb'] = self.Elogb
-                    best_pll_dict['best_Et'] = self.Et
-                    best_pll_dict['best_Elogt'] = self.Elogt
-            improvement = (pred_ll - old_pll) / abs(old_pll)
+            if squarem is None:
+                improvement = (pred_ll - old_pll) / abs(old_pll)
+            else:
+                # the jumps may lower the score on the way to a higher one
+                improvement = squarem.improvement(pred_ll)
             if self.verbose:
                 string = 'ITERATION: %d\tPred_ll: %.2f\tOld Pred_ll: %.2f\t Improvement: %.5f' % (i, pred_ll, old_pll, improvement)
                 self.logger.info(string)
             if improvement < self.tol and i > self.min_iter:
-                if update == 'default' and item_fit_type != 'default':
-                    if item_fit_type == 'converge_in_category_first':
-                        # we converged in-category. now converge out_category
-                        if zero_untrained_components:
-                            self.logger.info(
-                                're-load initial values for out_category')
-                            self.gamma_b[beta_bool_not] = gamma_b_out_category
-                            self.rho_b[beta_bool_not] = rho_b_out_category
-                        self._update(X, rows, cols, vad, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, item_fit_type=item_fit_type,
-                            update='out_category')
-                    if item_fit_type == 'converge_out_category_first':
-                        # we converged out-category. now converge in_category
-                        if zero_untrained_components:
-                            self.logger.info(
-                                're-load initial values for in_category')
-                            self.gamma_b[beta_bool] = gamma_b_in_category
-                            self.rho_b[beta_bool] = rho_b_in_category
-                        self._update(X, rows, cols, vad, beta=beta,
-                            observed_user_preferences=observed_user_preferences,
-                            categorywise=categorywise, item_fit_type=item_fit_type,
-                            update='in_category')
-                    # if user_fit_type == 'converge_separately':
-                    #     self._update(X, rows, cols, vad, beta=beta,
-                    #         observed_user_preferences=observed_user_preferences,
-                    #         user_fit_type=user_fit_type,
-                    #         categorywise=categorywise,
-                    #         item_fit_type=item_fit_type)
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll)
+                converged = True
+                break
+            old_pll = pred_ll
+        if converged and update == 'default' and item_fit_type != 'default':
+            # the zeroed-out initial values are re-loaded (once, a resumed
+            # sub-stage has them already)
+            initial, frame['initial'] = frame['initial'], dict()
+            categories = self._categories
+            if item_fit_type == 'converge_in_category_first':
+                # we converged in-category. now converge out_category
+                if initial:
+                    self.logger.info(
+                        're-load initial values for out_category')
+                    categories.put(self.gamma_b, initial['gamma_b'], False)
+                    categories.put(self.rho_b, initial['rho_b'], False)
+                self._update(X, rows, cols, vad, beta=beta,
+                    observed_user_preferences=observed_user_preferences,
+                    categorywise=categorywise, item_fit_type=item_fit_type,
+                    update='out_category', resume=resume)
+            if item_fit_type == 'converge_out_category_first':
+                # we converged out-category. now converge in_category
+                if initial:
+                    self.logger.info(
+                        're-load initial values for in_category')
+                    categories.put(self.gamma_b, initial['gamma_b'])
+                    categories.put(self.rho_b, initial['rho_b'])
+                self._update(X, rows, cols, vad, beta=beta,
+                    observed_user_preferences=observed_user_preferences,
+                    categorywise=categorywise, item_fit_type=item_fit_type,
+                    update='in_category', resume=resume)
+            # if user_fit_type == 'converge_separately':
+            #     self._update(X, rows, cols, vad, beta=beta,
+            #         observed_user_preferences=observed_user_preferences,
+            #         user_fit_type=user_fit_type,
+            #         categorywise=categorywise,
+            #         item_fit_type=item_fit_type)
+        if not best.saved:
+            # nothing was scored (evaluation off), the last iterate stands in
+            best.save(self, pred_ll)
+        if squarem is not None:
+            squarem.log_stats()
+        self._frames.pop()
+        return pred_ll, best #return the validation ll
+
+    def _update_svi(self, X, rows, cols, vad, resume=()):
+        # stochastic variational inference: each minibatch of users gets
+        # local updates of theta, then beta takes a step towards the value
+        # it would have if every user looked like the minibatch
+        n_items, n_users = X.shape
+        old_pll = pred_ll = -np.inf
+        frame = dict()
+        start, step_count = 0, 0
+        if resume:
+            state = resume[0]
+            start, old_pll, pred_ll, step_count = (
+                state['iteration'], state['old_pll'], state['pred_ll'],
+                state['step_count'])
+        self._frames.append(frame)
+        for i in xrange(start, self.max_iter):
+            if (i > start and self.checkpoint is not None and
+                    self.checkpoint.due(i)):
+                frame.update(iteration=i, old_pll=old_pll, pred_ll=pred_ll,
+                             step_count=step_count)
+                self.checkpoint.save(self, self._frames)
+            users = np.random.permutation(n_users)
+            for batch in xrange(0, n_users, self.batch_size):
+                step = (self.learning_offset + step_count) ** \
+                    -self.learning_decay
+                self._update_minibatch(X, rows, cols,
+                    np.sort(users[batch:batch + self.batch_size]), step)
+                step_count += 1
+            if not self.eval_schedule.due(i):
+                continue
+            pred_ll = self.eval_schedule.score(self, **vad)
+            if np.isnan(pred_ll):
+                self.logger.error('got nan in predictive ll')
+                raise Exception('nan in predictive ll')
+            improvement = (pred_ll - old_pll) / abs(old_pll)
+            if self.verbose:
+                string = 'ITERATION: %d\tPred_ll: %.2f\tOld Pred_ll: %.2f\t Improvement: %.5f\t Step: %.5f' % (i, pred_ll, old_pll, improvement, step)
+                self.logger.info(string)
+            if improvement < self.tol and i > self.min_iter:
                 break
             old_pll = pred_ll
-        #pass
-        return pred_ll, best_pll_dict #return the validation ll
+        self._frames.pop()
+        return pred_ll
+
+    def _update_minibatch(self, X, rows, cols, users, step):
+        X_data, rows_batch, cols_batch, pattern = \
+            self._pattern.users_subset(X.data, users)
+        expElogb = self.exp_cache.get('Elogb')
+
+        # local step, theta of the minibatch users given beta
+        rho_t = self.b + np.sum(self.Eb, axis=0, keepdims=True).T
+        Elogt = self.Elogt[:, users]
+        for _ in xrange(self.local_iter):
+            expElogt = np.exp(Elogt)
+            gamma_t = kernels.ratio_dot_users(X_data, expElogb, expElogt,
+                rows_batch, cols_batch, pattern=pattern)
+            gamma_t *= expElogt
+            gamma_t += self.a
+            Et, Elogt = _compute_expectations(gamma_t, rho_t, self.dtype)
+        self.gamma_t[:, users] = gamma_t
+        self.rho_t[:, users] = rho_t
+        self.Et[:, users] = Et
+        self.Elogt[:, users] = Elogt
+        self.exp_cache.invalidate('Elogt')
+
+        # global step, a natural gradient step on beta with the minibatch
+        # statistics scaled up to all users
+        scale = float(X.shape[1]) / users.size
+        expElogt = np.exp(Elogt)
+        shape = (X.shape[0], self.n_components)
+        gamma_b = kernels.ratio_dot_items(X_data, expElogb, expElogt,
+            rows_batch, cols_batch, pattern=pattern,
+            out=self.workspace.get('gamma_b_batch', shape))
+        gamma_b *= expElogb
+        gamma_b *= scale * step
+        gamma_b += self.c * step
+        self.gamma_b *= 1 - step
+        self.gamma_b += gamma_b
+        rho_b = self.d + scale * np.sum(Et, axis=1)
+        self.rho_b *= 1 - step
+        self.rho_b += step * rho_b
+        self.Eb, self.Elogb = _compute_expectations(
+            self.gamma_b, self.rho_b, self.dtype,
+            out=self.workspace.expectations('b', shape))
+        self.exp_cache.invalidate('Elogb')
 
     def _update_users(self, X, rows, cols, beta=False, theta=False,
         observed_user_preferences=False, observed_item_attributes=False,
         only_update=False):
 
-        xexplog = self._xexplog(rows, cols, beta=beta,
+        beta_x, theta_x = self._xexplog_factors(beta=beta,
             observed_user_preferences=observed_user_preferences)
 
         self.logger.info('updating users')
 
-        ratioT = sparse.csr_matrix(( X.data / xexplog,
-                                    (rows, cols)),
-                                   dtype=np.float32, shape=X.shape).transpose()
         if observed_user_preferences:
             self.logger.info('updating user preferences based on fixed values')
             expLogElogt = self.Et
         else:
-            expLogElogt = np.exp(self.Elogt)
+            expLogElogt = self.exp_cache.get('Elogt')
 
-        if type(beta) == np.ndarray or only_update == 'users':
-            self.gamma_t = self.a + expLogElogt * \
-                ratioT.dot(self.Eb).T
+        gamma_t = self.workspace.get('gamma_t', (self.n_components, X.shape[1]))
+        if variational.observed(beta) or only_update == 'users':
+            kernels.ratio_dot_users(X.data, beta_x, theta_x, rows, cols,
+                beta_acc=self.Eb, pattern=self._pattern, out=gamma_t)
         else:
-            self.gamma_t = self.a + expLogElogt * \
-                ratioT.dot(np.exp(self.Elogb)).T
-
-        self.rho_t = self.b + np.sum(self.Eb, axis=0, keepdims=True).T
-        self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+            kernels.ratio_dot_users(X.data, beta_x, theta_x, rows, cols,
+                beta_acc=self.exp_cache.get('Elogb'), pattern=self._pattern,
+                out=gamma_t)
+        gamma_t *= expLogElogt
+        gamma_t += self.a
+        self.gamma_t = gamma_t
+
+        self.rho_t = self.b + variational.factor_sums(self.Eb)
+        self.Et, self.Elogt = _compute_expectations(
+            self.gamma_t, self.rho_t, self.dtype,
+            out=self.workspace.expectations('t', self.gamma_t.shape))
+        self.exp_cache.invalidate('Elogt')
+
+    def _update_users_active(self, X, active, iteration):
+        '''
+        _update_users of the unobserved model for the users selected by the
+        active set only, over their ratings only. The other users keep their
+        gamma, rho and expectations.
+        '''
+        users = active.select(iteration)
+        self.logger.info('updating {} of {} users'.format(users.size,
+                                                          X.shape[1]))
+        if not users.size:
+            return
+        if users.size == X.shape[1]:
+            index = slice(None)
+            X_data, rows, cols, pattern = (X.data, self._pattern.rows,
+                                           self._pattern.cols, self._pattern)
+        else:
+            index = users
+            X_data, rows, cols, pattern = self._pattern.users_subset(X.data,
+                                                                     users)
+        expElogt = self.exp_cache.get('Elogt')[:, index]
+        gamma_t = kernels.ratio_dot_users(X_data, self.exp_cache.get('Elogb'),
+                                          expElogt, rows, cols,
+                                          pattern=pattern)
+        gamma_t *= expElogt
+        gamma_t += self.a
+        rho_t = self.b + variational.factor_sums(self.Eb)
+        Et, Elogt = _compute_expectations(gamma_t, rho_t, self.dtype)
+        active.record(users, Et.T, self.Et[:, index].T)
+        if users.size == X.shape[1]:
+            self.gamma_t, self.rho_t, self.Et, self.Elogt = (gamma_t, rho_t,
+                                                             Et, Elogt)
+            self.exp_cache.invalidate('Elogt')
+            return
+        if self.rho_t.shape != self.gamma_t.shape:
+            # frozen users keep their own rate, so it is kept per user
+            self.rho_t = np.array(np.broadcast_to(self.rho_t,
+                                                  self.gamma_t.shape))
+        self.gamma_t[:, index] = gamma_t
+        self.rho_t[:, index] = rho_t
+        self.Et[:, index] = Et
+        self.Elogt[:, index] = Elogt
+        self.exp_cache.refresh('Elogt', (slice(None), index), Elogt)
+
+    def _update_items_active(self, X, active, iteration):
+        '''
+        _update_items of the unobserved model for the items selected by the
+        active set only, see _update_users_active
+        '''
+        items = active.select(iteration)
+        self.logger.info('updating {} of {} items'.format(items.size,
+                                                          X.shape[0]))
+        if not items.size:
+            return
+        if items.size == X.shape[0]:
+            index = slice(None)
+            X_data, rows, cols, pattern = (X.data, self._pattern.rows,
+                                           self._pattern.cols, self._pattern)
+        else:
+            index = items
+            X_data, rows, cols, pattern = self._pattern.items_subset(X.data,
+                                                                     items)
+        expElogb = self.exp_cache.get('Elogb')[index]
+        expElogt = self.exp_cache.get('Elogt')
+        gamma_b = kernels.ratio_dot_items(X_data, expElogb, expElogt, rows,
+                                          cols, theta_acc=expElogt,
+                                          pattern=pattern)
+        gamma_b *= expElogb
+        gamma_b += self.c
+        rho_b = self.d + np.sum(self.Et, axis=1)
+        Eb, Elogb = _compute_expectations(gamma_b, rho_b, self.dtype)
+        active.record(items, Eb, self.Eb[index])
+        if items.size == X.shape[0]:
+            self.gamma_b, self.rho_b, self.Eb, self.Elogb = (gamma_b, rho_b,
+                                                             Eb, Elogb)
+            self.exp_cache.invalidate('Elogb')
+            return
+        if self.rho_b.shape != self.gamma_b.shape:
+            # frozen items keep their own rate, so it is kept per item
+            self.rho_b = np.array(np.broadcast_to(self.rho_b,
+                                                  self.gamma_b.shape))
+        self.gamma_b[index] = gamma_b
+        self.rho_b[index] = rho_b
+        self.Eb[index] = Eb
+        self.Elogb[index] = Elogb
+        self.exp_cache.refresh('Elogb', index, Elogb)
 
     def _update_items(self, X, rows, cols, beta=False, categorywise=False,
         observed_user_preferences=False,
@@ -410,82 +786,85 @@ class PoissonMF(BaseEstimator, TransformerMixin):
 
         self.logger.info('updating items')
 
-        xexplog = self._xexplog(rows, cols,
+        beta_x, theta_x = self._xexplog_factors(
             observed_user_preferences=observed_user_preferences)
 
-        ratio = sparse.csr_matrix((X.data / xexplog,
-                                   (rows, cols)),
-                                  dtype=np.float32, shape=X.shape)
-        if (type(beta) == np.ndarray and
+        shape = (X.shape[0], self.n_components)
+        categories = self._categories
+        if (variational.observed(beta) and
+                categorywise and
+                update == 'in_category'):
+            self.logger.info('updating *only* in-category parameters')
+            # computed only at the in-category entries, the rest stay frozen
+            gamma_b_updated = self.workspace.get('gamma_b_masked',
+                                                 categories.cols.shape)
+            kernels.ratio_dot_items_masked(
+                X.data, beta_x, theta_x, rows, cols, categories.indptr,
+                categories.cols, pattern=self._pattern, out=gamma_b_updated)
+            gamma_b_updated *= categories.take(self.exp_cache.get('Elogb'))
+            gamma_b_updated += self.c
+            variational.update_in_category(
+                self, 'b', gamma_b_updated, self.d + np.sum(self.Et, axis=1))
+            return
+        elif (variational.observed(beta) and
                 categorywise and
                 update != 'default'):
 
-            beta_bool = beta.astype(bool)
-            if observed_user_preferences:
-                gamma_b_updated = self.c + np.exp(self.Elogb) * \
-                    ratio.dot(self.Et.T)
-            else:
-                gamma_b_updated = self.c + np.exp(self.Elogb) * \
-                    ratio.dot(np.exp(self.Elogt.T))
+            gamma_b_updated = self.workspace.get('gamma_b_updated', shape)
+            kernels.ratio_dot_items(X.data, beta_x, theta_x, rows, cols,
+                                    pattern=self._pattern, out=gamma_b_updated)
+            gamma_b_updated *= self.exp_cache.get('Elogb')
+            gamma_b_updated += self.c
             rho_b_updated = self.d + np.sum(self.Et, axis=1)
-            rho_b_updated_reshaped = np.reshape(np.repeat(rho_b_updated,
-                self.rho_b.shape[0], axis=0), self.rho_b.shape)
-            if update == 'in_category':
-                    self.logger.info('updating *only* in-category parameters')
-                    self.gamma_b[beta_bool] = gamma_b_updated[beta_bool]
-                    self.rho_b[beta_bool] = rho_b_updated_reshaped[beta_bool]
-            elif update == 'out_category':
-                    beta_bool_not = np.logical_not(beta_bool)
+            if update == 'out_category':
                     self.logger.info('updating *only* out-category parameters')
-                    self.gamma_b[beta_bool_not] = gamma_b_updated[beta_bool_not]
-                    self.rho_b[beta_bool_not] = \
-                        rho_b_updated_reshaped[beta_bool_not]
+                    self._categories.copyto(self.gamma_b, gamma_b_updated,
+                                            False)
+                    self._categories.copyto(self.rho_b, rho_b_updated, False)
         else:
-            self.gamma_b = self.c + np.exp(self.Elogb) * \
-                ratio.dot(np.exp(self.Elogt.T))
+            self.gamma_b = self.workspace.get('gamma_b', shape)
+            kernels.ratio_dot_items(X.data, beta_x, theta_x, rows, cols,
+                                    theta_acc=self.exp_cache.get('Elogt'),
+                                    pattern=self._pattern, out=self.gamma_b)
+            self.gamma_b *= self.exp_cache.get('Elogb')
+            self.gamma_b += self.c
             self.rho_b = self.d + np.sum(self.Et, axis=1)
-        self.Eb, self.Elogb = _compute_expectations(self.gamma_b, self.rho_b)
+        self.Eb, self.Elogb = _compute_expectations(
+            self.gamma_b, self.rho_b, self.dtype,
+            out=self.workspace.expectations('b', shape))
+        self.exp_cache.invalidate('Elogb')
 
-    def _xexplog(self, rows, cols, beta=False, observed_item_attributes=False,
+    def _xexplog_factors(self, beta=False, observed_item_attributes=False,
         observed_user_preferences=False):
         '''
+        Item and user factors whose inner product for user i, doc d is
         sum_k exp(E[log theta_{ik} * beta_{kd}])
         '''
-        if type(beta) == np.ndarray and observed_item_attributes:
+        if variational.observed(beta) and observed_item_attributes:
             # add trick for log sum exp overflow prevention
-            #data = _inner(self.Eb, np.exp(self.Elogt - self.Elogt.max()), rows, cols)
-            data = _inner(self.Eb, np.exp(self.Elogt), rows, cols)
+            #return self.Eb, np.exp(self.Elogt - self.Elogt.max())
+            return self.Eb, self.exp_cache.get('Elogt')
         elif observed_user_preferences:
-            data = _inner(np.exp(self.Elogb), self.Et, rows, cols)
+            return self.exp_cache.get('Elogb'), self.Et
         else:
-            data = _inner(np.exp(self.Elogb), np.exp(self.Elogt), rows, cols)
-        return data
+            return self.exp_cache.get('Elogb'), self.exp_cache.get('Elogt')
 
     def pred_loglikeli(obj, X_new, rows_new, cols_new):
-        X_pred = _inner(obj.Eb, obj.Et, rows_new, cols_new)
+        X_pred = kernels.inner(obj.Eb, obj.Et, rows_new, cols_new)
         pred_ll = np.mean(X_new * np.log(X_pred) - X_pred)
         return pred_ll
 
 
-def _inner(beta, theta, rows, cols):
-    n_ratings = rows.size
-    n_components, n_users = theta.shape
-    data = np.empty(n_ratings, dtype=np.float32)
-    code = r"""
-    for (int i = 0; i < n_ratings; i++) {
-       data[i] = 0.0;
-       for (int j = 0; j < n_components; j++) {
-           data[i] += beta[rows[i] * n_components + j] * theta[j * n_users + cols[i]];
-       }
-    }
-    """
-    weave.inline(code, ['data', 'theta', 'beta', 'rows', 'cols',
-                        'n_ratings', 'n_components', 'n_users'])
-    return data
-
-
-def _compute_expectations(alpha, beta):
+
+def _compute_expectations(alpha, beta, dtype, out=None):
     '''
-    Given x ~ Gam(alpha, beta), compute E[x] and E[log x]
+    Given x ~ Gam(alpha, beta), compute E[x] and E[log x], checking that
+    nothing was promoted away from the model dtype. With out=(Ex, Elogx)
+    the expectations are written into those buffers instead
     '''
-    return (alpha / beta, special.psi(alpha) - np.log(beta))
+    if out is None:
+        Ex, Elogx = alpha / beta, variational.psi(alpha) - np.log(beta)
+    else:
+        Ex, Elogx = variational.gamma_expectations(alpha, beta, *out)
+    variational.check_dtype(dtype, alpha=alpha, beta=beta, Ex=Ex, Elogx=Elogx)
+    return Ex, Elogx
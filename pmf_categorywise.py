@@ -7,10 +7,13 @@ CREATED: 2014-03-25 02:06:52 by Dawen Liang <dliang@ee.columbia.edu>
 """
 import logging
 import numpy as np
-from scipy import sparse, special, weave
+from scipy import special
 
 from sklearn.base import BaseEstimator, TransformerMixin
 
+import kernels
+import variational
+
 
 class PoissonMF(BaseEstimator, TransformerMixin):
     ''' Poisson matrix factorization with batch inference '''
@@ -44,6 +47,7 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             Model hyperparameters
         '''
         self.logger = logging.getLogger(__name__)
+        self.exp_cache = variational.ExpCache(self)
 
         self.n_components = n_components
         self.max_iter = max_iter
@@ -86,7 +90,7 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.d = float(kwargs.get('d', 0.1))
 
     def _init_users(self, n_users, theta=False, beta=False):
-        if type(beta) == np.ndarray:
+        if variational.observed(beta):
             self.logger.info('initializing theta to be the observed one')
             self.Et = theta
             self.Elogt = None
@@ -106,9 +110,9 @@ class PoissonMF(BaseEstimator, TransformerMixin):
 
     def _init_items(self, n_items, beta=False):
         # if we pass in observed betas:
-        if type(beta) == np.ndarray:
+        if variational.observed(beta):
             self.logger.info('initializing beta to be the observed one')
-            self.Eb = beta
+            self.Eb = variational.observed_factor(beta, np.float32)
             self.Elogb = None
             self.gamma_b = None
             self.rho_b = None
@@ -139,46 +143,65 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             Returns the instance itself.
         '''
         n_items, n_users = X.shape
+        self._pattern = kernels.SparsityPattern(rows, cols, X.shape)
         self._init_items(n_items, beta=beta)
         self._init_users(n_users, theta=theta)
         self._update(X, rows, cols, vad, beta=beta)
+        self.exp_cache.log_stats()
         return self
 
-    #def transform(self, X, attr=None):
-    #    '''Encode the data as a linear combination of the latent components.
-
-    #    Parameters
-    #    ----------
-    #    X : array-like, shape (n_samples, n_feats)
-
-    #    attr: string
-    #        The name of attribute, default 'Eb'. Can be changed to Elogb to
-    #        obtain E_q[log beta] as transformed data.
-
-    #    Returns
-    #    -------
-    #    X_new : array-like, shape(n_samples, n_filters)
-    #        Transformed data, as specified by attr.
-    #    '''
-
-    #    if not hasattr(self, 'Eb'):
-    #        raise ValueError('There are no pre-trained components.')
-    #    n_samples, n_feats = X.shape
-    #    if n_feats != self.Eb.shape[1]:
-    #        raise ValueError('The dimension of the transformed data '
-    #                         'does not match with the existing components.')
-    #    if attr is None:
-    #        attr = 'Et'
-    #    self._init_weights(n_samples)
-    #    self._update(X, update_beta=False)
-    #    return getattr(self, attr)
+    def transform(self, X):
+        '''Encode unseen users by their preferences, see fold_in_users.
+
+        Parameters
+        ----------
+        X : sparse matrix, shape (n_items, n_users)
+            Ratings of the users, over the items the model was fit on.
+
+        Returns
+        -------
+        X_new : array-like, shape (n_users, n_components)
+            E[theta] of the users.
+        '''
+        return self.fold_in_users(X).T
+
+    def fold_in_users(self, X, max_iter=100, tol=1e-4, batch_size=None):
+        '''
+        E[theta] (n_components x n_users, like Et) of users unseen in fit
+        with ratings X (sparse, n_items x n_users), from user-only updates
+        against the frozen item factors. The fitted model is not modified.
+        '''
+        return variational.fold_in_users(self, X, max_iter=max_iter, tol=tol,
+                                         batch_size=batch_size)
+
+    def _fold_in(self, X_data, rows, cols, n_users, max_iter, tol):
+        pattern = kernels.SparsityPattern(rows, cols,
+                                          (self.Eb.shape[0], n_users))
+        if self.Elogb is None:
+            # beta was observed
+            beta_x = self.Eb
+        else:
+            beta_x = self.exp_cache.get('Elogb')
+        rho_t = self.b + variational.factor_sums(self.Eb)
+        Et, Elogt = _compute_expectations(
+            np.full((self.n_components, n_users), self.a, dtype=self.Eb.dtype),
+            rho_t)
+        for _ in xrange(max_iter):
+            expElogt = np.exp(Elogt)
+            gamma_t = self.a + expElogt * kernels.ratio_dot_users(
+                X_data, beta_x, expElogt, rows, cols, pattern=pattern)
+            Et_old = Et
+            Et, Elogt = _compute_expectations(gamma_t, rho_t)
+            if variational.converged(Et, Et_old, tol):
+                break
+        return Et
 
     def _update(self, X, rows, cols, vad, beta=False):
         # alternating between update latent components and weights
         old_pll = -np.inf
         for i in xrange(self.max_iter):
             self._update_users(X, rows, cols, beta=beta)
-            if type(beta) == np.ndarray:
+            if variational.observed(beta):
                 # do nothing if we have observed betas.
                 pass
             else:
@@ -197,11 +220,8 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         pass
 
     def _update_users(self, X, rows, cols, beta=False):
-        xexplog = self._xexplog(rows, cols, beta=beta)
-        ratioT = sparse.csr_matrix(( X.data / xexplog,
-                                    (rows, cols)),
-                                   dtype=np.float32, shape=X.shape).transpose()
-        if type(beta) == np.ndarray:
+        beta_x, theta_x = self._xexplog_factors(beta=beta)
+        if variational.observed(beta):
             # for n in range(0, self.Eb.shape[0]+1):
             #     dot = ratioT[0,0:n].dot(self.Eb[0:n,0])
             #     if np.isnan(dot):
@@ -231,59 +251,46 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             # add trick for logsumexp overflow prevention
             # self.gamma_t = self.a + np.exp(self.Elogt - self.Elogt.max()) * \
             #     ratioT.dot(self.Eb).T
-            self.gamma_t = self.a + np.exp(self.Elogt) * \
-                ratioT.dot(self.Eb).T
+            self.gamma_t = self.a + self.exp_cache.get('Elogt') * \
+                kernels.ratio_dot_users(X.data, beta_x, theta_x, rows, cols,
+                                        beta_acc=self.Eb,
+                                        pattern=self._pattern)
         else:
-            self.gamma_t = self.a + np.exp(self.Elogt) * \
-                ratioT.dot(np.exp(self.Elogb)).T
-        self.rho_t = self.b + np.sum(self.Eb, axis=0, keepdims=True).T
+            self.gamma_t = self.a + self.exp_cache.get('Elogt') * \
+                kernels.ratio_dot_users(X.data, beta_x, theta_x, rows, cols,
+                                        beta_acc=self.exp_cache.get('Elogb'),
+                                        pattern=self._pattern)
+        self.rho_t = self.b + variational.factor_sums(self.Eb)
         self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
 
     def _update_items(self, X, rows, cols):
-        ratio = sparse.csr_matrix((X.data / self._xexplog(rows, cols),
-                                   (rows, cols)),
-                                  dtype=np.float32, shape=X.shape)
-        self.gamma_b = self.c + np.exp(self.Elogb) * \
-            ratio.dot(np.exp(self.Elogt.T))
+        beta_x, theta_x = self._xexplog_factors()
+        self.gamma_b = self.c + self.exp_cache.get('Elogb') * \
+            kernels.ratio_dot_items(X.data, beta_x, theta_x, rows, cols,
+                                    pattern=self._pattern)
         self.rho_b = self.d + np.sum(self.Et, axis=1)
         self.Eb, self.Elogb = _compute_expectations(self.gamma_b, self.rho_b)
 
-    def _xexplog(self, rows, cols, beta=False):
+    def _xexplog_factors(self, beta=False):
         '''
+        Item and user factors whose inner product for user i, doc d is
         sum_k exp(E[log theta_{ik} * beta_{kd}])
         '''
-        if type(beta) == np.ndarray:
+        if variational.observed(beta):
             # add trick for log sum exp overflow prevention
-            #data = _inner(self.Eb, np.exp(self.Elogt - self.Elogt.max()), rows, cols)
-            data = _inner(self.Eb, np.exp(self.Elogt), rows, cols)
+            #return self.Eb, np.exp(self.Elogt - self.Elogt.max())
+            return self.Eb, self.exp_cache.get('Elogt')
         else:
-            data = _inner(np.exp(self.Elogb), np.exp(self.Elogt), rows, cols)
-        return data
+            return self.exp_cache.get('Elogb'), self.exp_cache.get('Elogt')
 
     def pred_loglikeli(self, X_new, rows_new, cols_new):
         #print self.Eb[0]
         #print self.Et[:,0]
-        X_pred = _inner(self.Eb, self.Et, rows_new, cols_new)
+        X_pred = kernels.inner(self.Eb, self.Et, rows_new, cols_new)
         pred_ll = np.mean(X_new * np.log(X_pred) - X_pred)
         return pred_ll
 
 
-def _inner(beta, theta, rows, cols):
-    n_ratings = rows.size
-    n_components, n_users = theta.shape
-    data = np.empty(n_ratings, dtype=np.float32)
-    code = r"""
-    for (int i = 0; i < n_ratings; i++) {
-       data[i] = 0.0;
-       for (int j = 0; j < n_components; j++) {
-           data[i] += beta[rows[i] * n_components + j] * theta[j * n_users + cols[i]];
-       }
-    }
-    """
-    weave.inline(code, ['data', 'theta', 'beta', 'rows', 'cols',
-                        'n_ratings', 'n_components', 'n_users'])
-    return data
-
 
 def _compute_expectations(alpha, beta):
     '''
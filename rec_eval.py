@@ -1,4 +1,3 @@
-import bottleneck as bn
 import numpy as np
 from math import log
 from operator import div, add
@@ -8,18 +7,116 @@ import time, sys, json
 import pandas as pd
 import cPickle as pickle
 import logging
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger()
 
-def load_data(csv_file, shape, binarize):
-    tp = pd.read_csv(csv_file, delimiter='\t', header=None, names=['uid', 'did', 'count'])
-    rows, cols = np.array(tp['did'], dtype=np.int32), np.array(tp['uid'], dtype=np.int32)
-    count = tp['count']
-    matrix = scipy.sparse.csr_matrix((count,(rows, cols)), dtype=np.int16, shape=shape)
+# lines of a ratings TSV parsed at a time by load_data
+CHUNK_LINES = 1000000
+
+def load_data(csv_file, shape, binarize, chunk_lines=CHUNK_LINES):
+    '''
+    Load a (uid, did, count) TSV as an n_docs x n_users csr_matrix of
+    counts, with duplicate ratings summed. The file is read twice,
+    chunk_lines lines at a time: the first pass counts the ratings per
+    document and finds the narrowest count dtype, the second fills the CSR
+    indptr/indices/data by a counting sort, one chunk at a time. Peak
+    memory is the final CSR (int32 indices, int16 counts unless a count
+    needs int32 or int64) plus one chunk's parse and sort temporaries; only
+    if the file has duplicate ratings is data widened to int64 while they
+    are summed.
+
+    Returns the matrix and the int32 (rows, cols) of its entries, in the
+    order of matrix.data.
+    '''
+    n_rows, n_cols = shape
+    row_counts = np.zeros(n_rows, dtype=np.int64)
+    count_dtype = np.int16
+    for rows, cols, counts in _read_chunks(csv_file, chunk_lines):
+        for name, index, size in (('did', rows, n_rows),
+                                  ('uid', cols, n_cols)):
+            if index.size and (index.min() < 0 or index.max() >= size):
+                raise ValueError('{} has {}s outside [0, {})'.format(
+                    getattr(csv_file, 'name', csv_file), name, size))
+        count_dtype = np.promote_types(count_dtype, _count_dtype(counts))
+        row_counts += np.bincount(rows, minlength=n_rows)
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(row_counts, out=indptr[1:])
+    del row_counts
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=count_dtype)
+    cursor = indptr[:-1].copy()
+    for rows, cols, counts in _read_chunks(csv_file, chunk_lines):
+        order = np.argsort(rows, kind='mergesort')
+        rows = rows[order]
+        chunk_counts = np.bincount(rows, minlength=n_rows)
+        group_start = np.cumsum(chunk_counts) - chunk_counts
+        positions = cursor[rows] + np.arange(rows.size) - group_start[rows]
+        indices[positions] = cols[order]
+        data[positions] = counts[order]
+        cursor += chunk_counts
+    del cursor
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=shape)
+    matrix.sort_indices()
+    if _has_duplicates(matrix):
+        # summed at full width, then narrowed again below
+        matrix.data = matrix.data.astype(np.int64)
+        matrix.sum_duplicates()
+    else:
+        # sorted and without duplicates already
+        matrix.has_canonical_format = True
     if binarize:
-        matrix.data = np.ones_like(matrix.data)
+        matrix.data = np.ones(matrix.nnz, dtype=np.int16)
+    else:
+        matrix.data = matrix.data.astype(_count_dtype(matrix.data),
+                                         copy=False)
+    rows = np.repeat(np.arange(n_rows, dtype=np.int32), np.diff(matrix.indptr))
+    cols = matrix.indices.astype(np.int32)
     return matrix, rows, cols
 
+def _read_chunks(csv_file, chunk_lines):
+    ''' (rows, cols, counts) of each chunk_lines lines of a ratings TSV '''
+    if hasattr(csv_file, 'seek'):
+        # a file object is read once per pass of load_data
+        csv_file.seek(0)
+    for chunk in pd.read_csv(csv_file, delimiter='\t', header=None,
+                             names=['uid', 'did', 'count'],
+                             dtype={'uid': np.int32, 'did': np.int32,
+                                    'count': np.int64},
+                             chunksize=chunk_lines):
+        yield chunk['did'].values, chunk['uid'].values, chunk['count'].values
+
+def _has_duplicates(matrix):
+    ''' Whether a CSR matrix with sorted indices repeats an index in a row '''
+    same = matrix.indices[1:] == matrix.indices[:-1]
+    # pairs straddling two rows are not duplicates
+    starts = matrix.indptr[1:-1]
+    starts = starts[(starts > 0) & (starts < matrix.nnz)]
+    same[starts - 1] = False
+    return bool(same.any())
+
+def load_datasets(csv_files, shape, binarize):
+    '''
+    load_data for each file (e.g. train, validation and test) concurrently,
+    in a thread per file
+    '''
+    pool = ThreadPool(len(csv_files))
+    try:
+        return pool.map(lambda csv_file: load_data(csv_file, shape, binarize),
+                        csv_files)
+    finally:
+        pool.close()
+
+def _count_dtype(counts):
+    ''' int16, or the narrowest wider int type that holds the counts '''
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not counts.size or (counts.min() >= info.min and
+                               counts.max() <= info.max):
+            return dtype
+    return np.int64
+
 def user_idx_generator(n_users, batch_users):
     for start in xrange(0, n_users, batch_users):
         end = min(n_users, start + batch_users)
@@ -121,16 +218,18 @@ def precision_at_k_batch(train_data, vad_data, test_data, Et, Eb, user_idx,
 
     X_pred = _make_prediction(train_data, vad_data, Et, Eb, user_idx,
                               batch_users)
-    idx = bn.argpartsort(-X_pred, k, axis=1)
-    X_pred_binary = np.zeros_like(X_pred, dtype=bool)
-    X_pred_binary[np.tile(np.arange(batch_users), (k, 1)).T, idx[:, :k]] = True
+    # the top k of each user, unordered, by partial selection
+    idx = np.argpartition(-X_pred, k - 1, axis=1)[:, :k]
+    X_pred_binary = sparse.csr_matrix(
+        (np.ones(idx.size, dtype=np.float32), idx.ravel(),
+         np.arange(0, idx.size + 1, k)), shape=X_pred.shape)
 
-    X_true_binary = (test_data[user_idx] > 0).toarray()
-    tmp = (np.logical_and(X_true_binary, X_pred_binary).sum(axis=1)).astype(
-        np.float32)
+    X_true_binary = test_data[user_idx] > 0
+    tmp = np.asarray(X_true_binary.multiply(X_pred_binary).sum(axis=1),
+                     dtype=np.float32).ravel()
 
     if normalize:
-        precision = tmp / np.minimum(k, X_true_binary.sum(axis=1))
+        precision = tmp / np.minimum(k, X_true_binary.getnnz(axis=1))
     else:
         precision = tmp / k
     return precision
@@ -138,14 +237,12 @@ def precision_at_k_batch(train_data, vad_data, test_data, Et, Eb, user_idx,
 
 def mean_rank(data, Et, Eb, user_idx):
     X_pred = Et[user_idx].dot(Eb)
-    # rank starts with 1
-    all_rank = np.argsort(np.argsort(-X_pred, axis=1), axis=1) + 1
     X_true_binary = (data[user_idx] > 0).tocoo()
-    rank = sparse.csr_matrix((all_rank[X_true_binary.row, X_true_binary.col],
-                              (X_true_binary.row, X_true_binary.col)),
-                             shape=all_rank.shape)
-    return np.asarray(rank.sum(axis=1),
-                      dtype=np.float32).ravel() / rank.getnnz(axis=1)
+    # rank starts with 1
+    rank = _ranks(X_pred, X_true_binary.row, X_true_binary.col) + 1
+    return np.bincount(X_true_binary.row, weights=rank,
+                       minlength=X_pred.shape[0]).astype(np.float32) / \
+        X_true_binary.getnnz(axis=1)
 
 
 def mean_rrank_at_k_batch(train_data, vad_data, test_data, Et, Eb,
@@ -159,12 +256,15 @@ def mean_rrank_at_k_batch(train_data, vad_data, test_data, Et, Eb,
 
     X_pred = _make_prediction(train_data, vad_data, Et, Eb, user_idx,
                               batch_users)
-    all_rrank = 1. / (np.argsort(np.argsort(-X_pred, axis=1), axis=1) + 1)
-    X_true_binary = (test_data[user_idx] > 0).toarray()
+    X_true_binary = (test_data[user_idx] > 0).tocoo()
+    rrank = 1. / (_ranks(X_pred, X_true_binary.row, X_true_binary.col) + 1)
 
-    test_rrank = X_true_binary * all_rrank
-    top_k = bn.partsort(-test_rrank, k, axis=1)
-    return -top_k[:, :k].mean(axis=1)
+    # the k best ranked test items of each user, fewer count as zeros
+    order = np.lexsort((-rrank, X_true_binary.row))
+    users, rrank = X_true_binary.row[order], rrank[order]
+    top_k = np.arange(users.size) - np.searchsorted(users, users) < k
+    return np.bincount(users[top_k], weights=rrank[top_k],
+                       minlength=batch_users) / k
 
 
 def mean_perc_rank_batch(train_data, vad_data, test_data, Et, Eb, user_idx):
@@ -178,32 +278,28 @@ def mean_perc_rank_batch(train_data, vad_data, test_data, Et, Eb, user_idx):
 
     X_pred = _make_prediction(train_data, vad_data, Et, Eb, user_idx,
                               batch_users)
-    all_perc = np.argsort(np.argsort(-X_pred, axis=1), axis=1) / \
-        np.isfinite(X_pred).sum(axis=1, keepdims=True).astype(np.float32)
-    perc_batch = (all_perc[test_data[user_idx].nonzero()] *
-                  test_data[user_idx].data).sum()
-    return perc_batch
+    X_true = test_data[user_idx].tocoo()
+    n_ranked = np.isfinite(X_pred).sum(axis=1).astype(np.float32)
+    perc = _ranks(X_pred, X_true.row, X_true.col) / n_ranked[X_true.row]
+    return (perc * X_true.data).sum()
 
 def NDCG_binary(train_data, vad_data, test_data, Et, Eb, user_idx):
     '''
     normalized discounted cumulative gain for binary relevance
     '''
     batch_users = user_idx.stop - user_idx.start
-    n_items = train_data.shape[1]
 
     X_pred = _make_prediction(train_data, vad_data, Et, Eb, user_idx,
                               batch_users)
-    all_rank = np.argsort(np.argsort(-X_pred, axis=1), axis=1)
-    # build the discount template
-    tp = np.hstack((1, 1. / np.log2(np.arange(2, n_items + 1))))
-    all_disc = tp[all_rank]
-
     X_true_binary = (test_data[user_idx] > 0).tocoo()
-    disc = sparse.csr_matrix((all_disc[X_true_binary.row, X_true_binary.col],
-                              (X_true_binary.row, X_true_binary.col)),
-                             shape=all_disc.shape)
-    DCG = np.array(disc.sum(axis=1)).ravel()
-    IDCG = np.array([tp[:n].sum() for n in test_data[user_idx].getnnz(axis=1)])
+    rank = _ranks(X_pred, X_true_binary.row, X_true_binary.col)
+    # the discount of rank r (from 0) is 1 / log2(r + 1), and 1 for rank 0
+    DCG = np.bincount(X_true_binary.row,
+                      weights=1. / np.log2(np.maximum(rank, 1) + 1),
+                      minlength=batch_users)
+    n_true = test_data[user_idx].getnnz(axis=1)
+    tp = np.hstack((1, 1. / np.log2(np.arange(2, n_true.max() + 1))))
+    IDCG = np.hstack((0, np.cumsum(tp)))[n_true]
     return DCG / IDCG
 
 def calc_all(train_data, validation_data, test_data, Et, Eb):
@@ -306,6 +402,45 @@ def _top_songs(k,beta,songnum2fullname, song2artist, n=10):
     mn = np.mean(counts)
     return mn, ["%0.3f  %s" %(beta[k, topId],songnum2fullname[topId]) for topId in top[0:n]]
 
+def _ranks(X_pred, rows, cols):
+    '''
+    Rank (from 0) of each X_pred[rows, cols] within its row of X_pred, by
+    decreasing score, with ties in column order as in a stable sort of
+    -X_pred. The higher ranked entries of each row are counted against the
+    row's few sorted scores instead of sorting the row, see _row_ranks.
+    '''
+    ranks = np.empty(len(rows), dtype=np.int64)
+    order = np.argsort(rows, kind='mergesort')
+    for entries in np.split(order, np.flatnonzero(np.diff(rows[order])) + 1):
+        if entries.size:
+            ranks[entries] = _row_ranks(X_pred[rows[entries[0]]],
+                                        cols[entries])
+    return ranks
+
+def _row_ranks(row, cols):
+    '''
+    _ranks of row[cols] within row, in O(len(row) * log(len(cols)))
+    '''
+    scores = row[cols]
+    sorted_scores = np.sort(scores)
+    # per candidate, how many of the scores are below it
+    below = np.searchsorted(sorted_scores, row, side='left')
+    # a candidate is above score s if it is above every score up to s, and
+    # above[p] counts the candidates above at least p of the scores
+    above = np.cumsum(np.bincount(below, minlength=cols.size + 1)[::-1])[::-1]
+    ranks = above[np.searchsorted(sorted_scores, scores, side='right')]
+    # of the candidates tied with a score (its own column among them), those
+    # in earlier columns rank above it
+    tied = np.flatnonzero(sorted_scores[np.minimum(below, cols.size - 1)] ==
+                          row)
+    tied_scores = row[tied]
+    tied_order = np.lexsort((tied, tied_scores))
+    position = np.empty(tied.size, dtype=np.int64)
+    position[tied_order] = np.arange(tied.size)
+    first = np.searchsorted(tied_scores[tied_order], scores, side='left')
+    ranks += position[np.searchsorted(tied, cols)] - first
+    return ranks
+
 def _make_prediction(train_data, vad_data, Et, Eb, user_idx, batch_users):
     n_songs = train_data.shape[1]
     # exclude examples from training and validation
@@ -0,0 +1,15 @@
+# builds the compiled kernels used by kernels.py:
+#   python setup.py build_ext --inplace
+
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+import numpy as np
+
+extensions = [
+    Extension('_kernels', ['_kernels.pyx'],
+              include_dirs=[np.get_include()],
+              extra_compile_args=['-O3'])
+]
+
+setup(name='ctpf', ext_modules=cythonize(extensions))
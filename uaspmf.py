@@ -10,15 +10,18 @@ MODIFIED: 2015-03-25 13:06:12 by Jaan Altosaar <altosaar@princeton.edu>
 
 import sys
 import numpy as np
-from scipy import sparse, special, weave
+from scipy import sparse
 import pandas as pd
 from sklearn.base import BaseEstimator, TransformerMixin
 import logging
+import kernels
+import variational
 
 class PoissonMF(BaseEstimator, TransformerMixin):
     ''' Poisson matrix factorization with batch inference '''
     def __init__(self, n_components=100, max_iter=100, min_iter=1, tol=0.0001,
                  smoothness=100, random_state=None, verbose=False,
+                 dtype=np.float32, eval_schedule=None, snapshot_memory=None,
                  beta=False, theta=False,
                  categorywise=False,
                  item_fit_type='all_categories',
@@ -35,6 +38,11 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.smoothness = smoothness
         self.random_state = random_state
         self.verbose = verbose
+        self.dtype = dtype
+        if eval_schedule is None:
+            eval_schedule = variational.EvalSchedule()
+        self.eval_schedule = eval_schedule
+        self.snapshot_memory = snapshot_memory
         self.max_iter_fixed = 4
         self.observed_user_preferences = observed_user_preferences
         self.observed_item_attributes = observed_item_attributes
@@ -45,9 +53,9 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.observed_corrections = False
 
         if observed_user_preferences:
-            self.Et = theta
+            self.Et = np.asarray(theta, dtype=self.dtype)
         if observed_item_attributes:
-            self.Ebs = beta
+            self.Ebs = np.asarray(beta, dtype=self.dtype)
         if categorywise:
             if not type(beta) == np.ndarray:
                 raise Exception('need observed categories for categorywise')
@@ -59,6 +67,9 @@ class PoissonMF(BaseEstimator, TransformerMixin):
 
         self._parse_args(**kwargs)
         self.logger = logging.getLogger(__name__)
+        self.exp_cache = variational.ExpCache(self)
+        self.workspace = variational.Workspace(dtype)
+        self.ratings_cache = variational.RatingsCache()
 
 
     def _parse_args(self, **kwargs):
@@ -74,10 +85,11 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         for artist in range(0,self.n_artists):
             #self.artist2songs[artist]=np.where(self.song2artist==artist)[0]
             self.artist2songs[artist]=np.array([artist])
-        self.n_songs_by_artist = np.reshape(np.array([self.artist2songs[artist].size for artist in range(self.n_artists)]).astype(np.float32),(self.n_artists,1))
+        self.n_songs_by_artist = np.reshape(np.array([self.artist2songs[artist].size for artist in range(self.n_artists)]).astype(self.dtype),(self.n_artists,1))
         #self.artist_indicator = pd.get_dummies(self.song2artist).T
         #self.artist_indicator = sparse.csr_matrix(self.artist_indicator.values)
-        self.artist_indicator = sparse.identity(self.n_artists, format='csr')
+        self.artist_indicator = sparse.identity(self.n_artists, dtype=self.dtype,
+                                                format='csr')
 
     def _init_users(self, n_users):
         # if we pass in observed thetas:
@@ -92,12 +104,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_t = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(self.n_components, n_users)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_t = self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(self.n_components, n_users)
-                                ).astype(np.float32)
-            self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+                                ).astype(self.dtype)
+            self.Et, self.Elogt = _compute_expectations(
+                self.gamma_t, self.rho_t, self.dtype)
 
     def _init_items(self, n_items):
         # if we pass in observed betas:
@@ -112,12 +125,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             self.gamma_bs = 0.01 * self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
+                                ).astype(self.dtype)
             self.rho_bs = 0.01 * self.smoothness * \
                 np.random.gamma(self.smoothness, 1. / self.smoothness,
                                 size=(n_items, self.n_components)
-                                ).astype(np.float32)
-            self.Ebs, self.Elogbs = _compute_expectations(self.gamma_bs, self.rho_bs)
+                                ).astype(self.dtype)
+            self.Ebs, self.Elogbs = _compute_expectations(
+                self.gamma_bs, self.rho_bs, self.dtype)
 
     def _init_artists(self, n_artists):
         self.logger.info('initializing corrections normally from gamma')
@@ -125,12 +139,13 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         self.gamma_ba = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
                             size=(n_artists, self.n_components)
-                            ).astype(np.float32)
+                            ).astype(self.dtype)
         self.rho_ba = self.smoothness * \
             np.random.gamma(self.smoothness, 1. / self.smoothness,
                             size=(n_artists, self.n_components)
-                            ).astype(np.float32)
-        self.Eba, self.Elogba = _compute_expectations(self.gamma_ba, self.rho_ba)
+                            ).astype(self.dtype)
+        self.Eba, self.Elogba = _compute_expectations(
+            self.gamma_ba, self.rho_ba, self.dtype)
 
     def fit(self, X, rows, cols, vad):
         '''Fit the model to the data in X.
@@ -146,12 +161,14 @@ class PoissonMF(BaseEstimator, TransformerMixin):
             Returns the instance itself.
         '''
         n_items, n_users = X.shape
+        self._pattern = kernels.SparsityPattern(rows, cols, X.shape)
         self.n_users = n_users
         self._init_items(n_items)
         self._init_users(n_users)
         self._init_artists(self.n_artists)
         if self.user_fit_type == 'converge_separately':
-            best_validation_ll = -np.inf
+            best = variational.Snapshot(['Eba', 'Ebs', 'Et', 'Elogba', 'Elogbs', 'Elogt'],
+                                        max_memory=self.snapshot_memory)
             for switch_idx in xrange(self.max_iter_fixed):
                 if switch_idx % 2 == 0:
                     update_users_or_items = 'items'
@@ -168,41 +185,24 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                     initialize_users = 'none'
                 self.logger.info('=> only updating {}, switch number {}'
                     .format(update_users_or_items, switch_idx))
-                validation_ll, best_pll_dict = self._update(
+                validation_ll, stage_best = self._update(
                     X, rows, cols, vad,
                     initialize_users=initialize_users,
                     update_users_or_items=update_users_or_items,
                     update_categories=update_categories)
-                new_validation_ll = best_pll_dict['pred_ll']
                 self.logger.info('set params to best pll {}, old one was {}'
-                    .format(new_validation_ll, validation_ll))
-                validation_ll = new_validation_ll
-                self.Eba = best_pll_dict['best_Eba']
-                self.Ebs = best_pll_dict['best_Ebs']
-                self.Et = best_pll_dict['best_Et']
-                self.Elogba = best_pll_dict['best_Elogba']
-                self.Elogbs = best_pll_dict['best_Elogbs']
-                self.Elogt = best_pll_dict['best_Elogt']
-                if validation_ll > best_validation_ll:
-                    best_Eba = self.Eba
-                    best_Ebs = self.Ebs
-                    best_Et = self.Et
-                    best_Elogba = self.Elogba
-                    best_Elogbs = self.Elogbs
-                    best_Elogt = self.Elogt
-                    best_validation_ll = validation_ll
+                    .format(stage_best.score, validation_ll))
+                stage_best.restore(self)
+                best.offer(self, stage_best.score)
                 self.logger.info('best validation ll was {}'.format(
-                    best_validation_ll))
+                    best.score))
             # set to best values
-            self.Eba = best_Eba
-            self.Ebs = best_Ebs
-            self.Et = best_Et
-            self.Elogt = best_Elogt
-            self.Elogbs = best_Elogbs
-            self.Elogba = best_Elogba
+            best.restore(self)
 
         else:
             self._update(X, rows, cols, vad)
+        self.exp_cache.log_stats()
+        self.workspace.log_stats()
         return self
 
     def _update(self, X, rows, cols, vad,
@@ -210,8 +210,10 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         update_users_or_items='both',
         update_categories='all_categories'):
         # alternating between update latent components and weights
-        old_pll = -np.inf
-        best_pll_dict = dict(pred_ll = -np.inf)
+        old_pll = pred_ll = -np.inf
+        best = variational.Snapshot(
+            ['Eba', 'Elogba', 'Ebs', 'Elogbs', 'Et', 'Elogt'],
+            max_memory=self.snapshot_memory)
 
         # user update logic
         for i in xrange(self.max_iter):
@@ -228,35 +230,14 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                 else:
                     self._update_users(X, rows, cols)
             else:
-                self.logger.info('BEFORE updating users')
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-                self._update_users(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
+                for _ in xrange(5):
+                    self._update_users(X, rows, cols)
 
             # item update logic
             if self.observed_item_attributes:
                 pass
             else:
                 self._update_items(X, rows, cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
 
             # zero out in-category or out_category corrections
             if self.item_fit_type == 'converge_in_category_first' or self.item_fit_type == 'converge_out_category_first':
@@ -293,28 +274,18 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                 self._update_artists(X,rows,cols, update_categories=update_categories)
             elif update_users_or_items == 'both':
                 self._update_artists(X,rows,cols)
-                train_ll = self.pred_loglikeli(X.data, rows, cols)
-                self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-                        .format(train_ll))
-
-            pred_ll = self.pred_loglikeli(**vad)
-            # train_ll = self.pred_loglikeli(X.data, rows, cols)
-            # self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
-            #         .format(train_ll))
+
+            self.eval_schedule.log_train(self, X, rows, cols, i)
+            if not self.eval_schedule.due(i):
+                continue
+            pred_ll = self.eval_schedule.score(self, **vad)
             if np.isnan(pred_ll):
                 self.logger.error('got nan in predictive ll')
                 raise Exception('nan in predictive ll')
             else:
-                if pred_ll > best_pll_dict['pred_ll']:
-                    best_pll_dict['pred_ll'] = pred_ll
+                if best.offer(self, pred_ll):
                     self.logger.info('logged new best pred_ll as {}'
                         .format(pred_ll))
-                    best_pll_dict['best_Eba'] = self.Eba
-                    best_pll_dict['best_Elogba'] = self.Elogba
-                    best_pll_dict['best_Ebs'] = self.Ebs
-                    best_pll_dict['best_Elogbs'] = self.Elogbs
-                    best_pll_dict['best_Et'] = self.Et
-                    best_pll_dict['best_Elogt'] = self.Elogt
             improvement = (pred_ll - old_pll) / abs(old_pll)
             if self.verbose:
                 string = 'ITERATION: %d\tPred_ll: %.2f\tOld Pred_ll: %.2f\tImprovement: %.5f' % (i, pred_ll, old_pll, improvement)
@@ -338,8 +309,11 @@ class PoissonMF(BaseEstimator, TransformerMixin):
                         self._update(X, rows, cols, vad, update_categories='in_category')
                 break
             old_pll = pred_ll
+        if not best.saved:
+            # nothing was scored (evaluation off), the last iterate stands in
+            best.save(self, pred_ll)
         #pass
-        return pred_ll, best_pll_dict
+        return pred_ll, best
 
     def _update_users(self, X, rows, cols, switch_from_observed_user_preferences=False):
         self.logger.info('updating users')
@@ -347,34 +321,41 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         if self.observed_item_attributes:
             expElogbs = self.Ebs
         else:
-            expElogbs = np.exp(self.Elogbs)
+            expElogbs = self.exp_cache.get('Elogbs')
 
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
+            expElogt = self.exp_cache.get('Elogt')
 
         if self.observed_corrections:
             expElogba = self.Eba
         else:
-            expElogba = np.exp(self.Elogba)[self.song2artist]
-
-        ratioTs = sparse.csr_matrix((X.data / self._xexplog_bs(rows, cols),
-                                    (rows, cols)),
-                                   dtype=np.float32, shape=X.shape).transpose()
-        ratioTa = sparse.csr_matrix((X.data / self._xexplog_ba(rows, cols),
-                                    (rows, cols)),
-                                   dtype=np.float32, shape=X.shape).transpose()
-        self.gamma_t = self.a + expElogt * \
-            ratioTs.dot(expElogbs).T + \
-            expElogt * \
-            ratioTa.dot(expElogba).T
+            expElogba = self.exp_cache.get('Elogba')[self.song2artist]
+
+        # song and artist terms share the user factor, so one sweep serves both
+        beta_s, theta = self._xexplog_bs_factors()
+        beta_a, _ = self._xexplog_ba_factors()
+        shape = (self.n_components, X.shape[1])
+        self.gamma_t = self.workspace.get('gamma_t', shape)
+        ratio_dot_ba = self.workspace.get('ratio_dot_ba', shape)
+        kernels.ratio_dot_users2(X.data, beta_s, beta_a, theta, rows, cols,
+                                 beta_acc1=expElogbs, beta_acc2=expElogba,
+                                 pattern=self._pattern, out1=self.gamma_t,
+                                 out2=ratio_dot_ba)
+        self.gamma_t *= expElogt
+        self.gamma_t += self.a
+        ratio_dot_ba *= expElogt
+        self.gamma_t += ratio_dot_ba
 
         self.rho_t = self.b + np.sum(
             self.Eba[self.song2artist], axis=0, keepdims=True).T + \
             np.sum(self.Ebs, axis=0, keepdims=True).T
 
-        self.Et, self.Elogt = _compute_expectations(self.gamma_t, self.rho_t)
+        self.Et, self.Elogt = _compute_expectations(
+            self.gamma_t, self.rho_t, self.dtype,
+            out=self.workspace.expectations('t', shape))
+        self.exp_cache.invalidate('Elogt')
 
         # switch off after updating once using fixed user preferences!
         if switch_from_observed_user_preferences:
@@ -387,129 +368,134 @@ class PoissonMF(BaseEstimator, TransformerMixin):
         if self.observed_item_attributes:
             expElogbs = self.Eb
         else:
-            expElogbs = np.exp(self.Elogbs)
+            expElogbs = self.exp_cache.get('Elogbs')
 
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
-
-        ratio = sparse.csr_matrix((X.data / self._xexplog_bs(rows, cols),
-                                   (rows, cols)),
-                                  dtype=np.float32, shape=X.shape)
-        self.gamma_bs = self.f + expElogbs * \
-            ratio.dot(expElogt.T)
+            expElogt = self.exp_cache.get('Elogt')
+
+        beta_s, theta_s = self._xexplog_bs_factors()
+        shape = (X.shape[0], self.n_components)
+        self.gamma_bs = self.workspace.get('gamma_bs', shape)
+        kernels.ratio_dot_items(X.data, beta_s, theta_s, rows, cols,
+                                theta_acc=expElogt, pattern=self._pattern,
+                                out=self.gamma_bs)
+        self.gamma_bs *= expElogbs
+        self.gamma_bs += self.f
         self.rho_bs = self.g + np.sum(self.Et, axis=1)
-        self.Ebs, self.Elogbs = _compute_expectations(self.gamma_bs, self.rho_bs)
+        self.Ebs, self.Elogbs = _compute_expectations(
+            self.gamma_bs, self.rho_bs, self.dtype,
+            out=self.workspace.expectations('bs', shape))
+        self.exp_cache.invalidate('Elogbs')
 
     def _update_artists(self, X, rows, cols,
         update_categories='all_categories'):
 
         self.logger.info('updating epsilons / artists')
 
-        ratio = sparse.csr_matrix((X.data / self._xexplog_ba(rows, cols),
-                                   (rows, cols)),
-                                  dtype=np.float32, shape=X.shape)
+        beta_a, theta_a = self._xexplog_ba_factors()
 
         if self.observed_user_preferences:
-            expElogt = self.Et.T
+            expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt.T)
+            expElogt = self.exp_cache.get('Elogt')
+
+        ratio_dot_t = kernels.ratio_dot_items(
+            X.data, beta_a, theta_a, rows, cols, theta_acc=expElogt,
+            pattern=self._pattern,
+            out=self.workspace.get('ratio_dot_t', (X.shape[0],
+                                                   self.n_components)))
+        ratio_dot_t *= self.exp_cache.get('Elogba')[self.song2artist]
+        summed_over_artists = self.artist_indicator.dot(ratio_dot_t)
+        summed_over_artists += self.c
 
         if update_categories == 'in_category' or update_categories == 'out_category':
 
             beta_bool = self.Ebs.astype(bool)
 
-            summed_over_artists = self.artist_indicator.dot(np.exp(self.Elogba[self.song2artist]) * \
-                ratio.dot(expElogt))
-
-            gamma_ba_updated = self.c + summed_over_artists
+            gamma_ba_updated = summed_over_artists
             rho_ba_updated = self.d + self.n_songs_by_artist * np.sum(self.Et, axis=1)
 
             if update_categories == 'in_category':
                     self.logger.info('updating *only* in-category parameters')
-                    self.gamma_ba[beta_bool] = gamma_ba_updated[beta_bool]
-                    self.rho_ba[beta_bool] = rho_ba_updated[beta_bool]
+                    np.copyto(self.gamma_ba, gamma_ba_updated, where=beta_bool)
+                    np.copyto(self.rho_ba, rho_ba_updated, where=beta_bool)
             elif update_categories == 'out_category':
                     beta_bool_not = np.logical_not(beta_bool)
                     self.logger.info('updating *only* out-category parameters')
-                    self.gamma_ba[beta_bool_not] = gamma_ba_updated[beta_bool_not]
-                    self.rho_ba[beta_bool_not] = \
-                        rho_ba_updated[beta_bool_not]
+                    np.copyto(self.gamma_ba, gamma_ba_updated,
+                              where=beta_bool_not)
+                    np.copyto(self.rho_ba, rho_ba_updated,
+                              where=beta_bool_not)
 
         elif update_categories == 'all_categories':
 
-            summed_over_artists = self.artist_indicator.dot(
-                np.exp(self.Elogba[self.song2artist]) * \
-                ratio.dot(expElogt))
-
-            self.gamma_ba = self.c + summed_over_artists
+            self.gamma_ba = summed_over_artists
             self.rho_ba = self.d + self.n_songs_by_artist * \
                 np.sum(self.Et, axis=1)
 
-        self.Eba, self.Elogba = _compute_expectations(self.gamma_ba, self.rho_ba)
+        self.Eba, self.Elogba = _compute_expectations(
+            self.gamma_ba, self.rho_ba, self.dtype,
+            out=self.workspace.expectations('ba', self.gamma_ba.shape))
+        self.exp_cache.invalidate('Elogba')
 
 
-    def _xexplog_bs(self, rows, cols):
+    def _xexplog_bs_factors(self):
         '''
+        Song and user factors whose inner product for user i, song d is
         sum_k exp(E[log theta_{ik} * beta_s_{kd}])
         '''
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
+            expElogt = self.exp_cache.get('Elogt')
 
         if self.observed_item_attributes:
             expElogbs = self.Ebs
         else:
-            expElogbs = np.exp(self.Elogbs)
+            expElogbs = self.exp_cache.get('Elogbs')
 
-        data = _inner(expElogbs, expElogt, rows, cols)
+        return expElogbs, expElogt
 
-        return data
-
-    def _xexplog_ba(self, rows, cols):
+    def _xexplog_ba_factors(self):
         '''
-        user i, artist a(s) = s_num2a_num[cols]
+        Artist and user factors whose inner product for
+        user i, artist a(s) = s_num2a_num[cols] is
         sum_k exp(E[log theta_{ik} * beta_a_{ka}])
         '''
         if self.observed_user_preferences:
             expElogt = self.Et
         else:
-            expElogt = np.exp(self.Elogt)
-
-        rows_artists = np.array([song for song in rows], dtype=np.int32)
-        data = _inner(np.exp(self.Elogba), expElogt, rows_artists, cols)
+            expElogt = self.exp_cache.get('Elogt')
 
-        return data
+        # artists are indexed by song (see artist2songs in _parse_args), so
+        # the song rows double as artist rows
+        return self.exp_cache.get('Elogba'), expElogt
 
     def pred_loglikeli(self, X_new, rows_new, cols_new):
-        X_pred_bs = _inner(self.Ebs, self.Et, rows_new, cols_new)
-        #rows_artists_new = np.array([self.song2artist[song] for song in rows_new], dtype=np.int32)
-        rows_artists_new = np.array([song for song in rows_new], dtype=np.int32)
-        X_pred_ba = _inner(self.Eba, self.Et, rows_artists_new, cols_new)
-        X_pred = X_pred_bs + X_pred_ba
-        pred_ll = np.mean(X_new * np.log(X_pred) - X_pred)
+        X_new, rows_new, cols_new = self.ratings_cache.get(
+            X_new, rows_new, cols_new, (self.Ebs.shape[0], self.Et.shape[1]))
+        # Eba is indexed by song like Ebs, and the two terms are only
+        # scored as a sum, so one inner product with Ebs + Eba does
+        Ebs_sum = np.add(self.Ebs, self.Eba,
+            out=self.workspace.get('Ebs_sum', self.Ebs.shape))
+        X_pred = kernels.inner(Ebs_sum, self.Et, rows_new, cols_new)
+        pred_ll = np.log(X_pred)
+        pred_ll *= X_new
+        pred_ll -= X_pred
+        pred_ll = np.mean(pred_ll)
         return pred_ll
 
-def _inner(beta, theta, rows, cols):
-    n_ratings = rows.size
-    n_components, n_users = theta.shape
-    data = np.empty(n_ratings, dtype=np.float32)
-    code = r"""
-    for (int i = 0; i < n_ratings; i++) {
-       data[i] = 0.0;
-       for (int j = 0; j < n_components; j++) {
-           data[i] += beta[rows[i] * n_components + j] * theta[j * n_users + cols[i]];
-       }
-    }
-    """
-    weave.inline(code, ['data', 'theta', 'beta', 'rows', 'cols',
-                        'n_ratings', 'n_components', 'n_users'])
-    return data
-
-def _compute_expectations(alpha, beta):
+def _compute_expectations(alpha, beta, dtype, out=None):
     '''
-    Given x ~ Gam(alpha, beta), compute E[x] and E[log x]
+    Given x ~ Gam(alpha, beta), compute E[x] and E[log x], checking that
+    nothing was promoted away from the model dtype. With out=(Ex, Elogx)
+    the expectations are written into those buffers instead
     '''
-    return (alpha / beta, special.psi(alpha) - np.log(beta))
\ No newline at end of file
+    if out is None:
+        Ex, Elogx = alpha / beta, variational.psi(alpha) - np.log(beta)
+    else:
+        Ex, Elogx = variational.gamma_expectations(alpha, beta, *out)
+    variational.check_dtype(dtype, alpha=alpha, beta=beta, Ex=Ex, Elogx=Elogx)
+    return Ex, Elogx
\ No newline at end of file
@@ -0,0 +1,866 @@
+"""
+
+Helpers shared by the variational estimators (pmf, hpmf, ctpf, uaspmf)
+
+"""
+import copy
+import logging
+import tempfile
+import weakref
+import numpy as np
+from scipy import sparse, special
+from scipy.sparse import linalg
+
+import kernels
+
+# number of elements per block in gamma_expectations, so that the log(beta)
+# temporary stays cache-sized
+BLOCK_ELEMENTS = 65536
+
+# an ActiveSet with more than this fraction of its rows active updates all
+# of them, as gathering and scattering the rows would cost more than it saves
+ACTIVE_FRACTION = 0.5
+
+# observed factors with at most this fraction of nonzeros (e.g. category
+# indicators) are kept in CSR, so the kernels visit each item's few nonzeros
+SPARSE_DENSITY = 0.25
+
+# init='subsample' fits this fraction of the users for this many iterations
+INIT_USERS = 0.1
+INIT_ITERATIONS = 5
+
+# init='categories' starts each paper's out-of-category components at this
+# fraction of its in-category ones
+INIT_OUT_CATEGORY = 0.01
+
+
+class ExpCache(object):
+    '''
+    exp(E[log x]) for each factor of an estimator, computed on first use and
+    kept until that factor's E[log x] is rewritten by _compute_expectations
+    '''
+    def __init__(self, owner):
+        self.owner = owner
+        self.logger = logging.getLogger(__name__)
+        self.hits = dict()
+        self.misses = dict()
+        self._cache = dict()
+
+    def get(self, name):
+        ''' exp(owner.<name>), e.g. get('Elogt') '''
+        source = getattr(self.owner, name)
+        if name in self._cache:
+            source_ref, value = self._cache[name]
+            if source_ref() is source:
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return value
+        self.misses[name] = self.misses.get(name, 0) + 1
+        value = self._cache.get(name, (None, None))[1]
+        if (value is not None and value.shape == source.shape and
+                value.dtype == source.dtype):
+            # no caller holds on to exp(...) across an update, so the old
+            # value's memory can be reused
+            np.exp(source, out=value)
+        else:
+            value = np.exp(source)
+        self._cache[name] = (weakref.ref(source), value)
+        return value
+
+    def refresh(self, name, index, values=None):
+        '''
+        Update the cached value after owner.<name> was written in place at
+        index only (e.g. a tuple of index arrays), with the values written
+        there if given
+        '''
+        source = getattr(self.owner, name)
+        if name in self._cache:
+            source_ref, value = self._cache[name]
+            if source_ref() is source:
+                if values is None:
+                    values = source[index]
+                value[index] = np.exp(values)
+                return
+        self.invalidate(name)
+
+    def invalidate(self, *names):
+        ''' Mark the cached values stale, needed when a factor is written in place '''
+        for name in names:
+            if name in self._cache:
+                self._cache[name] = (lambda: None, self._cache[name][1])
+
+    def log_stats(self):
+        for name in sorted(set(self.hits) | set(self.misses)):
+            self.logger.info('exp({}) cache: {} hits, {} misses'.format(
+                name, self.hits.get(name, 0), self.misses.get(name, 0)))
+
+
+class Snapshot(object):
+    '''
+    Copies of some of an estimator's attributes (e.g. Eb, Et) from its best
+    scoring iterate so far. Values are copied only when the score improves,
+    into buffers allocated on the first save and reused after that. If the
+    copies would take more than max_memory bytes, the buffers are memory
+    mapped temporary files instead, so a fit holds at most one extra
+    in-memory copy of the factors it snapshots.
+    '''
+    def __init__(self, names, max_memory=None):
+        self.names = tuple(names)
+        self.max_memory = max_memory
+        self.score = -np.inf
+        self.saved = False
+        self.spilled = False
+        self._buffers = dict()
+
+    def offer(self, owner, score):
+        ''' Save owner's attributes if score beats the best so far '''
+        if self.saved and not score > self.score:
+            return False
+        self.save(owner, score)
+        return True
+
+    def save(self, owner, score):
+        self._store([(name, getattr(owner, name)) for name in self.names],
+                    score)
+
+    def restore(self, owner):
+        '''
+        Set owner's attributes to copies of the saved values, so later
+        in-place updates of owner cannot reach into the snapshot
+        '''
+        for name in self.names:
+            buf = self._buffers[name]
+            if sparse.issparse(buf):
+                buf = buf.copy()
+            elif buf is not None:
+                buf = np.array(buf)
+            setattr(owner, name, buf)
+
+    def dump(self):
+        ''' The saved score and values, as written to a checkpoint '''
+        return dict(score=self.score, saved=self.saved,
+                    values=dict((name, self._buffers.get(name))
+                                for name in self.names))
+
+    def load(self, state):
+        ''' Inverse of dump, when resuming from a checkpoint '''
+        if state['saved']:
+            self._store([(name, state['values'].get(name))
+                         for name in self.names], state['score'])
+
+    def _store(self, values, score):
+        if not self.saved:
+            nbytes = sum(value.nbytes for _, value in values
+                         if isinstance(value, np.ndarray))
+            self.spilled = (self.max_memory is not None and
+                            nbytes > self.max_memory)
+        for name, value in values:
+            if value is None:
+                # e.g. Elogb when beta is observed
+                self._buffers[name] = None
+                continue
+            if sparse.issparse(value):
+                # a sparse observed beta, which fit never changes
+                self._buffers[name] = value.copy()
+                continue
+            buf = self._buffers.get(name)
+            if buf is None or buf.shape != value.shape or \
+                    buf.dtype != value.dtype:
+                buf = self._allocate(value)
+                self._buffers[name] = buf
+            np.copyto(buf, value)
+        self.score = score
+        self.saved = True
+
+    def _allocate(self, value):
+        if self.spilled and value.size:
+            return np.memmap(tempfile.TemporaryFile(), dtype=value.dtype,
+                             mode='w+', shape=value.shape)
+        return np.empty_like(value)
+
+
+class EvalSchedule(object):
+    '''
+    When fit scores the model, and on which ratings.
+
+    every : int
+        Score the validation set every this many iterations, 0 turns
+        validation (and with it the convergence check) off
+    subsample : int or None
+        Score a fixed random subsample of this many ratings instead of the
+        whole validation (and training) set
+    train_every : int
+        Log the training log-likelihood every this many iterations, 0 for
+        never
+    '''
+    def __init__(self, every=1, subsample=None, train_every=0,
+                 random_state=0):
+        self.every = every
+        self.subsample = subsample
+        self.train_every = train_every
+        self.random_state = random_state
+        self.logger = logging.getLogger(__name__)
+        self._subsamples = RatingsCache()
+
+    @classmethod
+    def parse(cls, spec, **kwargs):
+        ''' Build a schedule from 'full', 'off', 'every:N' or 'subsample:M' '''
+        mode, _, value = spec.partition(':')
+        if mode == 'full':
+            return cls(**kwargs)
+        elif mode == 'off':
+            return cls(every=0, **kwargs)
+        elif mode == 'every':
+            return cls(every=int(value), **kwargs)
+        elif mode == 'subsample':
+            return cls(subsample=int(value), **kwargs)
+        raise ValueError('unknown evaluation schedule {}, use full, off, '
+                         'every:N or subsample:M'.format(spec))
+
+    def due(self, iteration):
+        return self.every > 0 and iteration % self.every == 0
+
+    def score(self, model, X_new, rows_new, cols_new):
+        ''' model.pred_loglikeli on the ratings, or on their subsample '''
+        return model.pred_loglikeli(*self._ratings(X_new, rows_new, cols_new))
+
+    def log_train(self, model, X, rows, cols, iteration):
+        if self.train_every > 0 and iteration % self.train_every == 0:
+            train_ll = self.score(model, X.data, rows, cols)
+            self.logger.info('{:0.5f} <=========== TRAIN log-likelihood'
+                             .format(train_ll))
+
+    def _ratings(self, X_new, rows_new, cols_new):
+        if self.subsample is None or self.subsample >= len(rows_new):
+            return X_new, rows_new, cols_new
+        # the subsample is drawn once per dataset, so that successive scores
+        # stay comparable for the convergence check
+        return self._subsamples.get(X_new, rows_new, cols_new, None,
+                                    transform=self._draw)
+
+    def _draw(self, X_new, rows_new, cols_new):
+        idx = np.sort(np.random.RandomState(self.random_state).choice(
+            len(rows_new), size=self.subsample, replace=False))
+        return (np.asarray(X_new)[idx], np.asarray(rows_new)[idx],
+                np.asarray(cols_new)[idx])
+
+
+class ActiveSet(object):
+    '''
+    The rows (users or items) of a factor whose variational parameters are
+    still moving, for fits that skip the converged ones. A row whose E[x]
+    changed by less than tol relative to its total, sum_k |change| / sum_k
+    E[x], when it was last updated is frozen. Every sweep_every iterations all rows are
+    updated, which re-admits the frozen rows that have drifted since, and so
+    are they whenever more than ACTIVE_FRACTION of them are active.
+    '''
+    def __init__(self, n_rows, tol, sweep_every=10):
+        self.n_rows = n_rows
+        self.tol = tol
+        self.sweep_every = sweep_every
+        self.rows = np.arange(n_rows, dtype=np.int32)
+
+    def select(self, iteration):
+        ''' The rows to update at iteration, all of them on a full sweep '''
+        if (self.sweep_every > 0 and iteration % self.sweep_every == 0 or
+                self.rows.size > ACTIVE_FRACTION * self.n_rows):
+            return np.arange(self.n_rows, dtype=np.int32)
+        return self.rows
+
+    def record(self, rows, Ex, Ex_old):
+        '''
+        After rows were updated from Ex_old to Ex (one row of each per entry
+        of rows), keep those that moved by at least tol active
+        '''
+        # relative to the row's total rather than per component, where the
+        # many near-zero components would keep every row active
+        change = np.sum(np.abs(Ex - Ex_old), axis=1) / np.sum(Ex_old, axis=1)
+        self.rows = np.asarray(rows, dtype=np.int32)[change >= self.tol]
+
+
+class Squarem(object):
+    '''
+    SQUAREM acceleration (Varadhan and Roland, 2008) of the batch
+    coordinate ascent, over the shape and rate parameters gamma_<name> and
+    rho_<name> of the given factors (e.g. 't', 'b'), extrapolated in log
+    space so that they stay positive.
+
+    The expectations of factor name are E<name> and Elog<name>, unless
+    expectations maps name to another suffix (ctpf's items, gamma_bs and
+    rho_bs, have Eb and Elogb).
+
+    Each cycle takes two plain iterations x0 -> x1 -> x2, jumps to
+    x0 - 2 alpha r + alpha^2 v with r = x1 - x0, v = x2 - 2 x1 + x0 and
+    alpha = -|r| / |v| (clipped to [-max_step, -1]), and takes one plain
+    iteration from there. score(owner) (the validation log-likelihood)
+    guards the jump: while the extrapolated iterate scores below x2, alpha
+    backtracks halfway towards -1, and after max_backtracks the cycle
+    falls back to x2 itself (alpha = -1). The iterations are the
+    estimator's own, run by steps.
+
+    The estimators test for convergence with improvement, once per cycle.
+    '''
+    def __init__(self, factors, score, expectations=None, max_step=8.,
+                 max_backtracks=4):
+        self.factors = tuple(factors)
+        self.score = score
+        self.expectations = dict(expectations or ())
+        self.max_step = max_step
+        self.max_backtracks = max_backtracks
+        self.logger = logging.getLogger(__name__)
+        self.stage = 'x1'
+        self.accepted = 0
+        self.backtracked = 0
+        self.rejected = 0
+        self.best_score = -np.inf
+        self._tested_score = -np.inf
+        self._cycle_end = False
+        self._x2_score = None
+        self._saved = dict()
+
+    def before_step(self, owner):
+        if 'x0' not in self._saved:
+            self._saved['x0'] = self._params(owner)
+        if self.stage == 'jump':
+            self._jump(owner)
+            self._saved = dict()
+            self._x2_score = None
+            self.stage = 'x1'
+            self._cycle_end = True
+
+    def after_step(self, owner):
+        if self.stage == 'x1' and 'x0' not in self._saved:
+            # the cycle after a jump starts from the plain iterate after it
+            self._saved['x0'] = self._params(owner)
+        elif self.stage == 'x1':
+            self._saved['x1'] = self._params(owner)
+            self.stage = 'x2'
+        elif self.stage == 'x2':
+            self._saved['x2'] = self._params(owner)
+            self.stage = 'jump'
+
+    def improvement(self, score):
+        '''
+        At the first score after a cycle ended, the relative improvement of
+        the best score over that cycle, else nan (which never converges)
+        '''
+        if self.stage == 'jump' and self._x2_score is None:
+            # saves _jump scoring x2 again
+            self._x2_score = score
+        self.best_score = max(self.best_score, score)
+        if not self._cycle_end:
+            return np.nan
+        self._cycle_end = False
+        improvement = ((self.best_score - self._tested_score) /
+                       abs(self._tested_score))
+        self._tested_score = self.best_score
+        return improvement
+
+    def dump(self):
+        ''' The cycle's state, as written to a checkpoint '''
+        return dict(stage=self.stage, best_score=self.best_score,
+                    tested_score=self._tested_score,
+                    cycle_end=self._cycle_end, x2_score=self._x2_score,
+                    saved=dict((key, dict(params))
+                               for key, params in self._saved.items()))
+
+    def load(self, state):
+        ''' Inverse of dump, when resuming from a checkpoint '''
+        self.stage = state['stage']
+        self.best_score = state['best_score']
+        self._tested_score = state['tested_score']
+        self._cycle_end = bool(state['cycle_end'])
+        self._x2_score = state['x2_score']
+        self._saved = dict((key, dict(params))
+                           for key, params in state['saved'].items())
+
+    def log_stats(self):
+        self.logger.info('squarem: {} steps accepted ({} after '
+                         'backtracking), {} fell back to the plain '
+                         'iterate'.format(self.accepted, self.backtracked,
+                                          self.rejected))
+
+    def _names(self, owner):
+        # observed factors have no variational parameters
+        return [name for name in self.factors
+                if isinstance(getattr(owner, 'gamma_' + name, None),
+                              np.ndarray)]
+
+    def _params(self, owner):
+        ''' The log of the parameters, where the extrapolation happens '''
+        params = dict()
+        for name in self._names(owner):
+            for prefix in ('gamma_', 'rho_'):
+                params[prefix + name] = np.log(getattr(owner, prefix + name))
+        return params
+
+    def _jump(self, owner):
+        '''
+        Extrapolate from x0, x1, x2 (where owner is), backtracking while
+        the extrapolated iterate scores below x2
+        '''
+        x0, x1, x2 = (self._saved[key] for key in ('x0', 'x1', 'x2'))
+        r, v = dict(), dict()
+        for key in x2:
+            # the rates may have been broadcast to the shape of the shapes
+            # since x0, see e.g. pmf's _update_users_active
+            r[key] = x1[key] - x0[key]
+            v[key] = x2[key] - 2 * x1[key] + x0[key]
+        r_norm = np.sqrt(sum(np.sum(np.square(x, dtype=np.float64))
+                             for x in r.values()))
+        v_norm = np.sqrt(sum(np.sum(np.square(x, dtype=np.float64))
+                             for x in v.values()))
+        if not v_norm > 0 or not r_norm > v_norm:
+            # e.g. the factors did not move, alpha = -1 is x2 itself
+            return
+        x2_score = self._x2_score
+        if x2_score is None:
+            x2_score = self.score(owner)
+        alpha = max(-self.max_step, -r_norm / v_norm)
+        for backtrack in xrange(self.max_backtracks + 1):
+            self._set(owner, dict(
+                (key, x0[key] - 2 * alpha * r[key] + alpha ** 2 * v[key])
+                for key in x2))
+            # also rejects nan
+            if self.score(owner) >= x2_score:
+                self.accepted += 1
+                self.backtracked += backtrack > 0
+                return
+            alpha = -1 - (-1 - alpha) / 2
+        self.rejected += 1
+        self.logger.info('squarem step rejected, back to the plain iterate')
+        self._set(owner, x2)
+
+    def _set(self, owner, params):
+        ''' Set the parameters from their log and recompute the factors'
+        expectations '''
+        dtype = np.dtype(owner.dtype)
+        for name in self._names(owner):
+            gamma = np.exp(params['gamma_' + name]).astype(dtype, copy=False)
+            rho = np.exp(params['rho_' + name]).astype(dtype, copy=False)
+            Ex, Elogx = gamma_expectations(gamma, rho, np.empty_like(gamma),
+                                           np.empty_like(gamma))
+            check_dtype(owner.dtype, gamma=gamma, rho=rho, Ex=Ex,
+                        Elogx=Elogx)
+            setattr(owner, 'gamma_' + name, gamma)
+            setattr(owner, 'rho_' + name, rho)
+            suffix = self.expectations.get(name, name)
+            setattr(owner, 'E' + suffix, Ex)
+            setattr(owner, 'Elog' + suffix, Elogx)
+            owner.exp_cache.invalidate('Elog' + suffix)
+
+
+def steps(squarem, owner):
+    '''
+    The plain batch iteration of one iteration of owner's fit, with
+    squarem (a Squarem, or None) saving and extrapolating around it
+    '''
+    if squarem is not None:
+        squarem.before_step(owner)
+    yield
+    if squarem is not None:
+        squarem.after_step(owner)
+
+
+def check_accelerate(accelerate):
+    ''' Fail early on an unknown accelerate option of the estimators '''
+    if accelerate not in (None, 'squarem'):
+        raise ValueError('unknown accelerate {}, use None or squarem'.format(
+            accelerate))
+
+
+class RatingsCache(object):
+    '''
+    Ratings scored by pred_loglikeli (held-out or training), validated and
+    converted to kernel index arrays once per dataset rather than on every
+    call. A dataset is recognized by the identity of its arrays.
+    '''
+    def __init__(self):
+        self._entries = []
+
+    def get(self, X_new, rows_new, cols_new, shape, transform=None):
+        '''
+        (X_new, rows, cols) with int32 rows and cols checked against shape,
+        or transform(X_new, rows_new, cols_new) if given
+        '''
+        arrays = (X_new, rows_new, cols_new)
+        self._entries = [(refs, entry) for refs, entry in self._entries
+                         if refs[0]() is not None]
+        for refs, entry in self._entries:
+            if all(ref() is a for ref, a in zip(refs, arrays)):
+                return entry
+        if transform is None:
+            entry = _ratings(X_new, rows_new, cols_new, shape)
+        else:
+            entry = transform(X_new, rows_new, cols_new)
+        try:
+            self._entries.append((tuple(weakref.ref(a) for a in arrays), entry))
+        except TypeError:
+            # not weak-referenceable (e.g. a list), so not worth caching
+            pass
+        return entry
+
+
+def _ratings(X_new, rows_new, cols_new, shape):
+    X_new = np.asarray(X_new)
+    rows = np.ascontiguousarray(rows_new, dtype=np.int32)
+    cols = np.ascontiguousarray(cols_new, dtype=np.int32)
+    if not X_new.shape == rows.shape == cols.shape:
+        raise ValueError('X_new, rows_new and cols_new must have the same '
+                         'length, got {}, {} and {}'.format(
+                             X_new.shape, rows.shape, cols.shape))
+    # the compiled kernels do not bounds check
+    for name, index, size in (('rows_new', rows, shape[0]),
+                              ('cols_new', cols, shape[1])):
+        if index.size and (index.min() < 0 or index.max() >= size):
+            raise ValueError('{} has indices outside [0, {})'.format(
+                name, size))
+    return X_new, rows, cols
+
+
+def fold_in_users(model, X, max_iter=100, tol=1e-4, batch_size=None):
+    '''
+    The body of the estimators' fold_in_users: E[theta] (n_components x
+    n_new_users) of users unseen in fit, given their ratings X (sparse,
+    n_items x n_new_users), with the fitted item factors frozen. The
+    model's _fold_in runs the user-only updates on batch_size users at a
+    time (all of them by default), vectorized across the batch.
+    '''
+    if getattr(model, 'Eb', None) is None:
+        raise ValueError('There are no pre-trained components.')
+    X = sparse.csc_matrix(X)
+    n_items = model.Eb.shape[0]
+    if X.shape[0] != n_items:
+        raise ValueError('X has {} items, the model was fit on {}'.format(
+            X.shape[0], n_items))
+    dtype = model.Eb.dtype
+    Et = np.empty((model.n_components, X.shape[1]), dtype=dtype)
+    step = max(1, batch_size or X.shape[1])
+    for start in xrange(0, X.shape[1], step):
+        batch = X[:, start:start + step].tocoo()
+        Et[:, start:start + step] = model._fold_in(
+            batch.data.astype(dtype), batch.row.astype(np.int32),
+            batch.col.astype(np.int32), batch.shape[1], max_iter, tol)
+    return Et
+
+
+def check_init(init):
+    ''' Fail early on an unknown init option of the estimators '''
+    if init not in ('random', 'subsample', 'svd', 'categories'):
+        raise ValueError('unknown init {}, use random, subsample, svd or '
+                         'categories'.format(init))
+
+
+def init_factors(model, X, beta=False):
+    '''
+    Replace the random starting values of model's unobserved item factor
+    (gamma_b, rho_b) and, for svd, user factor (gamma_t, rho_t) by ones
+    computed from the ratings X (n_items x n_users CSR), as chosen by
+    model.init:
+
+        random : keep the draws of _init_items and _init_users
+        subsample : E[beta] of the same model fit for INIT_ITERATIONS
+            iterations on a random INIT_USERS of the users
+        svd : the nonnegative parts of a truncated SVD of X (NNDSVD,
+            Boutsidis and Gallopoulos, 2008), for both factors
+        categories : the observed category indicators beta for the
+            in-category components, of a categorywise fit
+
+    The first iteration's user update then starts from data-shaped item
+    factors instead of near-uniform ones.
+    '''
+    if model.init == 'random':
+        return
+    if not isinstance(getattr(model, 'gamma_b', None), np.ndarray):
+        raise ValueError('init {} needs unobserved item factors'.format(
+            model.init))
+    K = model.n_components
+    Et = None
+    if model.init == 'categories':
+        if not observed(beta) or beta.shape[1] != K:
+            raise ValueError('init categories needs the observed categories '
+                             'as beta, one per component')
+        Eb = np.maximum(to_dense(beta), INIT_OUT_CATEGORY)
+    elif observed(beta):
+        raise ValueError('init {} is for the model without observed '
+                         'categories'.format(model.init))
+    elif model.init == 'subsample':
+        Eb = _subsample_items(model, X)
+    else:
+        Eb, Et = _nndsvd(X, K)
+    model.logger.info('initializing factors by {}'.format(model.init))
+    _seed(model, 'b', Eb, getattr(model, 'items_init_scale', 1))
+    if Et is not None and isinstance(model.gamma_t, np.ndarray):
+        _seed(model, 't', Et)
+
+
+def _seed(model, name, Ex, scale=1):
+    # a gamma with mean Ex and the shape of the random draws
+    shape = scale * model.smoothness
+    gamma = np.full(Ex.shape, shape, dtype=model.dtype)
+    rho = (shape / np.asarray(Ex, dtype=np.float64)).astype(model.dtype)
+    Ex, Elogx = gamma_expectations(gamma, rho, np.empty_like(gamma),
+                                   np.empty_like(gamma))
+    check_dtype(model.dtype, gamma=gamma, rho=rho, Ex=Ex, Elogx=Elogx)
+    setattr(model, 'gamma_' + name, gamma)
+    setattr(model, 'rho_' + name, rho)
+    setattr(model, 'E' + name, Ex)
+    setattr(model, 'Elog' + name, Elogx)
+    model.exp_cache.invalidate('Elog' + name)
+
+
+def _subsample_items(model, X):
+    n_users = X.shape[1]
+    users = np.sort(np.random.choice(
+        n_users, size=max(1, int(INIT_USERS * n_users)), replace=False))
+    X_sub = sparse.csr_matrix(X[:, users])
+    coo = X_sub.tocoo()
+    # a copy with its own caches and buffers, which is neither checkpointed
+    # nor scored
+    sub = copy.copy(model)
+    sub.init = 'random'
+    sub.max_iter = INIT_ITERATIONS
+    sub.checkpoint = None
+    sub.eval_schedule = EvalSchedule(every=0)
+    sub.exp_cache = ExpCache(sub)
+    sub.workspace = Workspace(model.dtype)
+    empty = np.zeros(0, dtype=np.int32)
+    sub.fit(X_sub, coo.row.astype(np.int32), coo.col.astype(np.int32),
+            dict(X_new=empty, rows_new=empty, cols_new=empty))
+    return sub.Eb
+
+
+def _nndsvd(X, n_components):
+    U, s, Vt = linalg.svds(sparse.csr_matrix(X, dtype=np.float64),
+                           k=n_components)
+    # each singular pair is replaced by the nonnegative part, positive or
+    # negative, of larger norm
+    Up, Un = np.maximum(U, 0), np.maximum(-U, 0)
+    Vp, Vn = np.maximum(Vt, 0), np.maximum(-Vt, 0)
+    norms = [np.sqrt(np.sum(np.square(x), axis=axis))
+             for x, axis in ((Up, 0), (Un, 0), (Vp, 1), (Vn, 1))]
+    positive = norms[0] * norms[2] >= norms[1] * norms[3]
+    W = np.where(positive, Up, Un)
+    H = np.where(positive[:, np.newaxis], Vp, Vn)
+    W_norm = np.where(positive, norms[0], norms[1])
+    H_norm = np.where(positive, norms[2], norms[3])
+    scale = np.sqrt(s * W_norm * H_norm)
+    W *= scale / np.maximum(W_norm, np.finfo(W.dtype).tiny)
+    H *= (scale / np.maximum(H_norm, np.finfo(H.dtype).tiny))[:, np.newaxis]
+    # zeros would start components at E[log x] = -inf, they get the value
+    # whose products average to the mean rating instead (NNDSVDa)
+    fill = np.sqrt(X.sum() / float(np.prod(X.shape)) / n_components)
+    return np.maximum(W, fill), np.maximum(H, fill)
+
+
+def converged(Ex, Ex_old, tol):
+    ''' Whether the mean relative change from Ex_old to Ex is below tol '''
+    return np.mean(np.abs(Ex - Ex_old) / Ex_old) < tol
+
+
+def observed(x):
+    '''
+    Whether x is an observed factor passed to fit, a dense array or a scipy
+    sparse matrix (e.g. the category indicators), rather than False/None
+    '''
+    return isinstance(x, np.ndarray) or sparse.issparse(x)
+
+
+def observed_factor(x, dtype):
+    '''
+    An observed factor in the model dtype, as CSR if it is sparse or at most
+    SPARSE_DENSITY dense, otherwise as an array
+    '''
+    if sparse.issparse(x):
+        return sparse.csr_matrix(x, dtype=dtype)
+    x = np.asarray(x, dtype=dtype)
+    if np.count_nonzero(x) <= SPARSE_DENSITY * x.size:
+        return sparse.csr_matrix(x)
+    return x
+
+
+def factor_sums(Eb):
+    '''
+    The sums over items of the item factor Eb (dense or sparse), as the
+    n_components x 1 column added to the users' rate parameters
+    '''
+    if sparse.issparse(Eb):
+        return np.asarray(Eb.sum(axis=0), dtype=Eb.dtype).T
+    return np.sum(Eb, axis=0, keepdims=True).T
+
+
+def to_dense(x):
+    ''' x as a dense array, e.g. a sparse observed Eb when writing results '''
+    if sparse.issparse(x):
+        return x.toarray()
+    return x
+
+
+class CategoryMask(object):
+    '''
+    The (item, component) entries of an item factor that lie in the item's
+    observed categories, i.e. the nonzeros of beta (dense or sparse), kept as
+    index arrays instead of a dense boolean matrix. take, put and copyto
+    address either those entries (inside=True) or all the others, in the
+    row-major order of boolean mask indexing, so they stand in for
+    x[beta_bool], x[~beta_bool] and np.copyto(..., where=beta_bool).
+
+    stale is set when entries outside the mask of an item factor's gamma/rho
+    were written without recomputing its expectations, so that the next
+    update_in_category recomputes all of them.
+    '''
+    def __init__(self, beta):
+        beta = sparse.csr_matrix(beta, copy=True)
+        beta.sum_duplicates()
+        beta.eliminate_zeros()
+        self.shape = beta.shape
+        self.stale = False
+        self.indptr = beta.indptr.astype(np.int32)
+        self.rows = np.repeat(np.arange(beta.shape[0], dtype=np.int32),
+                              np.diff(beta.indptr))
+        self.cols = beta.indices.astype(np.int32)
+        self._flat = self.rows * np.int64(beta.shape[1]) + self.cols
+
+    def take(self, x, inside=True):
+        ''' Copy of the masked (or unmasked) entries of x '''
+        if inside:
+            return x[self.rows, self.cols]
+        return np.delete(x.ravel(), self._flat)
+
+    def put(self, x, values, inside=True):
+        ''' Set the masked (or unmasked) entries of x to values '''
+        if inside:
+            x[self.rows, self.cols] = values
+            return
+        kept = x[self.rows, self.cols]
+        if np.ndim(values) == 0:
+            x.fill(values)
+        else:
+            # values, with the kept entries spliced back in at their places
+            x[...] = np.insert(values, self._flat - np.arange(self._flat.size),
+                               kept).reshape(x.shape)
+        x[self.rows, self.cols] = kept
+
+    def copyto(self, dst, src, inside=True):
+        ''' Copy the masked (or unmasked) entries of src, which broadcasts '''
+        src = np.broadcast_to(src, dst.shape)
+        if inside:
+            dst[self.rows, self.cols] = src[self.rows, self.cols]
+            return
+        kept = dst[self.rows, self.cols]
+        np.copyto(dst, src)
+        dst[self.rows, self.cols] = kept
+
+
+def update_in_category(model, name, values, rho):
+    '''
+    Write the in-category update of the item factor name ('b' or 'eps'):
+    values are the new gamma_<name> at the model._categories entries, in
+    their order (e.g. from kernels.ratio_dot_items_masked), and rho the new
+    rho_<name>, broadcasting against it. Only those entries of gamma, rho,
+    E[x] and E[log x] are rewritten, in place, and the others cost nothing.
+    The expectations are recomputed everywhere instead when they may be out
+    of step with gamma and rho elsewhere: when categories.stale, or when
+    they are not the workspace buffers the model's updates write (e.g. after
+    a Snapshot restored E[x] alone, or on the first update).
+    '''
+    categories = model._categories
+    gamma = getattr(model, 'gamma_' + name)
+    rate = getattr(model, 'rho_' + name)
+    Ex, Elogx = model.workspace.expectations(name, gamma.shape)
+    categories.put(gamma, values)
+    categories.copyto(rate, rho)
+    if (categories.stale or getattr(model, 'E' + name) is not Ex or
+            getattr(model, 'Elog' + name) is not Elogx):
+        gamma_expectations(gamma, rate, Ex, Elogx)
+        setattr(model, 'E' + name, Ex)
+        setattr(model, 'Elog' + name, Elogx)
+        model.exp_cache.invalidate('Elog' + name)
+        categories.stale = False
+    else:
+        alpha, beta = categories.take(gamma), categories.take(rate)
+        categories.put(Ex, alpha / beta)
+        Elog = psi(alpha)
+        Elog -= np.log(beta)
+        categories.put(Elogx, Elog)
+        model.exp_cache.refresh('Elog' + name,
+                                (categories.rows, categories.cols))
+    check_dtype(model.dtype, gamma=gamma, rho=rate, Ex=Ex, Elogx=Elogx)
+
+
+def check_dtype(dtype, **arrays):
+    '''
+    Fail loudly when a variational parameter has drifted from the model dtype,
+    e.g. after an update silently promoted float32 to float64
+    '''
+    for name, value in sorted(arrays.items()):
+        if isinstance(value, np.ndarray) and value.dtype != dtype:
+            raise TypeError('{} has dtype {}, the model dtype is {}'.format(
+                name, value.dtype, np.dtype(dtype)))
+
+
+class Workspace(object):
+    '''
+    Named buffers owned by an estimator and reused by every iteration of fit,
+    so that steady-state updates write in place instead of allocating. A
+    buffer is only reallocated when the requested shape changes.
+    '''
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.logger = logging.getLogger(__name__)
+        self.allocations = 0
+        self._buffers = dict()
+
+    def get(self, name, shape):
+        ''' Buffer of the given shape, with arbitrary contents '''
+        shape = tuple(shape)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != self.dtype:
+            buf = np.empty(shape, dtype=self.dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+    def expectations(self, name, shape):
+        ''' The (E[x], E[log x]) buffers of a factor, e.g. name='t' '''
+        return self.get('E' + name, shape), self.get('Elog' + name, shape)
+
+    def log_stats(self):
+        nbytes = sum(buf.nbytes for buf in self._buffers.values())
+        self.logger.info('workspace: {} buffers, {:.1f} MB, {} allocations'
+                         .format(len(self._buffers), nbytes / 2. ** 20,
+                                 self.allocations))
+
+
+def gamma_expectations(alpha, beta, Ex, Elogx):
+    '''
+    Given x ~ Gam(alpha, beta), write E[x] and E[log x] into Ex and Elogx.
+    alpha and beta may broadcast against Ex; the rows are processed in blocks
+    so that temporaries stay small.
+    '''
+    n_rows = Ex.shape[0]
+    step = max(1, BLOCK_ELEMENTS // max(1, Ex.size // max(1, n_rows)))
+    for start in xrange(0, n_rows, step):
+        block = slice(start, start + step)
+        a, b = _rows(alpha, block, Ex), _rows(beta, block, Ex)
+        np.divide(a, b, out=Ex[block])
+        psi(a, out=Elogx[block])
+        Elogx[block] -= np.log(b)
+    return Ex, Elogx
+
+
+def psi(x, out=None):
+    '''
+    The digamma function. float32 arrays go through the float32 kernel in
+    kernels.digamma, everything else through scipy.special.psi
+    '''
+    if (isinstance(x, np.ndarray) and x.dtype == np.float32 and
+            (out is None or out.shape == x.shape and out.flags.c_contiguous)):
+        return kernels.digamma(x, out=out)
+    return special.psi(x, out=out)
+
+
+def _rows(x, block, like):
+    ''' The rows of x in block, unless x only broadcasts along them '''
+    if np.ndim(x) == like.ndim and x.shape[0] == like.shape[0]:
+        return x[block]
+    return x